@@ -1,8 +1,11 @@
+from sqlalchemy import select, update, delete, func, event
+from sqlalchemy.schema import CreateIndex
 from sqlalchemy.ext.asyncio import create_async_engine, AsyncSession
 from sqlalchemy.orm import sessionmaker
 from dotenv import load_dotenv
 # Import Base from models instead of redefining it
-from app.database.models import Base
+from app.database.models import Base, CartItem, CART_ITEM_LINE_KEY
+from app.database.versions import track_table_versions
 import os
 
 load_dotenv()
@@ -12,6 +15,33 @@ DATABASE_URL = os.getenv("DATABASE_URL", "sqlite+aiosqlite:///./test.db")
 # Create engine
 engine = create_async_engine(DATABASE_URL, echo=True)
 
+# Track table changes for versioned caches
+track_table_versions(engine.sync_engine)
+
+
+def begin_before_sqlite_savepoints(sync_engine) -> None:
+    """Открывает транзакцию SQLite явным BEGIN перед SAVEPOINT вне транзакции
+
+    Драйвер sqlite3 сам начинает транзакцию только перед INSERT/UPDATE/DELETE, поэтому
+    SAVEPOINT после одних SELECT становился внешней транзакцией, и RELEASE сразу
+    фиксировал изменения: откат или неудачная фиксация сессии их уже не отменяли.
+    Явный BEGIN нужен только здесь: если начинать так каждую транзакцию, чтение
+    удерживало бы блокировку до конца сессии, и параллельные оформления заказов
+    взаимно блокировались бы ("database is locked").
+    """
+
+    @event.listens_for(sync_engine, "savepoint")
+    def _savepoint(conn, name):
+        dbapi_connection = conn.connection.dbapi_connection
+        # Адаптер aiosqlite хранит соединение драйвера в _connection
+        driver_connection = getattr(dbapi_connection, "_connection", dbapi_connection)
+        if not driver_connection.in_transaction:
+            conn.exec_driver_sql("BEGIN")
+
+
+if engine.dialect.name == "sqlite":
+    begin_before_sqlite_savepoints(engine.sync_engine)
+
 # Create session factory
 SessionLocal = sessionmaker(
     bind=engine,
@@ -23,4 +53,29 @@ SessionLocal = sessionmaker(
 async def init_db():
     async with engine.begin() as conn:
         # Create all tables if they don't exist
-        await conn.run_sync(Base.metadata.create_all)
\ No newline at end of file
+        await conn.run_sync(Base.metadata.create_all)
+        # Индексы, добавленные после создания таблиц, create_all для существующих таблиц не создает
+        await _merge_duplicate_cart_lines(conn)
+        # checkfirst не видит индексы по выражениям (SQLite их не отражает), поэтому IF NOT EXISTS
+        await conn.execute(CreateIndex(_cart_line_index(), if_not_exists=True))
+
+
+def _cart_line_index():
+    return next(index for index in CartItem.__table__.indexes if index.name == "uq_cart_items_line")
+
+
+async def _merge_duplicate_cart_lines(conn):
+    """Сливает одинаковые строки корзины, чтобы можно было создать уникальный индекс"""
+    duplicates = await conn.execute(
+        select(func.min(CartItem.id), func.sum(CartItem.quantity), *CART_ITEM_LINE_KEY)
+        .group_by(*CART_ITEM_LINE_KEY)
+        .having(func.count() > 1)
+    )
+    for keep_id, quantity, cart_id, product_id, size, color in duplicates.all():
+        await conn.execute(update(CartItem).where(CartItem.id == keep_id).values(quantity=quantity))
+        await conn.execute(
+            delete(CartItem).where(
+                CartItem.id != keep_id,
+                *(column == value for column, value in zip(CART_ITEM_LINE_KEY, (cart_id, product_id, size, color)))
+            )
+        )
\ No newline at end of file
@@ -0,0 +1,23 @@
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlalchemy.ext.asyncio import AsyncSession
+
+
+def dialect_name(session: AsyncSession) -> str:
+    """Имя диалекта БД, к которой привязана сессия ('sqlite', 'postgresql', ...)"""
+    return session.get_bind().dialect.name
+
+
+def upsert_insert(session: AsyncSession, table):
+    """Возвращает insert() с поддержкой ON CONFLICT для диалекта текущей сессии"""
+    name = dialect_name(session)
+    if name == "postgresql":
+        return postgresql.insert(table)
+    if name == "sqlite":
+        return sqlite.insert(table)
+    raise NotImplementedError(f"ON CONFLICT не поддерживается для диалекта '{name}'")
+
+
+def chunked(items: list, size: int):
+    """Разбивает список на последовательные части не длиннее size"""
+    for start in range(0, len(items), size):
+        yield items[start:start + size]
@@ -1,5 +1,5 @@
 from sqlalchemy.orm import declarative_base, relationship
-from sqlalchemy import Column, Integer, String, Boolean, Date, ForeignKey, Text, DateTime, Float
+from sqlalchemy import Column, Integer, String, Boolean, Date, ForeignKey, Text, DateTime, Float, Index, JSON, UniqueConstraint, func, literal_column
 from datetime import date, datetime
 
 Base = declarative_base()
@@ -47,6 +47,24 @@ class CartItem(Base):
     cart = relationship("Cart", back_populates="items")
     product = relationship("Product", back_populates="cart_items")
 
+    # Одна строка на товар с одинаковыми размером и цветом; NULL приводится к '', иначе строки не считаются равными
+    __table_args__ = (
+        Index(
+            "uq_cart_items_line",
+            "cart_id", "product_id", func.coalesce(size, literal_column("''")), func.coalesce(color, literal_column("''")),
+            unique=True
+        ),
+    )
+
+
+# Ключ строки корзины в том же виде, что и в индексе uq_cart_items_line (для ON CONFLICT)
+CART_ITEM_LINE_KEY = (
+    CartItem.cart_id,
+    CartItem.product_id,
+    func.coalesce(CartItem.size, literal_column("''")),
+    func.coalesce(CartItem.color, literal_column("''")),
+)
+
 
 class TPointsTransaction(Base):
     __tablename__ = "tpoints"
@@ -117,6 +135,29 @@ class OrderItem(Base):
     product = relationship("Product")
 
 
+class CheckoutRequest(Base):
+    """Оформление корзины по токену кнопки; уникальность защищает от повторного заказа"""
+    __tablename__ = "checkout_requests"
+    __table_args__ = (UniqueConstraint("user_id", "token", name="uq_checkout_requests_token"),)
+
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    user_id = Column(Integer, ForeignKey("users.telegram_id"), nullable=False)
+    token = Column(String, nullable=False)
+    order_id = Column(Integer, ForeignKey("orders.id"), nullable=True)
+    result = Column(JSON, nullable=True)
+    created_at = Column(DateTime, default=datetime.now)
+
+
+class FSMRecord(Base):
+    """Состояние и данные FSM пользователя (см. app/states/storage.py)"""
+    __tablename__ = "fsm_states"
+
+    key = Column(String, primary_key=True)
+    state = Column(String, nullable=True)
+    data = Column(Text, nullable=True)  # JSON
+    updated_at = Column(DateTime, nullable=False, default=datetime.now, index=True)
+
+
 class AnonymousQuestion(Base):
     __tablename__ = "questions"
     id = Column(Integer, primary_key=True, autoincrement=True)
@@ -0,0 +1,85 @@
+from collections import defaultdict
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+# Счётчики изменений таблиц в этом процессе: {имя таблицы: версия}
+_table_versions: dict[str, int] = defaultdict(int)
+
+# Версия остатков товаров. Резерв и возврат остатков при оформлении заказа меняют
+# только ее, а не версию "products", так что кэши названий и цен (корзины) не
+# сбрасываются каждым заказом. Кэши, зависящие от остатков, учитывают обе версии.
+STOCK_VERSION = "products.stock"
+
+# Счётчики в общей памяти, если бот работает в нескольких процессах: {имя таблицы: Value}
+_shared_versions: dict = {}
+
+
+def shared_table_versions(context, tables) -> dict:
+    """Создает счётчики версий в общей памяти для передачи в дочерние процессы"""
+    return {table: context.Value("q", 0) for table in (*tables, STOCK_VERSION)}
+
+
+def use_shared_table_versions(counters: dict) -> None:
+    """Переключает учёт версий на общие счётчики: изменения в любом процессе видны во всех"""
+    _shared_versions.update(counters)
+
+
+def _bump(table: str) -> None:
+    counter = _shared_versions.get(table)
+    if counter is None:
+        _table_versions[table] += 1
+        return
+    with counter.get_lock():
+        counter.value += 1
+
+
+def table_version(*tables: str) -> tuple:
+    """Текущая версия данных указанных таблиц
+
+    Версия меняется при каждом INSERT/UPDATE/DELETE, а также при фиксации и откате
+    транзакции, в которой таблица изменялась. Запрос с execution_options(version=...)
+    меняет указанную версию вместо версии своей таблицы (см. STOCK_VERSION). Значение, полученное до чтения данных,
+    можно использовать как ключ кэша для построенного по ним результата.
+    """
+    return tuple(
+        _shared_versions[table].value if table in _shared_versions else _table_versions[table]
+        for table in tables
+    )
+
+
+def changed_versions(compiled, execution_options) -> set:
+    """Версии, которые меняет скомпилированный запрос
+
+    Учитываются и INSERT/UPDATE/DELETE внутри CTE (WITH ... UPDATE ... SELECT в
+    PostgreSQL): такой запрос компилируется как SELECT и флагов isupdate/isinsert не имеет.
+    """
+    names = set()
+    # У компиляторов DDL этих флагов нет
+    if any(getattr(compiled, flag, False) for flag in ("isinsert", "isupdate", "isdelete")):
+        table = getattr(compiled.statement, "table", None)
+        if table is not None:
+            names.add(execution_options.get("version", table.name))
+    for cte in getattr(compiled, "ctes", None) or ():
+        if getattr(cte.element, "is_dml", False):
+            names.add(cte.element.table.name)
+    return names
+
+
+def track_table_versions(engine: Engine) -> None:
+    """Подписывает движок на учёт изменений таблиц"""
+
+    @event.listens_for(engine, "after_cursor_execute")
+    def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        if context is None or context.compiled is None:
+            return
+        for name in changed_versions(context.compiled, context.execution_options):
+            _bump(name)
+            conn.info.setdefault("changed_tables", set()).add(name)
+
+    def _end_transaction(conn):
+        # Изменения стали видны другим соединениям (или отменены) - версия снова меняется
+        for name in conn.info.pop("changed_tables", ()):
+            _bump(name)
+
+    event.listen(engine, "commit", _end_transaction)
+    event.listen(engine, "rollback", _end_transaction)
@@ -6,11 +6,14 @@ from app.repositories.user_repo import UserRepo
 from app.repositories.order_repo import OrderRepo
 from app.repositories.anon_question_repo import AnonymousQuestionRepo
 from app.repositories.cart_repo import CartRepository
+from app.repositories.export_repo import ExportRepo
 from app.services.catalog_service import CatalogService
 from app.services.user_service import UserService
 from app.services.order_service import OrderService
 from app.services.question_service import AnonymousQuestionService
 from app.services.cart_service import CartService
+from app.services.export_service import ExportService
+from app.services.notification_service import NotificationService
 from app.database.database import SessionLocal
 import inspect
 
@@ -72,6 +75,11 @@ def inject_services(*service_classes: Type):
                         elif service_class == CartService:
                             # Pass the session directly to CartService as it expects it
                             kwargs[service_name] = CartService(session)
+                        elif service_class == NotificationService:
+                            # Бот берется из события (Message / CallbackQuery)
+                            kwargs[service_name] = NotificationService(args[0].bot)
+                        elif service_class == ExportService:
+                            kwargs[service_name] = ExportService(ExportRepo(session))
 
                     # Проверяем, что все необходимые сервисы созданы
                     missing_args = [service_class.__name__.lower() for service_class in service_classes if service_class.__name__.lower() not in kwargs]
@@ -11,10 +11,9 @@ from app.repositories.user_repo import UserRepo
 from app.utils.text import anonymous_block_description
 from app.utils.exel import anon_question_create_excel_file
 from app.decorator.injectors import inject_services
+from app.utils.export_cache import send_cached_export
+from app.database.versions import table_version
 import asyncio
-import tempfile
-import os
-from aiogram.types import FSInputFile
 
 
 anon_questions_router = Router()
@@ -157,33 +156,29 @@ async def mark_question_later(callback: CallbackQuery, anonymousquestionrepo: An
 @inject_services(AnonymousQuestionRepo)
 async def handle_export_excel(callback: CallbackQuery, anonymousquestionrepo: AnonymousQuestionRepo):
     try:
-        # Получаем все вопросы
-        questions = await anonymousquestionrepo.get_all_questions()
+        # Версия берётся до чтения данных: повторная выгрузка без новых вопросов идёт из кэша
+        version = table_version("questions")
+        questions_count = await anonymousquestionrepo.count_questions()
 
-        if not questions:
+        if not questions_count:
             await callback.answer("Нет вопросов для выгрузки.", show_alert=True)
             return
 
-        # Генерируем Excel
-        excel_data = anon_question_create_excel_file(questions)
-
-        if not isinstance(excel_data, bytes):
-            await callback.answer("Ошибка: неверный формат данных", show_alert=True)
-            return
-
-        # Сохраняем временно
-        with tempfile.NamedTemporaryFile(delete=False, suffix=".xlsx") as temp_file:
-            temp_file.write(excel_data)
-            temp_path = temp_file.name
+        async def build_excel() -> bytes:
+            questions = await anonymousquestionrepo.get_all_questions()
+            return anon_question_create_excel_file(questions)
 
         # Удаляем старое сообщение с кнопками (если не важно сохранять)
         await callback.message.delete()
 
         # Отправляем Excel
-        document = FSInputFile(temp_path, filename="anonymous_questions.xlsx")
-        await callback.message.answer_document(
-            document,
-            caption=f"📥 Выгрузка всех анонимных вопросов ({len(questions)} шт.)"
+        await send_cached_export(
+            callback.message,
+            name="questions",
+            version=version,
+            build=build_excel,
+            filename="anonymous_questions.xlsx",
+            caption=f"📥 Выгрузка всех анонимных вопросов ({questions_count} шт.)"
         )
 
         await callback.answer("Файл успешно создан ✅")
@@ -193,13 +188,10 @@ async def handle_export_excel(callback: CallbackQuery, anonymousquestionrepo: An
         await callback.answer("Ошибка при создании Excel-файла 😕", show_alert=True)
 
     finally:
-        if 'temp_path' in locals() and os.path.exists(temp_path):
-            os.unlink(temp_path)
-
         # Отправляем новое меню с клавиатурой
         await callback.message.answer(
             "📋 <b>Меню анонимных вопросов</b>\n\n"
             "Выберите действие:",
             reply_markup=anon_questions_menu_keyboard(),
             parse_mode="HTML"
-        )
\ No newline at end of file
+        )
@@ -8,6 +8,8 @@ from app.handlers.catalog import open_catalog
 from app.services.cart_service import CartService
 from app.services.catalog_service import CatalogService
 from app.services.notification_service import NotificationService
+from app.services.flash_sale import flash_sale
+from app.services.cart_debounce import cart_quantities
 from app.decorator.injectors import inject_services
 from app.keyboards.cart_keyboard import (
     get_cart_keyboard,
@@ -26,11 +28,21 @@ async def show_cart(callback: CallbackQuery, cartservice: CartService, catalogse
     """Просмотр корзины"""
     user_id = callback.from_user.id
     
-    # Получаем корзину пользователя
-    cart = await cartservice.get_or_create_cart(user_id)
+    # Отложенные нажатия "+"/"-" записываются до чтения корзины
+    await cart_quantities.flush_user(user_id)
+    # Получаем корзину пользователя (из кэша, если она не менялась)
+    cart = await cartservice.get_cart_view(user_id)
     
+    await render_cart(callback, cart)
     if not cart.items:
         await callback.answer("Ваша корзина пуста", show_alert=True)
+    else:
+        await callback.answer()
+
+
+async def render_cart(callback: CallbackQuery, cart):
+    """Показывает корзину (или сообщение о пустой корзине) в сообщении callback"""
+    if not cart.items:
         await update_message(
             callback,
             text="Ваша корзина пуста",
@@ -47,7 +59,6 @@ async def show_cart(callback: CallbackQuery, cartservice: CartService, catalogse
         text=text,
         reply_markup=get_cart_keyboard(cart)
     )
-    await callback.answer()
 
 
 async def format_cart_message(cart):
@@ -84,7 +95,7 @@ async def show_cart_item(callback: CallbackQuery, cartservice: CartService):
     user_id = callback.from_user.id
     
     # Получаем корзину пользователя
-    cart = await cartservice.get_or_create_cart(user_id)
+    cart = await cartservice.get_cart_view(user_id)
     
     # Находим нужный товар
     item = next((i for i in cart.items if i.id == item_id), None)
@@ -93,7 +104,17 @@ async def show_cart_item(callback: CallbackQuery, cartservice: CartService):
         await callback.answer("Товар не найден в корзине", show_alert=True)
         return
     
-    # Форматируем сообщение
+    # Отправляем сообщение с клавиатурой
+    await update_message(
+        callback,
+        text=format_cart_item_message(item),
+        reply_markup=get_cart_item_keyboard(item)
+    )
+    await callback.answer()
+
+
+def format_cart_item_message(item) -> str:
+    """Форматирует сообщение с отдельным товаром корзины"""
     product = item.product
     text = (
         f"<b>{product.name}</b>\n\n"
@@ -101,20 +122,13 @@ async def show_cart_item(callback: CallbackQuery, cartservice: CartService):
         f"Количество: {item.quantity}\n"
         f"Сумма: {product.price * item.quantity} T-points\n"
     )
-    
+
     if item.size:
         text += f"Размер: {item.size}\n"
-    
+
     if item.color:
         text += f"Цвет: {item.color}\n"
-    
-    # Отправляем сообщение с клавиатурой
-    await update_message(
-        callback,
-        text=text,
-        reply_markup=get_cart_item_keyboard(item)
-    )
-    await callback.answer()
+    return text
 
 
 @cart_router.callback_query(F.data.startswith("remove_cart_item_"))
@@ -125,24 +139,13 @@ async def remove_cart_item(callback: CallbackQuery, cartservice: CartService):
     user_id = callback.from_user.id
     
     # Удаляем товар из корзины
+    await cart_quantities.flush_user(user_id)
     await cartservice.remove_from_cart(user_id, item_id)
     await callback.answer("Товар удален из корзины")
     
     # Обновляем корзину
-    cart = await cartservice.get_or_create_cart(user_id)
-    if not cart.items:
-        await update_message(
-            callback,
-            text="Ваша корзина пуста",
-            reply_markup=get_empty_cart_keyboard()
-        )
-    else:
-        text = await format_cart_message(cart)
-        await update_message(
-            callback,
-            text=text,
-            reply_markup=get_cart_keyboard(cart)
-        )
+    cart = await cartservice.get_cart_view(user_id)
+    await render_cart(callback, cart)
 
 
 @cart_router.callback_query(F.data == "clear_cart")
@@ -152,6 +155,7 @@ async def clear_cart(callback: CallbackQuery, cartservice: CartService):
     user_id = callback.from_user.id
     
     # Очищаем корзину
+    await cart_quantities.flush_user(user_id)
     await cartservice.clear_user_cart(user_id)
     
     await callback.answer("Корзина очищена")
@@ -162,34 +166,68 @@ async def clear_cart(callback: CallbackQuery, cartservice: CartService):
     )
 
 
-@cart_router.callback_query(F.data == "checkout_cart")
+@cart_router.callback_query(F.data.startswith("checkout_cart"))
 @inject_services(CartService, NotificationService)
 async def checkout_cart(callback: CallbackQuery, cartservice: CartService, notificationservice: NotificationService):
     """Оформление заказа"""
     user_id = callback.from_user.id
+    # Токен кнопки: повторное нажатие на ту же кнопку не оформит второй заказ
+    token = callback.data.partition(":")[2] or None
     username = callback.from_user.username or f"user_{user_id}"
+    await cart_quantities.flush_user(user_id)
+    
+    # Заказы с товарами распродажи оформляются через очередь
+    if flash_sale.product_ids:
+        cart = await cartservice.get_cart_view(user_id)
+        quantities = {}
+        for item in cart.items:
+            quantities[item.product_id] = quantities.get(item.product_id, 0) + item.quantity
+        if flash_sale.applies_to(quantities):
+            async def on_result(success: bool, result):
+                if not success:
+                    await callback.message.answer(f"❌ {result}", reply_markup=get_empty_cart_keyboard())
+                    return
+                await callback.message.answer(
+                    checkout_success_text(result), reply_markup=get_checkout_keyboard(), parse_mode="HTML"
+                )
+                if result.get("duplicate"):
+                    return
+                await notificationservice.notify_hr_about_order(
+                    order_id=result['order_id'],
+                    user_id=user_id,
+                    username=username,
+                    total_cost=result['total_cost'],
+                    order_items=result['order_items']
+                )
+
+            position = await flash_sale.submit(user_id, quantities, on_result, token)
+            if position is None:
+                await callback.answer("Ваш заказ уже в очереди", show_alert=True)
+                return
+            await update_message(
+                callback,
+                text=f"⏳ <b>Вы в очереди на оформление</b> (№{position}).\n\nРезультат придет отдельным сообщением."
+            )
+            await callback.answer()
+            return
     
     # Оформляем заказ
-    success, result = await cartservice.checkout_cart(user_id)
+    success, result = await cartservice.checkout_cart(user_id, token)
     
     if not success:
         await callback.answer(result, show_alert=True)
         return
     
     # Отправляем сообщение об успешном оформлении заказа
-    text = (
-        "✅ <b>Заказ успешно оформлен!</b>\n\n"
-        f"Номер заказа: <b>#{result['order_id']}</b>\n"
-        f"Сумма заказа: <b>{result['total_cost']} T-points</b>\n"
-        f"Остаток на счету: <b>{result['remaining_balance']} T-points</b>\n\n"
-        "Наш менеджер свяжется с вами для уточнения деталей доставки."
-    )
-    
     await update_message(
         callback,
-        text=text,
+        text=checkout_success_text(result),
         reply_markup=get_checkout_keyboard()
     )
+    if result.get("duplicate"):
+        # Повторное нажатие: заказ уже оформлен, HR уже уведомлен
+        await callback.answer("Заказ уже оформлен")
+        return
     await callback.answer("Заказ успешно оформлен!")
     
     # Отправляем уведомление HR-менеджеру
@@ -202,85 +240,50 @@ async def checkout_cart(callback: CallbackQuery, cartservice: CartService, notif
     )
 
 
+def checkout_success_text(result: dict) -> str:
+    return (
+        "✅ <b>Заказ успешно оформлен!</b>\n\n"
+        f"Номер заказа: <b>#{result['order_id']}</b>\n"
+        f"Сумма заказа: <b>{result['total_cost']} T-points</b>\n"
+        f"Остаток на счету: <b>{result['remaining_balance']} T-points</b>\n\n"
+        "Наш менеджер свяжется с вами для уточнения деталей доставки."
+    )
+
+
 @cart_router.callback_query(F.data.startswith("increase_quantity_"))
-@inject_services(CartService)
-async def increase_quantity(callback: CallbackQuery, cartservice: CartService):
+async def increase_quantity(callback: CallbackQuery):
     """Увеличение количества товара в корзине"""
-    item_id = int(callback.data.split("_")[2])
-    user_id = callback.from_user.id
-    
-    # Увеличиваем количество товара
-    await cartservice.update_quantity(user_id, item_id, 1)
-    await callback.answer("Количество увеличено")
-    
-    # Обновляем информацию о товаре
-    cart = await cartservice.get_or_create_cart(user_id)
-    item = next((i for i in cart.items if i.id == item_id), None)
-    
-    if item:
-        # Если находимся в детальном просмотре товара
-        product = item.product
-        text = (
-            f"<b>{product.name}</b>\n\n"
-            f"Цена: {product.price} T-points\n"
-            f"Количество: {item.quantity}\n"
-            f"Сумма: {product.price * item.quantity} T-points\n"
-        )
-        
-        if item.size:
-            text += f"Размер: {item.size}\n"
-        
-        if item.color:
-            text += f"Цвет: {item.color}\n"
-        
-        await update_message(
-            callback,
-            text=text,
-            reply_markup=get_cart_item_keyboard(item)
-        )
+    await tap_quantity(callback, 1, "Количество увеличено")
 
 
 @cart_router.callback_query(F.data.startswith("decrease_quantity_"))
-@inject_services(CartService)
-async def decrease_quantity(callback: CallbackQuery, cartservice: CartService):
+async def decrease_quantity(callback: CallbackQuery):
     """Уменьшение количества товара в корзине"""
+    await tap_quantity(callback, -1, "Количество уменьшено")
+
+
+async def tap_quantity(callback: CallbackQuery, delta: int, answer: str):
+    """Нажатие "+"/"-": отвечаем сразу, а запись и перерисовку делает один раз cart_quantities"""
     item_id = int(callback.data.split("_")[2])
     user_id = callback.from_user.id
-    
-    # Уменьшаем количество товара
-    await cartservice.update_quantity(user_id, item_id, -1)
-    await callback.answer("Количество уменьшено")
-    
-    # Обновляем информацию о товаре в интерфейсе
-    cart = await cartservice.get_or_create_cart(user_id)
-    # Проверяем, существует ли товар ещё (мог быть удален при уменьшении до 0)
-    item = next((i for i in cart.items if i.id == item_id), None)
-    
-    if item:
-        # Если товар все еще существует, обновляем его отображение
-        product = item.product
-        text = (
-            f"<b>{product.name}</b>\n\n"
-            f"Цена: {product.price} T-points\n"
-            f"Количество: {item.quantity}\n"
-            f"Сумма: {product.price * item.quantity} T-points\n"
-        )
-        
-        if item.size:
-            text += f"Размер: {item.size}\n"
-        
-        if item.color:
-            text += f"Цвет: {item.color}\n"
-        
-        await update_message(
-            callback,
-            text=text,
-            reply_markup=get_cart_item_keyboard(item)
-        )
-    else:
-        # Если товар был удален (количество стало 0), возвращаемся к корзине
-        await show_cart(callback, cartservice)
-        
+
+    async def on_flush(quantity, cart):
+        item = cart.find(item_id)
+        if item:
+            # Если товар все еще существует, обновляем его отображение
+            await update_message(
+                callback,
+                text=format_cart_item_message(item),
+                reply_markup=get_cart_item_keyboard(item)
+            )
+        else:
+            # Если товар был удален (количество стало 0), возвращаемся к корзине
+            await render_cart(callback, cart)
+
+    cart_quantities.tap(user_id, item_id, delta, on_flush)
+    await callback.answer(answer)
+
+
 @cart_router.callback_query(F.data == "show_catalog")
 async def redirect_to_catalog(callback: CallbackQuery):
     """Перенаправление в каталог"""
@@ -1,17 +1,23 @@
 from aiogram import Router, F, Bot
-from aiogram.types import CallbackQuery, FSInputFile, Message
+from aiogram.types import CallbackQuery, Document, Message
 from aiogram.fsm.context import FSMContext
+from aiogram.filters import StateFilter
 from aiogram.enums.parse_mode import ParseMode
-import os
-import tempfile
+from datetime import datetime
+from html import escape
 
 from sqlalchemy.ext.asyncio import AsyncSession
 
 from app.states.states import CatalogStates
-from app.keyboards.catalog_manage_keyboard import catalog_manage
+from app.keyboards.catalog_manage_keyboard import catalog_manage, catalog_import_confirm
 from app.keyboards.main_menu_keyboard import user_main_menu
 from app.services.catalog_service import CatalogService
 from app.decorator.injectors import inject_services
+from app.utils.text import catalog_diff_description
+from app.utils.message_editor import ProgressMessage
+from app.utils.export_cache import send_cached_export
+from app.utils.telegram_files import downloaded_document
+from app.database.versions import table_version, STOCK_VERSION
 
 catalog_manage_router = Router()
 
@@ -34,9 +40,16 @@ async def upload_catalog_handler(callback: CallbackQuery, catalogservice: Catalo
     try:
         await callback.message.edit_text("⏳ Генерация Excel-файла...", parse_mode=ParseMode.HTML)
 
-        # Генерация Excel
-        file_path = await catalogservice.create_catalog_excel()
-        excel_file = FSInputFile(file_path)
+        # Повторная выгрузка без изменений каталога отправляется из кэша
+        version = table_version("products", STOCK_VERSION)
+        await send_cached_export(
+            callback.message,
+            name="catalog",
+            version=version,
+            build=catalogservice.create_catalog_excel_bytes,
+            filename=f"catalog_{datetime.now():%Y%m%d_%H%M%S}.xlsx",
+            caption="📊 Текущий каталог товаров в формате Excel."
+        )
 
         # Удаляем сообщение с клавиатурой
         try:
@@ -44,12 +57,6 @@ async def upload_catalog_handler(callback: CallbackQuery, catalogservice: Catalo
         except:
             pass
 
-        # Отправка Excel без клавиатуры
-        await callback.message.answer_document(
-            document=excel_file,
-            caption="📊 Текущий каталог товаров в формате Excel."
-        )
-
         # Клавиатура отправляется отдельно
         await callback.message.answer(
             "✅ Выгрузка каталога успешно выполнена.",
@@ -83,7 +90,10 @@ async def download_catalog_handler(callback: CallbackQuery, state: FSMContext):
     await state.update_data(hint_msg_id=msg.message_id)
 
 
-@catalog_manage_router.callback_query(CatalogStates.waiting_for_excel, F.data == "cancel_action")
+@catalog_manage_router.callback_query(
+    StateFilter(CatalogStates.waiting_for_excel, CatalogStates.confirm_import),
+    F.data == "cancel_action"
+)
 async def cancel_excel_upload(callback: CallbackQuery, state: FSMContext):
     await state.clear()
     await callback.answer("Загрузка отменена")
@@ -112,9 +122,9 @@ async def process_excel_file(
 
     file_name = message.document.file_name
     ext = file_name.split('.')[-1].lower() if '.' in file_name else ''
-    if ext not in ['xlsx', 'xls']:
+    if ext != 'xlsx':
         await message.answer(
-            "❌ Поддерживаются только .xlsx или .xls файлы.",
+            "❌ Поддерживаются только .xlsx файлы.",
             reply_markup=catalog_manage(include_cancel=True)
         )
         return
@@ -130,37 +140,55 @@ async def process_excel_file(
 
     # Сообщение о загрузке
     wait_message = await message.answer("⏳ Загружаю файл и обрабатываю данные...")
+    progress = ProgressMessage(wait_message)
 
-    try:
-        os.makedirs(catalogservice.excel_folder, exist_ok=True)
-        with tempfile.NamedTemporaryFile(delete=False, suffix=f"_{file_name}", dir=catalogservice.excel_folder) as tmp:
-            temp_path = tmp.name
-
-        file = await bot.get_file(message.document.file_id)
-        await bot.download_file(file.file_path, temp_path)
-
-        result = await catalogservice.import_catalog_from_excel(temp_path)
+    async def report_progress(rows_read: int):
+        await progress.update(f"⏳ Обрабатываю данные... Прочитано строк: {rows_read}")
 
-        try:
-            os.unlink(temp_path)
-        except:
-            pass
+    try:
+        # Файл скачивается в память (крупный - во временный файл, который удаляется сразу после обработки)
+        async with downloaded_document(bot, message.document) as source:
+            result = await catalogservice.import_catalog_from_excel(source, dry_run=True, progress=report_progress)
 
-        await state.clear()
         await wait_message.delete()
 
-        if result and result.get("success"):
-            updated_count = result.get("updated", 0)
+        if not result or not result.get("success"):
+            await state.clear()
+            msg = result.get("message", "Не удалось обработать файл")
             await message.answer(
-                f"✅ Каталог успешно обновлён.\nОбновлено товаров: {updated_count}",
+                f"❌ Ошибка при загрузке:\n{msg}",
                 reply_markup=catalog_manage()
             )
-        else:
-            msg = result.get("message", "Не удалось обработать файл")
+            return
+
+        diff = result["diff"]
+        errors_text = ""
+        if result.get("errors"):
+            errors_text = f"\n\n⚠️ Пропущено строк с ошибками: {len(result['errors'])}\n" + "\n".join(result["errors"][:3])
+            if len(result["errors"]) > 3:
+                errors_text += "\n... и другие"
+
+        if not diff["created"] and not diff["updated"] and not diff["stock"]:
+            await state.clear()
             await message.answer(
-                f"❌ Ошибка при загрузке:\n{msg}",
+                f"ℹ️ Изменений нет.\nБез изменений: {diff['unchanged']}" + errors_text,
                 reply_markup=catalog_manage()
             )
+            return
+
+        # Показываем HR изменения и ждём подтверждения. В FSM хранится только файл:
+        # при подтверждении он сравнивается с каталогом заново, так что правки,
+        # сделанные после предпросмотра, не затираются устаревшим снимком
+        await state.set_state(CatalogStates.confirm_import)
+        await state.update_data(
+            import_file=message.document.model_dump(include={"file_id", "file_unique_id", "file_name", "file_size"}),
+            import_preview={"created": len(diff["created"]), "updated": len(diff["updated"])}
+        )
+        await message.answer(
+            catalog_diff_description(diff) + escape(errors_text),
+            reply_markup=catalog_import_confirm(with_stock=bool(diff["stock"])),
+            parse_mode=ParseMode.HTML
+        )
 
     except Exception as e:
         print(f"Error processing Excel file: {e}")
@@ -172,6 +200,54 @@ async def process_excel_file(
         )
 
 
+@catalog_manage_router.callback_query(CatalogStates.confirm_import, F.data.in_({"catalog_import_apply", "catalog_import_apply:stock"}))
+@inject_services(CatalogService)
+async def apply_catalog_import(callback: CallbackQuery, state: FSMContext, catalogservice: CatalogService, bot: Bot):
+    await callback.answer()
+    data = await state.get_data()
+    await state.clear()
+    # Остатки из файла применяются только отдельной кнопкой
+    apply_stock = callback.data == "catalog_import_apply:stock"
+
+    if not data.get("import_file"):
+        await callback.message.edit_text("❌ Загрузка устарела, отправьте файл заново.", reply_markup=catalog_manage())
+        return
+
+    await callback.message.edit_text("⏳ Применяю изменения...")
+    progress = ProgressMessage(callback.message)
+
+    async def report_progress(rows_read: int):
+        await progress.update(f"⏳ Применяю изменения... Обработано строк: {rows_read}")
+
+    try:
+        async with downloaded_document(bot, Document(**data["import_file"])) as source:
+            result = await catalogservice.import_catalog_from_excel(
+                source, progress=report_progress, apply_stock=apply_stock
+            )
+    except Exception as e:
+        print(f"Error applying catalog import: {e}")
+        result = {"success": False, "message": str(e)}
+
+    if result.get("success"):
+        text = (
+            "✅ Каталог успешно обновлён.\n"
+            f"Добавлено товаров: {result.get('created', 0)}\n"
+            f"Обновлено товаров: {result.get('updated', 0)}\n"
+            f"Без изменений: {result.get('unchanged', 0)}"
+        )
+        if result.get("stock"):
+            text += f"\nОбновлено остатков: {result['stock']}"
+        if result.get("stock_skipped"):
+            text += f"\nОстатки не менялись (отличаются у {result['stock_skipped']} товаров)"
+        preview = data.get("import_preview", {})
+        if (preview.get("created"), preview.get("updated")) != (result.get("created"), result.get("updated")):
+            text += "\n\nℹ️ Каталог изменился после предпросмотра, применены актуальные отличия."
+    else:
+        text = f"❌ Ошибка при загрузке:\n{result.get('message', 'Не удалось обработать файл')}"
+
+    await callback.message.edit_text(text, reply_markup=catalog_manage())
+
+
 @catalog_manage_router.callback_query(F.data == "menu:main")
 async def back_to_main_menu(callback: CallbackQuery):
     await callback.answer()
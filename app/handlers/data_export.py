@@ -0,0 +1,171 @@
+from datetime import datetime, date
+from typing import Optional
+
+from aiogram import Router, F
+from aiogram.types import CallbackQuery, Message, BufferedInputFile
+from aiogram.fsm.context import FSMContext
+from aiogram.filters import StateFilter
+
+from app.states.states import DataExportStates
+from app.keyboards.data_export_keyboard import (
+    DATASET_TITLES, data_export_datasets, data_export_formats, data_export_period, data_export_departments
+)
+from app.keyboards.user_manage_menu_keyboard import hr_user_management_keyboard
+from app.services.export_service import ExportService, EXPORT_FORMATS
+from app.decorator.injectors import inject_services
+from app.utils.message_editor import update_message
+
+data_export_router = Router()
+
+DATE_FORMATS = ("%d.%m.%Y", "%Y-%m-%d")
+
+
+def _parse_date(text: str) -> date:
+    for fmt in DATE_FORMATS:
+        try:
+            return datetime.strptime(text.strip(), fmt).date()
+        except ValueError:
+            continue
+    raise ValueError(text)
+
+
+def _parse_period(text: str) -> tuple[Optional[date], Optional[date]]:
+    """Разбирает период вида '01.01.2025 - 31.03.2025' (любая граница может быть '-' или пропущена)"""
+    parts = text.replace("—", " ").replace(" - ", " ").split()
+    if not parts or len(parts) > 2:
+        raise ValueError(text)
+    bounds = [None if part == "-" else _parse_date(part) for part in parts]
+    date_from, date_to = bounds[0], bounds[-1] if len(bounds) == 2 else None
+    if date_from and date_to and date_from > date_to:
+        raise ValueError(text)
+    return date_from, date_to
+
+
+@data_export_router.callback_query(F.data == "data_export")
+async def choose_dataset(callback: CallbackQuery, state: FSMContext):
+    await state.clear()
+    await update_message(
+        callback,
+        text="🗜 <b>Выгрузка данных в CSV/JSONL</b>\n\nФайл сжимается gzip. Выберите, что выгрузить:",
+        reply_markup=data_export_datasets()
+    )
+
+
+@data_export_router.callback_query(F.data.startswith("data_export:ds:"))
+async def choose_format(callback: CallbackQuery, state: FSMContext):
+    dataset = callback.data.split(":")[2]
+    if dataset not in DATASET_TITLES:
+        await callback.answer("Неизвестный набор данных", show_alert=True)
+        return
+
+    await state.update_data(export_dataset=dataset)
+    await update_message(
+        callback,
+        text=f"{DATASET_TITLES[dataset]}\n\nВыберите формат:",
+        reply_markup=data_export_formats()
+    )
+
+
+@data_export_router.callback_query(F.data.startswith("data_export:fmt:"))
+async def ask_period(callback: CallbackQuery, state: FSMContext):
+    fmt = callback.data.split(":")[2]
+    data = await state.get_data()
+    if fmt not in EXPORT_FORMATS or "export_dataset" not in data:
+        await callback.answer("Выгрузка устарела, начните заново", show_alert=True)
+        return
+
+    await state.update_data(export_format=fmt)
+    await state.set_state(DataExportStates.waiting_for_period)
+    await update_message(
+        callback,
+        text=(
+            "Отправьте период в формате <code>ДД.ММ.ГГГГ - ДД.ММ.ГГГГ</code>.\n"
+            "Чтобы не ограничивать одну из границ, укажите вместо неё <code>-</code>."
+        ),
+        reply_markup=data_export_period()
+    )
+
+
+@data_export_router.callback_query(F.data == "data_export:period:all", StateFilter(DataExportStates.waiting_for_period))
+@inject_services(ExportService)
+async def period_all(callback: CallbackQuery, state: FSMContext, exportservice: ExportService):
+    await state.update_data(export_date_from=None, export_date_to=None)
+    await _ask_department(callback.message, state, exportservice)
+    await callback.answer()
+
+
+@data_export_router.message(F.text, StateFilter(DataExportStates.waiting_for_period))
+@inject_services(ExportService)
+async def period_entered(message: Message, state: FSMContext, exportservice: ExportService):
+    try:
+        date_from, date_to = _parse_period(message.text)
+    except ValueError:
+        await message.answer(
+            "Не удалось разобрать период. Пример: <code>01.01.2025 - 31.03.2025</code>",
+            reply_markup=data_export_period(),
+            parse_mode="HTML"
+        )
+        return
+
+    await state.update_data(
+        export_date_from=date_from.isoformat() if date_from else None,
+        export_date_to=date_to.isoformat() if date_to else None
+    )
+    await _ask_department(message, state, exportservice)
+
+
+async def _ask_department(message: Message, state: FSMContext, exportservice: ExportService):
+    data = await state.get_data()
+    # Анонимные вопросы не связаны с отделами
+    if data["export_dataset"] == "questions":
+        await _send_export(message, state, exportservice, department=None)
+        return
+
+    departments = await exportservice.get_departments()
+    await state.update_data(export_departments=departments)
+    await state.set_state(DataExportStates.waiting_for_department)
+    await message.answer("Выберите отдел:", reply_markup=data_export_departments(departments))
+
+
+@data_export_router.callback_query(F.data.startswith("data_export:dep:"), StateFilter(DataExportStates.waiting_for_department))
+@inject_services(ExportService)
+async def department_chosen(callback: CallbackQuery, state: FSMContext, exportservice: ExportService):
+    choice = callback.data.split(":")[2]
+    departments = (await state.get_data()).get("export_departments", [])
+    department = None
+    if choice != "all":
+        index = int(choice)
+        if index >= len(departments):
+            await callback.answer("Список отделов изменился, начните заново", show_alert=True)
+            return
+        department = departments[index]
+
+    await callback.message.edit_reply_markup(reply_markup=None)
+    await _send_export(callback.message, state, exportservice, department)
+    await callback.answer()
+
+
+async def _send_export(message: Message, state: FSMContext, exportservice: ExportService, department: Optional[str]):
+    data = await state.get_data()
+    await state.clear()
+
+    date_from = date.fromisoformat(data["export_date_from"]) if data.get("export_date_from") else None
+    date_to = date.fromisoformat(data["export_date_to"]) if data.get("export_date_to") else None
+
+    wait_message = await message.answer("⏳ Готовлю выгрузку...")
+    result = await exportservice.export_dataset(
+        data["export_dataset"], data["export_format"], date_from, date_to, department
+    )
+    await wait_message.delete()
+
+    caption = f"{DATASET_TITLES[data['export_dataset']]}: {result['rows']} строк"
+    if department:
+        caption += f", отдел: {department}"
+    await message.answer_document(BufferedInputFile(result["data"], filename=result["filename"]), caption=caption)
+    await message.answer("⬇️ Файл выгружен. Что дальше?", reply_markup=hr_user_management_keyboard())
+
+
+@data_export_router.callback_query(F.data == "data_export:cancel")
+async def cancel_export(callback: CallbackQuery, state: FSMContext):
+    await state.clear()
+    await update_message(callback, text="Управление сотрудниками:", reply_markup=hr_user_management_keyboard())
@@ -12,6 +12,8 @@ from aiogram.enums.parse_mode import ParseMode
 from app.keyboards.order_manage_keyboard import order_management_keyboard,order_manage_back
 
 from app.decorator.injectors import inject_services
+from app.utils.export_cache import send_cached_export
+from app.database.versions import table_version
 
 order_router = Router()
 
@@ -49,6 +51,27 @@ async def show_order_management(callback: CallbackQuery, orderservice: OrderServ
 
     await callback.answer()
     
+@order_router.callback_query(F.data == "export_orders")
+@inject_services(OrderService)
+async def export_orders(callback: CallbackQuery, orderservice: OrderService):
+    await callback.message.edit_reply_markup(reply_markup=None)
+
+    await send_cached_export(
+        callback.message,
+        name="orders",
+        version=table_version("orders", "order_items", "users"),
+        build=orderservice.export_orders_to_excel,
+        filename="orders.xlsx"
+    )
+
+    stats = await orderservice.get_order_summary()
+    await callback.message.answer(
+        text="⬇️ Файл выгружен. Что дальше?",
+        reply_markup=order_management_keyboard(stats["pending"])
+    )
+    await callback.answer()
+
+
 @order_router.callback_query(F.data == "view_pending_orders")
 @inject_services(OrderService)
 async def view_pending_orders(callback: CallbackQuery, orderservice: OrderService):
@@ -1,5 +1,5 @@
 from aiogram import Router, F
-from aiogram.types import CallbackQuery, Message, FSInputFile
+from aiogram.types import CallbackQuery, Message
 from aiogram.fsm.context import FSMContext
 from aiogram.filters import StateFilter
 from aiogram.fsm.state import State, StatesGroup
@@ -7,10 +7,10 @@ from app.keyboards.user_manage_menu_keyboard import hr_user_management_keyboard
 from app.services.user_service import UserService
 from app.utils.exel import parse_excel_file
 from app.decorator.injectors import inject_services
-from app.utils.message_editor import update_message
-
-import tempfile
-import os
+from app.utils.message_editor import update_message, ProgressMessage
+from app.utils.export_cache import send_cached_export
+from app.database.versions import table_version
+from app.utils.telegram_files import downloaded_document, UploadTooLarge
 
 user_manage_router = Router()
 
@@ -33,21 +33,15 @@ async def export_users(callback: CallbackQuery, userservice: UserService):
     # Удаляем inline-кнопки у исходного сообщения
     await callback.message.edit_reply_markup(reply_markup=None)
 
-    # Генерируем Excel
-    excel_bytes = await userservice.export_users_to_excel()
-
-    with tempfile.NamedTemporaryFile(delete=False, suffix=".xlsx") as temp_file:
-        temp_file.write(excel_bytes)
-        temp_file_path = temp_file.name
-
-    # Отправляем Excel-файл
-    await callback.message.answer_document(
-        document=FSInputFile(temp_file_path, filename="employees.xlsx")
+    # Генерируем Excel (строки пишутся в файл потоково) или берём из кэша
+    await send_cached_export(
+        callback.message,
+        name="users",
+        version=table_version("users"),
+        build=userservice.export_users_to_excel,
+        filename="employees.xlsx"
     )
 
-    # Удаляем файл
-    os.remove(temp_file_path)
-
     # Возвращаем пользователю прежние кнопки (например, меню управления)
     await callback.message.answer(
         text="⬇️ Файл выгружен. Что дальше?",
@@ -55,6 +49,25 @@ async def export_users(callback: CallbackQuery, userservice: UserService):
     )
 
 
+@user_manage_router.callback_query(F.data == "export_tpoints")
+@inject_services(UserService)
+async def export_tpoints(callback: CallbackQuery, userservice: UserService):
+    await callback.message.edit_reply_markup(reply_markup=None)
+
+    await send_cached_export(
+        callback.message,
+        name="tpoints",
+        version=table_version("tpoints", "users", "products"),
+        build=userservice.export_tpoints_to_excel,
+        filename="tpoints.xlsx"
+    )
+
+    await callback.message.answer(
+        text="⬇️ Файл выгружен. Что дальше?",
+        reply_markup=hr_user_management_keyboard()
+    )
+
+
 @user_manage_router.callback_query(F.data == "import_users")
 @inject_services(UserService)
 async def request_excel_upload(callback: CallbackQuery, state: FSMContext, userservice: UserService):
@@ -88,33 +101,30 @@ async def handle_excel_upload(message: Message, userservice: UserService, state:
             await message.answer("Пожалуйста, отправьте файл в формате .xlsx")
             return
 
-        file_path = f"/tmp/{file.file_name}"
-        print(f"Сохраняем файл по пути: {file_path}")
+        # Получаем сессию базы данных из репозитория пользователей
+        db_session = userservice.user_repo.session
         
+        wait_message = await message.answer("⏳ Обрабатываю файл...")
+        progress = ProgressMessage(wait_message)
+
+        async def report_progress(rows_read: int):
+            await progress.update(f"⏳ Обрабатываю файл... Прочитано строк: {rows_read}")
+
         try:
-            await message.bot.download(file, destination=file_path)
-            print(f"Файл успешно сохранен по пути: {file_path}")
-            
-            # Check if file actually exists after download
-            if os.path.exists(file_path):
-                print(f"Подтверждено: файл существует на диске, размер: {os.path.getsize(file_path)} байт")
-            else:
-                print(f"ОШИБКА: Файл не найден на диске после скачивания!")
-                await message.answer("Ошибка: не удалось сохранить файл")
-                return
+            # Файл скачивается в память (крупный - во временный файл, который удаляется сразу после обработки)
+            async with downloaded_document(message.bot, file) as source:
+                result = await parse_excel_file(source, db_session, progress=report_progress)
+            print(f"Функция parse_excel_file завершена с результатом: {result}")
+        except UploadTooLarge as e:
+            result = {"success": False, "message": str(e)}
         except Exception as download_error:
             print(f"Ошибка при скачивании файла: {str(download_error)}")
-            await message.answer(f"Ошибка при загрузке файла: {str(download_error)}")
-            return
+            result = {"success": False, "message": f"Ошибка при загрузке файла: {str(download_error)}"}
 
-        # Получаем сессию базы данных из репозитория пользователей
-        db_session = userservice.user_repo.session
-        print(f"Получена сессия БД: {db_session}")
-        
-        print(f"Начинаем вызов parse_excel_file с путем: {file_path}")
-        # Call your function
-        result = await parse_excel_file(file_path, db_session)
-        print(f"Функция parse_excel_file завершена с результатом: {result}")
+        try:
+            await wait_message.delete()
+        except Exception:
+            pass
 
         if result.get("success", False):
             status_message = f"Сотрудники успешно загружены в базу. Обновлено: {result.get('updated', 0)} записей."
@@ -130,10 +140,6 @@ async def handle_excel_upload(message: Message, userservice: UserService, state:
         # Отправляем сообщение о результате
         await message.answer(status_message)
         
-        print(f"Удаляем временный файл")
-        os.remove(file_path)
-        print(f"Временный файл удален")
-        
         # Восстанавливаем меню в новом сообщении
         await message.answer("Панель управления пользователями:", reply_markup=hr_user_management_keyboard())
         
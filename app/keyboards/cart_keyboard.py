@@ -1,3 +1,4 @@
+import secrets
 from aiogram.types import InlineKeyboardMarkup, InlineKeyboardButton
 from app.database.models import Cart, CartItem
 
@@ -18,10 +19,10 @@ def get_cart_keyboard(cart: Cart) -> InlineKeyboardMarkup:
             )
         ])
 
-    # Кнопки действий
+    # Кнопки действий; токен оформления защищает от повторного заказа по той же кнопке
     buttons.append([
         InlineKeyboardButton(text="🔄 Очистить корзину", callback_data="clear_cart"),
-        InlineKeyboardButton(text="✅ Оформить заказ", callback_data="checkout_cart")
+        InlineKeyboardButton(text="✅ Оформить заказ", callback_data=f"checkout_cart:{secrets.token_hex(8)}")
     ])
 
     # Кнопка возврата
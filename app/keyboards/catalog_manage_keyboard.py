@@ -18,4 +18,22 @@ def catalog_manage(include_cancel: bool = False):
     if include_cancel:
         buttons.insert(1, [InlineKeyboardButton(text="❌ Отменить", callback_data="cancel_action")])
     
-    return InlineKeyboardMarkup(inline_keyboard=buttons)
\ No newline at end of file
+    return InlineKeyboardMarkup(inline_keyboard=buttons)
+
+def catalog_import_confirm(with_stock: bool = False):
+    """Keyboard for confirming catalog import after the diff preview
+
+    Args:
+        with_stock: Add a separate button that also applies stock values from the file
+    """
+    buttons = [
+        [
+            InlineKeyboardButton(text="✅ Применить изменения", callback_data="catalog_import_apply"),
+            InlineKeyboardButton(text="❌ Отменить", callback_data="cancel_action")
+        ]
+    ]
+    if with_stock:
+        buttons.insert(1, [
+            InlineKeyboardButton(text="📦 Применить с остатками", callback_data="catalog_import_apply:stock")
+        ])
+    return InlineKeyboardMarkup(inline_keyboard=buttons)
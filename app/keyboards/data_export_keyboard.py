@@ -0,0 +1,47 @@
+from aiogram.utils.keyboard import InlineKeyboardBuilder
+from aiogram.types import InlineKeyboardMarkup
+
+DATASET_TITLES = {
+    "users": "👥 Сотрудники",
+    "orders": "📋 Заказы",
+    "order_items": "📦 Позиции заказов",
+    "tpoints": "💰 Операции T-points",
+    "questions": "❓ Анонимные вопросы",
+}
+
+
+def data_export_datasets() -> InlineKeyboardMarkup:
+    builder = InlineKeyboardBuilder()
+    for dataset, title in DATASET_TITLES.items():
+        builder.button(text=title, callback_data=f"data_export:ds:{dataset}")
+    builder.button(text="Назад", callback_data="user_management")
+    builder.adjust(1)
+    return builder.as_markup()
+
+
+def data_export_formats() -> InlineKeyboardMarkup:
+    builder = InlineKeyboardBuilder()
+    builder.button(text="CSV (.csv.gz)", callback_data="data_export:fmt:csv")
+    builder.button(text="JSONL (.jsonl.gz)", callback_data="data_export:fmt:jsonl")
+    builder.button(text="Отмена", callback_data="data_export:cancel")
+    builder.adjust(2, 1)
+    return builder.as_markup()
+
+
+def data_export_period() -> InlineKeyboardMarkup:
+    builder = InlineKeyboardBuilder()
+    builder.button(text="За всё время", callback_data="data_export:period:all")
+    builder.button(text="Отмена", callback_data="data_export:cancel")
+    builder.adjust(1)
+    return builder.as_markup()
+
+
+def data_export_departments(departments: list[str]) -> InlineKeyboardMarkup:
+    # В callback_data передается номер отдела: название может не поместиться в 64 байта
+    builder = InlineKeyboardBuilder()
+    builder.button(text="Все отделы", callback_data="data_export:dep:all")
+    for index, department in enumerate(departments):
+        builder.button(text=department, callback_data=f"data_export:dep:{index}")
+    builder.button(text="Отмена", callback_data="data_export:cancel")
+    builder.adjust(1)
+    return builder.as_markup()
@@ -7,6 +7,7 @@ def order_management_keyboard(pending_count: int) -> InlineKeyboardMarkup:
         [InlineKeyboardButton(text=f"📋 Посмотреть новые заказы ({pending_count})", callback_data="view_pending_orders")],
         [InlineKeyboardButton(text="✅ История выполненных", callback_data="view_completed_orders")],
         [InlineKeyboardButton(text="📊 Подробная статистика", callback_data="detailed_order_stats")],
+        [InlineKeyboardButton(text="📤 Выгрузить заказы", callback_data="export_orders")],
         [InlineKeyboardButton(text="⬅️ Назад", callback_data="menu:main")]
     ])
 
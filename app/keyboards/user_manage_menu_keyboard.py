@@ -6,6 +6,8 @@ def hr_user_management_keyboard() -> InlineKeyboardMarkup:
     builder = InlineKeyboardBuilder()
     builder.button(text="📤 Выгрузить список", callback_data="export_users")
     builder.button(text="📥 Загрузить список", callback_data="import_users")
+    builder.button(text="📤 Выгрузить историю T-points", callback_data="export_tpoints")
+    builder.button(text="🗜 Выгрузка CSV/JSONL", callback_data="data_export")
     builder.button(text="Назад в меню", callback_data="menu:main")
     builder.adjust(1)
     return builder.as_markup()
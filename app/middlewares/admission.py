@@ -0,0 +1,86 @@
+import os
+from typing import Any, Awaitable, Callable, Dict, Optional
+from aiogram import BaseMiddleware
+from aiogram.types import TelegramObject, Update
+
+from app.middlewares.dispatch import OrderedDispatchMiddleware, DEFAULT_LANE, queue_depth
+from app.utils.metrics import metrics
+
+# Пороги перегрузки: обновлений в работе и в очереди, среднее ожидание в очереди (сек.)
+ADMISSION_MAX_IN_FLIGHT = int(os.getenv("ADMISSION_MAX_IN_FLIGHT", "200"))
+ADMISSION_MAX_WAIT = float(os.getenv("ADMISSION_MAX_WAIT", "2.0"))
+
+# Колбэки, которые при перегрузке можно отклонить: просмотр каталога, корзины и меню.
+# Оформление заказа, добавление в корзину, сообщения и действия HR не отклоняются.
+SHEDDABLE_CALLBACK_PREFIXES = (
+    "open_catalog", "show_catalog", "back_to_catalog", "product_", "back_to_product_",
+    "show_sizes_", "show_colors_", "show_quantity_", "show_cart", "cart_item_", "menu:main",
+)
+
+BUSY_TEXT = "⏳ Бот сейчас перегружен, попробуйте через несколько секунд"
+
+admitted_total = metrics.counter("admission_admitted_total", "Принятые обновления")
+shed_total = metrics.counter("admission_shed_total", "Отклоненные при перегрузке обновления")
+admission_in_flight = metrics.gauge("admission_in_flight", "Принятые обновления в работе и в очереди")
+
+
+def is_sheddable(update: Update) -> bool:
+    return bool(
+        update.callback_query
+        and update.callback_query.data
+        and update.callback_query.data.startswith(SHEDDABLE_CALLBACK_PREFIXES)
+    )
+
+
+class AdmissionControlMiddleware(BaseMiddleware):
+    """Отклоняет второстепенные колбэки при перегрузке
+
+    Считает принятые обновления, которые еще не обработаны, и смотрит на среднее
+    ожидание в очереди планировщика. Если порог превышен, просмотр каталога и
+    корзины сразу получает ответ "попробуйте позже" без обращения к БД, так что
+    оформление заказов и задачи HR сохраняют свою пропускную способность.
+    Регистрируется до OrderedDispatchMiddleware.
+    """
+
+    def __init__(self, dispatcher: Optional[OrderedDispatchMiddleware] = None,
+                 max_in_flight: int = ADMISSION_MAX_IN_FLIGHT, max_wait: float = ADMISSION_MAX_WAIT):
+        super().__init__()
+        self.dispatcher = dispatcher
+        self.max_in_flight = max_in_flight
+        self.max_wait = max_wait
+        self.in_flight = 0
+
+    def overload_reason(self) -> Optional[str]:
+        if self.in_flight >= self.max_in_flight:
+            return "in_flight"
+        # Ожидание учитывается, только пока в очереди кто-то есть: иначе среднее устарело
+        if (self.dispatcher is not None and self.dispatcher.recent_wait >= self.max_wait
+                and queue_depth.get(lane=DEFAULT_LANE) > 0):
+            return "wait"
+        return None
+
+    async def __call__(
+        self,
+        handler: Callable[[TelegramObject, Dict[str, Any]], Awaitable[Any]],
+        event: TelegramObject,
+        data: Dict[str, Any]
+    ) -> Any:
+        sheddable = isinstance(event, Update) and is_sheddable(event)
+        if sheddable:
+            reason = self.overload_reason()
+            if reason:
+                shed_total.inc(reason=reason)
+                try:
+                    await event.callback_query.answer(BUSY_TEXT)
+                except Exception as e:
+                    print(f"Failed to answer shed callback: {e}")
+                return None
+
+        admitted_total.inc(kind="sheddable" if sheddable else "critical")
+        self.in_flight += 1
+        admission_in_flight.inc()
+        try:
+            return await handler(event, data)
+        finally:
+            self.in_flight -= 1
+            admission_in_flight.dec()
@@ -0,0 +1,29 @@
+from typing import Any, Awaitable, Callable, Dict
+from aiogram import BaseMiddleware
+from aiogram.types import TelegramObject, Update
+
+from app.utils.cache import LRUCache
+
+
+class UpdateDeduplicationMiddleware(BaseMiddleware):
+    """Пропускает повторно доставленные обновления (тот же update_id)
+
+    Помнит последние maxsize идентификаторов; повторное обновление не доходит до обработчиков.
+    """
+
+    def __init__(self, maxsize: int = 10000):
+        super().__init__()
+        self.seen = LRUCache(maxsize)
+
+    async def __call__(
+        self,
+        handler: Callable[[TelegramObject, Dict[str, Any]], Awaitable[Any]],
+        event: TelegramObject,
+        data: Dict[str, Any]
+    ) -> Any:
+        if isinstance(event, Update):
+            if self.seen.get(event.update_id) is not None:
+                print(f"Skipped duplicate update {event.update_id}")
+                return None
+            self.seen.put(event.update_id, True)
+        return await handler(event, data)
@@ -0,0 +1,108 @@
+import asyncio
+import os
+import time
+from contextlib import nullcontext
+from typing import Any, Awaitable, Callable, Dict, Optional
+from aiogram import BaseMiddleware
+from aiogram.types import TelegramObject, Update
+
+from app.utils.metrics import metrics
+
+# Сколько обновлений разных пользователей обрабатывается одновременно
+DISPATCH_CONCURRENCY = int(os.getenv("DISPATCH_CONCURRENCY", "32"))
+# Отдельная полоса для тяжелых задач HR (выгрузки и загрузки Excel)
+DISPATCH_HEAVY_CONCURRENCY = int(os.getenv("DISPATCH_HEAVY_CONCURRENCY", "2"))
+
+# Колбэки, запускающие выгрузки
+HEAVY_CALLBACKS = {"export_users", "export_tpoints", "export_orders", "download_catalog", "data_export:period:all"}
+HEAVY_CALLBACK_PREFIXES = ("data_export:dep:",)
+
+DEFAULT_LANE, HEAVY_LANE = "default", "heavy"
+
+# Вес последнего замера в скользящем среднем времени ожидания
+WAIT_SMOOTHING = 0.2
+
+queue_depth = metrics.gauge("dispatch_queue_depth", "Обновления, ожидающие обработки")
+in_flight = metrics.gauge("dispatch_in_flight", "Обновления в обработке")
+wait_seconds = metrics.histogram("dispatch_wait_seconds", "Время ожидания обработки обновления")
+handle_seconds = metrics.histogram("dispatch_handle_seconds", "Время обработки обновления")
+
+
+def update_lane(update: Update) -> str:
+    """Полоса обработки: тяжелые задачи не занимают места обычных обновлений"""
+    if update.callback_query and update.callback_query.data:
+        data = update.callback_query.data
+        if data in HEAVY_CALLBACKS or data.startswith(HEAVY_CALLBACK_PREFIXES):
+            return HEAVY_LANE
+    if update.message and update.message.document:
+        return HEAVY_LANE
+    return DEFAULT_LANE
+
+
+class OrderedDispatchMiddleware(BaseMiddleware):
+    """Планировщик обработки обновлений
+
+    Обновления одного пользователя обрабатываются строго по очереди (asyncio.Lock
+    отдает блокировку в порядке ожидания), обновления разных пользователей - параллельно,
+    но не больше concurrency одновременно. Тяжелые задачи HR идут в своей полосе с
+    отдельным лимитом. Глубина очереди и время ожидания экспортируются в метрики.
+    """
+
+    def __init__(self, concurrency: int = DISPATCH_CONCURRENCY, heavy_concurrency: int = DISPATCH_HEAVY_CONCURRENCY):
+        super().__init__()
+        self.lanes = {
+            DEFAULT_LANE: asyncio.Semaphore(concurrency),
+            HEAVY_LANE: asyncio.Semaphore(heavy_concurrency),
+        }
+        # user_id -> [блокировка, число обновлений пользователя в работе и в ожидании]
+        self.user_locks: Dict[int, list] = {}
+        # Скользящее среднее времени ожидания обычных обновлений (сек.)
+        self.recent_wait = 0.0
+
+    def _acquire_user(self, user_id: int) -> asyncio.Lock:
+        entry = self.user_locks.get(user_id)
+        if entry is None:
+            entry = self.user_locks[user_id] = [asyncio.Lock(), 0]
+        entry[1] += 1
+        return entry[0]
+
+    def _release_user(self, user_id: int):
+        entry = self.user_locks[user_id]
+        entry[1] -= 1
+        if entry[1] == 0:
+            del self.user_locks[user_id]
+
+    async def __call__(
+        self,
+        handler: Callable[[TelegramObject, Dict[str, Any]], Awaitable[Any]],
+        event: TelegramObject,
+        data: Dict[str, Any]
+    ) -> Any:
+        lane = update_lane(event) if isinstance(event, Update) else DEFAULT_LANE
+        user = data.get("event_from_user")
+        user_id: Optional[int] = user.id if user else None
+
+        queued_at = time.monotonic()
+        queue_depth.inc(lane=lane)
+        waiting = True
+        user_lock = self._acquire_user(user_id) if user_id is not None else nullcontext()
+        try:
+            async with user_lock:
+                async with self.lanes[lane]:
+                    queue_depth.dec(lane=lane)
+                    waiting = False
+                    started_at = time.monotonic()
+                    wait_seconds.observe(started_at - queued_at, lane=lane)
+                    if lane == DEFAULT_LANE:
+                        self.recent_wait += (started_at - queued_at - self.recent_wait) * WAIT_SMOOTHING
+                    in_flight.inc(lane=lane)
+                    try:
+                        return await handler(event, data)
+                    finally:
+                        in_flight.dec(lane=lane)
+                        handle_seconds.observe(time.monotonic() - started_at, lane=lane)
+        finally:
+            if waiting:
+                queue_depth.dec(lane=lane)
+            if user_id is not None:
+                self._release_user(user_id)
@@ -0,0 +1,63 @@
+from typing import Any, Awaitable, Callable, Dict
+from aiogram import BaseMiddleware
+from aiogram.types import CallbackQuery, Message, TelegramObject
+
+from app.states.states import AnonymousQuestionStates, CatalogStates, DataExportStates
+
+# Колбэки, которые продолжают сценарий с состоянием, и группа состояний этого сценария.
+# Выбор размера/цвета/количества сюда не входит: он хранит только данные, а кнопки
+# несут товар, количество и выбранные размер и цвет в callback_data.
+STATEFUL_CALLBACKS = (
+    ("edit_question", AnonymousQuestionStates),
+    ("cancel_question", AnonymousQuestionStates),
+    ("submit_question", AnonymousQuestionStates),
+    ("data_export:period:", DataExportStates),
+    ("data_export:dep:", DataExportStates),
+    ("catalog_import_apply", CatalogStates),
+)
+
+SESSION_EXPIRED_TEXT = "⌛ Сессия истекла, начните заново"
+
+
+def continues_flow(callback_data: str, expired_state: str) -> bool:
+    """Продолжает ли колбэк сценарий, состояние которого истекло"""
+    if not callback_data or not expired_state:
+        return False
+    return any(
+        callback_data.startswith(prefix) and expired_state in group
+        for prefix, group in STATEFUL_CALLBACKS
+    )
+
+
+class SessionExpiredMiddleware(BaseMiddleware):
+    """Сообщает пользователю, что его незавершенный сценарий истек
+
+    Хранилище FSM помечает ключи, состояние которых удалено по сроку или
+    вытеснено при переполнении. Первое обновление пользователя после этого
+    снимает пометку; если это продолжение именно истекшего сценария (колбэк из
+    STATEFUL_CALLBACKS той же группы состояний или сообщение, которое ждал шаг
+    сценария), оно не доходит до обработчика, а пользователь получает просьбу
+    начать заново. Остальные обновления и команды проходят как обычно.
+    Регистрируется как outer-middleware на message и callback_query.
+    """
+
+    async def __call__(
+        self,
+        handler: Callable[[TelegramObject, Dict[str, Any]], Awaitable[Any]],
+        event: TelegramObject,
+        data: Dict[str, Any]
+    ) -> Any:
+        state = data.get("state")
+        pop_expired = getattr(state.storage, "pop_expired", None) if state is not None else None
+        expired_state = pop_expired(state.key) if pop_expired is not None else None
+        if expired_state is None:
+            return await handler(event, data)
+
+        if isinstance(event, CallbackQuery) and continues_flow(event.data, expired_state):
+            await event.answer(SESSION_EXPIRED_TEXT, show_alert=True)
+            return None
+        # Сообщение ждал только шаг сценария с состоянием (текст вопроса, период, файл)
+        if isinstance(event, Message) and expired_state and not (event.text or "").startswith("/"):
+            await event.answer(f"{SESSION_EXPIRED_TEXT}: /start")
+            return None
+        return await handler(event, data)
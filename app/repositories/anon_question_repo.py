@@ -35,4 +35,8 @@ class AnonymousQuestionRepo:
     async def get_all_questions(self) -> list[AnonymousQuestion]:
         stmt = select(AnonymousQuestion).order_by(AnonymousQuestion.submitted_at.desc())
         result = await self.session.execute(stmt)
-        return result.scalars().all()    
\ No newline at end of file
+        return result.scalars().all()
+
+    async def count_questions(self) -> int:
+        result = await self.session.execute(select(func.count(AnonymousQuestion.id)))
+        return result.scalar_one()
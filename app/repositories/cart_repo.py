@@ -1,8 +1,11 @@
 from sqlalchemy.ext.asyncio import AsyncSession
-from sqlalchemy import select, update, delete
+from sqlalchemy import select, update, delete, func
 from sqlalchemy.orm import joinedload
+from datetime import datetime
+from typing import Optional
 
-from app.database.models import Cart, CartItem, Product
+from app.database.models import Cart, CartItem, Product, CART_ITEM_LINE_KEY
+from app.database.dialect import upsert_insert, dialect_name
 
 
 
@@ -27,37 +30,54 @@ class CartRepository:
         
         return cart
     
-    async def add_item(self, cart_id: int, product_id: int, quantity: int = 1, size: str = None, color: str = None):
-        """Добавление товара в корзину"""
-        # Проверяем, есть ли уже такой товар в корзине с такими же параметрами
+    async def get_cart_id(self, user_id: int) -> int:
+        """Id активной корзины пользователя (создается при необходимости) без загрузки товаров"""
+        cart_id = await self.session.scalar(
+            select(Cart.id).where(Cart.user_id == user_id, Cart.is_active == True).limit(1)
+        )
+        if cart_id is None:
+            cart = Cart(user_id=user_id)
+            self.session.add(cart)
+            await self.session.flush()
+            cart_id = cart.id
+        return cart_id
+
+    async def get_cart_lines(self, user_id: int):
+        """Строки активной корзины пользователя с названием и ценой товара одним запросом"""
         result = await self.session.execute(
-            select(CartItem)
-            .where(
-                CartItem.cart_id == cart_id,
-                CartItem.product_id == product_id,
-                CartItem.size == size,
-                CartItem.color == color
-            )
+            select(CartItem.id, CartItem.cart_id, CartItem.product_id, CartItem.quantity, CartItem.size,
+                   CartItem.color, Product.name, Product.price)
+            .join(Cart, Cart.id == CartItem.cart_id)
+            .join(Product, Product.id == CartItem.product_id)
+            .where(Cart.user_id == user_id, Cart.is_active == True)
+            .order_by(CartItem.id)
         )
-        cart_item = result.scalars().first()
-        
-        if cart_item:
-            # Увеличиваем количество
-            cart_item.quantity += quantity
-            self.session.add(cart_item)
-        else:
-            # Создаем новый элемент корзины
-            cart_item = CartItem(
-                cart_id=cart_id,
-                product_id=product_id,
-                quantity=quantity,
-                size=size,
-                color=color
-            )
-            self.session.add(cart_item)
-        
-        await self.session.flush()
-        return cart_item
+        return result.all()
+
+    async def add_item(self, cart_id: int, product_id: int, quantity: int = 1, size: str = None, color: str = None):
+        """Добавление товара в корзину
+
+        Одним запросом INSERT ... ON CONFLICT: если строка с тем же товаром, размером и
+        цветом уже есть, её количество увеличивается. Параллельные нажатия не создают
+        дубликатов благодаря уникальному индексу uq_cart_items_line.
+
+        Returns:
+            Строка с полями id и quantity
+        """
+        stmt = upsert_insert(self.session, CartItem).values(
+            cart_id=cart_id,
+            product_id=product_id,
+            quantity=quantity,
+            size=size,
+            color=color,
+            added_at=datetime.now()
+        )
+        stmt = stmt.on_conflict_do_update(
+            index_elements=list(CART_ITEM_LINE_KEY),
+            set_={"quantity": CartItem.quantity + stmt.excluded.quantity}
+        ).returning(CartItem.id, CartItem.quantity)
+        result = await self.session.execute(stmt)
+        return result.one()
     
     async def remove_item(self, cart_item_id: int):
         """Удаление товара из корзины"""
@@ -66,18 +86,53 @@ class CartRepository:
         )
         await self.session.flush()
     
-    async def update_quantity(self, cart_item_id: int, quantity: int):
-        """Обновление количества товара в корзине"""
-        if quantity <= 0:
-            await self.remove_item(cart_item_id)
-            return
-        
-        await self.session.execute(
+    async def change_quantity(self, cart_item_id: int, delta: int, user_id: int = None) -> Optional[int]:
+        """Меняет количество товара в корзине на delta без предварительного чтения строки
+
+        Строка, количество в которой становится нулевым или отрицательным, удаляется.
+        В PostgreSQL изменение и удаление выполняются одним запросом (CTE), в остальных
+        БД удаление выполняется только если условное обновление не затронуло строку.
+
+        Args:
+            user_id: Если указан, меняется только строка из корзины этого пользователя
+
+        Returns:
+            Новое количество, 0 если строка удалена, None если строки нет
+        """
+        conditions = [CartItem.id == cart_item_id]
+        if user_id is not None:
+            conditions.append(CartItem.cart_id.in_(select(Cart.id).where(Cart.user_id == user_id)))
+
+        increment = (
             update(CartItem)
-            .where(CartItem.id == cart_item_id)
-            .values(quantity=quantity)
+            .where(*conditions, CartItem.quantity + delta > 0)
+            .values(quantity=CartItem.quantity + delta)
+            .returning(CartItem.quantity)
+            .execution_options(synchronize_session=False)
         )
-        await self.session.flush()
+        remove = (
+            delete(CartItem)
+            .where(*conditions, CartItem.quantity + delta <= 0)
+            .returning(CartItem.id)
+            .execution_options(synchronize_session=False)
+        )
+
+        if dialect_name(self.session) == "postgresql":
+            updated, deleted = increment.cte("updated"), remove.cte("deleted")
+            result = await self.session.execute(
+                select(
+                    select(updated.c.quantity).scalar_subquery(),
+                    select(func.count()).select_from(deleted).scalar_subquery()
+                )
+            )
+            quantity, removed = result.one()
+            return quantity if quantity is not None else (0 if removed else None)
+
+        quantity = (await self.session.execute(increment)).scalar_one_or_none()
+        if quantity is not None:
+            return quantity
+        removed = (await self.session.execute(remove)).scalar_one_or_none()
+        return 0 if removed is not None else None
     
     async def clear_cart(self, cart_id: int):
         """Очистка корзины"""
@@ -86,16 +141,55 @@ class CartRepository:
         )
         await self.session.flush()
     
-    async def get_cart_total(self, cart_id: int):
-        """Получение общей стоимости корзины"""
+    async def delete_idle_carts(self, idle_since: datetime, batch_size: int) -> dict:
+        """Удаляет до batch_size корзин без активности с idle_since вместе с их строками
+
+        Активность корзины - время последнего добавления товара, для пустой корзины -
+        время ее создания.
+
+        Returns:
+            Словарь с ключами 'carts', 'items' (удалено строк) и 'user_ids'
+        """
+        last_activity = func.coalesce(func.max(CartItem.added_at), Cart.created_at)
         result = await self.session.execute(
-            select(CartItem, Product)
-            .join(Product, CartItem.product_id == Product.id)
-            .where(CartItem.cart_id == cart_id)
+            select(Cart.id, Cart.user_id)
+            .outerjoin(CartItem, CartItem.cart_id == Cart.id)
+            .group_by(Cart.id, Cart.user_id, Cart.created_at)
+            .having(last_activity < idle_since)
+            .limit(batch_size)
         )
-        
-        total = 0
-        for cart_item, product in result:
-            total += product.price * cart_item.quantity
-        
-        return total
\ No newline at end of file
+        rows = result.all()
+        if not rows:
+            return {"carts": 0, "items": 0, "user_ids": []}
+
+        cart_ids = [row.id for row in rows]
+        items = await self.session.execute(
+            delete(CartItem).where(CartItem.cart_id.in_(cart_ids)).execution_options(synchronize_session=False)
+        )
+        carts = await self.session.execute(
+            delete(Cart).where(Cart.id.in_(cart_ids)).execution_options(synchronize_session=False)
+        )
+        return {"carts": carts.rowcount, "items": items.rowcount, "user_ids": [row.user_id for row in rows]}
+
+    async def delete_unavailable_items(self, batch_size: int) -> dict:
+        """Удаляет до batch_size строк корзин с недоступными или удаленными товарами
+
+        Returns:
+            Словарь с ключами 'items' (удалено строк) и 'user_ids'
+        """
+        result = await self.session.execute(
+            select(CartItem.id, Cart.user_id)
+            .join(Cart, Cart.id == CartItem.cart_id)
+            .outerjoin(Product, Product.id == CartItem.product_id)
+            .where((Product.id.is_(None)) | (Product.is_available == False))
+            .limit(batch_size)
+        )
+        rows = result.all()
+        if not rows:
+            return {"items": 0, "user_ids": []}
+
+        items = await self.session.execute(
+            delete(CartItem).where(CartItem.id.in_([row.id for row in rows]))
+            .execution_options(synchronize_session=False)
+        )
+        return {"items": items.rowcount, "user_ids": list({row.user_id for row in rows})}
@@ -1,8 +1,21 @@
-from sqlalchemy import select, update, insert
+from sqlalchemy import select, update, insert, case, or_
 from sqlalchemy.ext.asyncio import AsyncSession
 from app.database.models import Product, CommonImage
+from app.database.dialect import upsert_insert, chunked
+from app.database.versions import STOCK_VERSION
 from typing import List, Dict, Any, Optional
 
+# Редактируемые через Excel колонки товара (кроме id)
+PRODUCT_COLUMNS = ('name', 'description', 'price', 'image_url', 'is_available', 'stock', 'sizes', 'colors')
+
+# Колонки, которые импорт перезаписывает у существующих товаров. Остаток уменьшается
+# заказами, поэтому старая выгрузка вернула бы проданные единицы: он меняется только
+# отдельным подтверждением (set_stock)
+CONTENT_COLUMNS = tuple(column for column in PRODUCT_COLUMNS if column != 'stock')
+
+# Количество строк в одном INSERT ... ON CONFLICT
+BULK_CHUNK_SIZE = 500
+
 class CatalogRepo:
     def __init__(self, session: AsyncSession):
         self.session = session
@@ -31,47 +44,88 @@ class CatalogRepo:
         result = await self.session.execute(query)
         return result.scalar_one_or_none()
     
-    async def create_or_update_products(self, products_data: List[Dict[str, Any]]) -> int:
-        """Create or update products from list of dictionaries
-        
+    async def write_products(self, rows: List[Dict[str, Any]], chunk_size: int = BULK_CHUNK_SIZE) -> None:
+        """Write product rows without comparing them to the stored ones
+
+        Rows with 'id' are upserted with INSERT ... ON CONFLICT DO UPDATE,
+        rows without it are inserted. Every chunk is a single statement.
+        Stock is written only for new products (see CONTENT_COLUMNS and set_stock).
+        The caller is responsible for committing.
+        """
+        keyed_rows = [{'id': row['id'], **{c: row.get(c) for c in PRODUCT_COLUMNS}} for row in rows if row.get('id')]
+        new_rows = [{c: row.get(c) for c in PRODUCT_COLUMNS} for row in rows if not row.get('id')]
+
+        for chunk in chunked(keyed_rows, chunk_size):
+            stmt = upsert_insert(self.session, Product).values(chunk)
+            stmt = stmt.on_conflict_do_update(
+                index_elements=[Product.id],
+                set_={column: stmt.excluded[column] for column in CONTENT_COLUMNS}
+            )
+            await self.session.execute(stmt)
+
+        for chunk in chunked(new_rows, chunk_size):
+            await self.session.execute(insert(Product).values(chunk))
+
+    async def set_stock(self, stock: Dict[int, Optional[int]]) -> None:
+        """Set absolute stock values confirmed by HR with one UPDATE
+
         Args:
-            products_data: List of product dictionaries
-            
+            stock: {product_id: new stock}; None means unlimited
+        """
+        if not stock:
+            return
+        await self.session.execute(
+            update(Product)
+            .where(Product.id.in_(list(stock)))
+            .values(stock=case(stock, value=Product.id))
+            .execution_options(synchronize_session=False, version=STOCK_VERSION)
+        )
+
+    async def reserve_stock(self, quantities: Dict[int, int]) -> List[int]:
+        """Atomically reserve stock for several products with one conditional UPDATE
+
+        Each product is decremented only if stock >= requested quantity; products with
+        NULL stock are unlimited. The caller must roll back the transaction if any
+        product was not reserved.
+
+        Args:
+            quantities: {product_id: quantity}
+
         Returns:
-            Number of products created/updated
+            IDs of products that could NOT be reserved
+        """
+        if not quantities:
+            return []
+        requested = case(quantities, value=Product.id)
+        result = await self.session.execute(
+            update(Product)
+            .where(Product.id.in_(list(quantities)), or_(Product.stock.is_(None), Product.stock >= requested))
+            .values(stock=Product.stock - requested)
+            .returning(Product.id)
+            .execution_options(synchronize_session=False, version=STOCK_VERSION)
+        )
+        reserved = set(result.scalars())
+        return [product_id for product_id in quantities if product_id not in reserved]
+
+    async def release_stock(self, quantities: Dict[int, int]) -> None:
+        """Return reserved stock (e.g. on order cancellation) with one UPDATE"""
+        if not quantities:
+            return
+        await self.session.execute(
+            update(Product)
+            .where(Product.id.in_(list(quantities)))
+            .values(stock=Product.stock + case(quantities, value=Product.id))
+            .execution_options(synchronize_session=False, version=STOCK_VERSION)
+        )
+
+    async def get_product_rows(self, product_ids: Optional[List[int]] = None) -> Dict[int, Dict[str, Any]]:
+        """Load editable columns of products as plain dictionaries keyed by ID
+
+        Args:
+            product_ids: IDs to load; the whole catalog is loaded in one query when omitted
         """
-        updated_count = 0
-        
-        for product_data in products_data:
-            product_id = product_data.get('id')
-            
-            if product_id:
-                # Update existing product
-                product = await self.get_product_by_id(product_id)
-                if product:
-                    # Remove id from data to be updated
-                    update_data = {k: v for k, v in product_data.items() if k != 'id'}
-                    
-                    # Update product
-                    stmt = (
-                        update(Product)
-                        .where(Product.id == product_id)
-                        .values(**update_data)
-                    )
-                    await self.session.execute(stmt)
-                    updated_count += 1
-                else:
-                    # Create new product with specified ID
-                    new_product = Product(**product_data)
-                    self.session.add(new_product)
-                    updated_count += 1
-            else:
-                # Create new product without ID
-                new_product_data = {k: v for k, v in product_data.items() if k != 'id'}
-                new_product = Product(**new_product_data)
-                self.session.add(new_product)
-                updated_count += 1
-        
-        # Commit all changes
-        await self.session.commit()
-        return updated_count
\ No newline at end of file
+        query = select(Product.id, *(getattr(Product, column) for column in PRODUCT_COLUMNS))
+        if product_ids is not None:
+            query = query.where(Product.id.in_(product_ids))
+        result = await self.session.execute(query)
+        return {row.id: dict(row._mapping) for row in result}
@@ -0,0 +1,102 @@
+from datetime import date, datetime, time, timedelta
+from typing import AsyncIterator, List, Optional
+from sqlalchemy import select, DateTime
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from app.database.models import User, Order, OrderItem, Product, TPointsTransaction, AnonymousQuestion
+
+
+def _users_query():
+    stmt = select(
+        User.telegram_id, User.fullname, User.username, User.department, User.post, User.role,
+        User.tpoints, User.birth_date, User.hire_date, User.is_active
+    ).order_by(User.telegram_id)
+    return stmt, User.hire_date, User.department
+
+
+def _orders_query():
+    stmt = (
+        select(Order.id, Order.created_at, Order.updated_at, Order.user_id, User.fullname,
+               User.department, Order.total_cost, Order.status)
+        .outerjoin(User, User.telegram_id == Order.user_id)
+        .order_by(Order.id)
+    )
+    return stmt, Order.created_at, User.department
+
+
+def _order_items_query():
+    stmt = (
+        select(OrderItem.id, OrderItem.order_id, Order.created_at, Order.status, Order.user_id,
+               User.department, OrderItem.product_id, Product.name.label("product_name"),
+               OrderItem.quantity, OrderItem.price, OrderItem.size, OrderItem.color)
+        .join(Order, Order.id == OrderItem.order_id)
+        .outerjoin(User, User.telegram_id == Order.user_id)
+        .outerjoin(Product, Product.id == OrderItem.product_id)
+        .order_by(OrderItem.id)
+    )
+    return stmt, Order.created_at, User.department
+
+
+def _tpoints_query():
+    stmt = (
+        select(TPointsTransaction.id, TPointsTransaction.transaction_date, TPointsTransaction.user_id,
+               User.fullname, User.department, TPointsTransaction.amount, TPointsTransaction.order_id,
+               TPointsTransaction.product_id, TPointsTransaction.comment)
+        .outerjoin(User, User.telegram_id == TPointsTransaction.user_id)
+        .order_by(TPointsTransaction.id)
+    )
+    return stmt, TPointsTransaction.transaction_date, User.department
+
+
+def _questions_query():
+    stmt = select(
+        AnonymousQuestion.id, AnonymousQuestion.submitted_at, AnonymousQuestion.question_status,
+        AnonymousQuestion.question_text
+    ).order_by(AnonymousQuestion.id)
+    # Вопросы анонимные, фильтр по отделу к ним не применяется
+    return stmt, AnonymousQuestion.submitted_at, None
+
+
+# Наборы данных для выгрузки: имя -> (запрос, колонка даты для фильтра, колонка отдела)
+EXPORT_DATASETS = {
+    "users": _users_query,
+    "orders": _orders_query,
+    "order_items": _order_items_query,
+    "tpoints": _tpoints_query,
+    "questions": _questions_query,
+}
+
+
+class ExportRepo:
+    def __init__(self, session: AsyncSession):
+        self.session = session
+
+    @staticmethod
+    def build_query(dataset: str, date_from: Optional[date] = None, date_to: Optional[date] = None,
+                    department: Optional[str] = None):
+        """Запрос выгрузки набора данных с фильтрами по периоду (включительно) и отделу"""
+        stmt, date_column, department_column = EXPORT_DATASETS[dataset]()
+
+        is_datetime = isinstance(date_column.type, DateTime)
+        if date_from:
+            stmt = stmt.where(date_column >= (datetime.combine(date_from, time()) if is_datetime else date_from))
+        if date_to:
+            # Конец периода включительно: всё, что раньше следующего дня
+            next_day = date_to + timedelta(days=1)
+            stmt = stmt.where(date_column < (datetime.combine(next_day, time()) if is_datetime else next_day))
+        if department and department_column is not None:
+            stmt = stmt.where(department_column == department)
+        return stmt
+
+    async def iter_rows(self, stmt, batch_size: int) -> AsyncIterator[List[tuple]]:
+        """Потоково отдает строки запроса пачками по batch_size"""
+        result = await self.session.stream(stmt.execution_options(yield_per=batch_size))
+        async for partition in result.partitions():
+            yield [tuple(row) for row in partition]
+
+    async def get_departments(self) -> List[str]:
+        """Список отделов сотрудников"""
+        result = await self.session.scalars(
+            select(User.department).where(User.department.is_not(None)).distinct().order_by(User.department)
+        )
+        return result.all()
@@ -2,9 +2,12 @@ from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy import select, update, func, insert
 from sqlalchemy.orm import joinedload
 from datetime import datetime
-from typing import List, Optional, Dict
+from typing import List, Optional, Dict, AsyncIterator
 
-from app.database.models import Order, OrderItem, Product, User, TPointsTransaction
+from app.database.models import Order, OrderItem, Product, User, TPointsTransaction, CheckoutRequest
+from app.repositories.user_repo import UserRepo
+from app.database.dialect import upsert_insert
+from app.repositories.catalog_repo import CatalogRepo
 
 
 class OrderRepo:
@@ -12,35 +15,80 @@ class OrderRepo:
         self.session = session
     
     # Основные методы работы с заказами
-    async def create_order(self, user_id: int, total_cost: float, status: str = "pending") -> Order:
-        """Создает новый заказ"""
-        order = Order(
-            user_id=user_id,
-            total_cost=total_cost,
-            status=status,
-            created_at=datetime.now()
+    async def create_order_with_items(self, user_id: int, total_cost: float, items: List[Dict],
+                                      status: str = "pending") -> int:
+        """Создает заказ и все его позиции двумя запросами
+
+        Заказ вставляется с RETURNING id, позиции - одним пакетным INSERT, без flush
+        и refresh на каждую строку.
+
+        Args:
+            items: Позиции заказа: словари с ключами product_id, quantity, price, size, color
+
+        Returns:
+            ID созданного заказа
+        """
+        order_id = await self.session.scalar(
+            insert(Order)
+            .values(user_id=user_id, total_cost=total_cost, status=status, created_at=datetime.now())
+            .returning(Order.id)
         )
-        self.session.add(order)
-        await self.session.flush()
-        await self.session.refresh(order)
-        return order
+        await self.session.execute(insert(OrderItem), [dict(item, order_id=order_id) for item in items])
+        return order_id
     
-    async def add_order_item(self, order_id: int, product_id: int, quantity: int, 
-                            price: float, size: str = None, color: str = None) -> OrderItem:
-        """Добавляет товар в заказ"""
-        order_item = OrderItem(
-            order_id=order_id,
-            product_id=product_id,
-            quantity=quantity,
-            price=price,
-            size=size,
-            color=color
+    async def claim_checkout(self, user_id: int, token: str) -> bool:
+        """Регистрирует оформление по токену
+
+        INSERT ... ON CONFLICT DO NOTHING: если параллельная транзакция уже вставила
+        этот токен, запрос дожидается ее завершения и ничего не вставляет.
+
+        Returns:
+            False, если оформление с этим токеном уже было (уникальный индекс)
+        """
+        stmt = upsert_insert(self.session, CheckoutRequest).values(
+            user_id=user_id, token=token, created_at=datetime.now()
         )
-        self.session.add(order_item)
-        await self.session.flush()
-        await self.session.refresh(order_item)
-        return order_item
-    
+        stmt = stmt.on_conflict_do_nothing(index_elements=["user_id", "token"]).returning(CheckoutRequest.id)
+        return await self.session.scalar(stmt) is not None
+
+    async def save_checkout_result(self, user_id: int, token: str, order_id: int, result: Dict) -> None:
+        """Сохраняет результат оформления, чтобы ответить на повторные нажатия"""
+        await self.session.execute(
+            update(CheckoutRequest)
+            .where(CheckoutRequest.user_id == user_id, CheckoutRequest.token == token)
+            .values(order_id=order_id, result=result)
+        )
+
+    async def get_checkout_result(self, user_id: int, token: str) -> Optional[Dict]:
+        """Результат оформления по токену или None"""
+        return await self.session.scalar(
+            select(CheckoutRequest.result)
+            .where(CheckoutRequest.user_id == user_id, CheckoutRequest.token == token)
+        )
+
+    async def iter_orders_for_export(self, batch_size: int) -> AsyncIterator[List[tuple]]:
+        """Потоково отдает заказы для выгрузки пачками по batch_size строк
+
+        Колонки: ID, дата, Telegram ID, ФИО, отдел, сумма, статус, количество товаров.
+        """
+        # Количество товаров считается одним GROUP BY, а не подзапросом на каждый заказ
+        items_count = (
+            select(OrderItem.order_id, func.sum(OrderItem.quantity).label("quantity"))
+            .group_by(OrderItem.order_id)
+            .subquery()
+        )
+        stmt = (
+            select(Order.id, Order.created_at, Order.user_id, User.fullname, User.department,
+                   Order.total_cost, Order.status, func.coalesce(items_count.c.quantity, 0))
+            .outerjoin(User, User.telegram_id == Order.user_id)
+            .outerjoin(items_count, items_count.c.order_id == Order.id)
+            .order_by(Order.id)
+            .execution_options(yield_per=batch_size)
+        )
+        result = await self.session.stream(stmt)
+        async for partition in result.partitions():
+            yield [tuple(row) for row in partition]
+
     async def get_order(self, order_id: int) -> Optional[Order]:
         """Получает заказ по ID с загрузкой товаров"""
         result = await self.session.execute(
@@ -103,14 +151,31 @@ class OrderRepo:
         if order.status in ["delivered", "completed"]:
             raise ValueError(f"Невозможно отменить заказ в статусе '{order.status}'")
             
-        await self.update_order_status(order_id, "cancelled")
+        # Статус меняется условно, чтобы параллельная отмена не вернула средства дважды
+        result = await self.session.execute(
+            update(Order)
+            .where(Order.id == order_id, Order.status.not_in(["delivered", "completed", "cancelled"]))
+            .values(status="cancelled", updated_at=datetime.now())
+            .returning(Order.id)
+        )
+        if result.scalar_one_or_none() is None:
+            await self.session.refresh(order)
+            raise ValueError(f"Невозможно отменить заказ в статусе '{order.status}'")
         
-        # Возвращаем средства
-        user = await self.session.get(User, order.user_id)
-        if user:
-            user.tpoints += order.total_cost
-            self.session.add(user)
-            await self.session.flush()
+        # Возвращаем товар на склад
+        quantities = {}
+        for item in order.items:
+            quantities[item.product_id] = quantities.get(item.product_id, 0) + item.quantity
+        await CatalogRepo(self.session).release_stock(quantities)
+        
+        # Возвращаем средства тем же атомарным запросом, что и при списании
+        await UserRepo(self.session).change_tpoints(
+            order.user_id,
+            int(order.total_cost),
+            order_id=order.id,
+            comment=f"Возврат за отмененный заказ #{order.id}"
+        )
+        await self.session.refresh(order)
             
         return order
     
@@ -1,9 +1,14 @@
 from sqlalchemy.ext.asyncio import AsyncSession
-from sqlalchemy import select, update, func
+from sqlalchemy import select, update, insert, func, literal
+from sqlalchemy.exc import IntegrityError
 from datetime import datetime
-from typing import Optional, List
+from typing import Optional, List, Dict, Any, AsyncIterator
 
-from app.database.models import User, TPointsTransaction
+from app.database.models import User, TPointsTransaction, Product
+from app.database.dialect import chunked, dialect_name
+
+# Количество строк в одном запросе при массовой записи пользователей
+BULK_CHUNK_SIZE = 500
 
 
 class UserRepo:
@@ -57,6 +62,104 @@ class UserRepo:
         result = await self.session.execute(select(User))
         return result.scalars().all()
     
+    async def get_existing_telegram_ids(self, telegram_ids: List[int],
+                                        chunk_size: int = BULK_CHUNK_SIZE) -> set:
+        """Возвращает те из telegram_ids, которые уже есть в БД (один IN-запрос на часть)"""
+        existing = set()
+        for chunk in chunked(list(telegram_ids), chunk_size):
+            result = await self.session.scalars(select(User.telegram_id).where(User.telegram_id.in_(chunk)))
+            existing.update(result)
+        return existing
+
+    async def bulk_upsert_users(self, users_data: List[Dict[str, Any]],
+                                chunk_size: int = BULK_CHUNK_SIZE) -> Dict[str, Any]:
+        """Массово создает и обновляет пользователей по Telegram ID
+
+        Существующие пользователи определяются одним IN-запросом на часть, новые
+        записываются одним INSERT, существующие - одним UPDATE по первичному ключу.
+        Если часть не записалась (например, занятый username), она повторяется
+        построчно, и в отчет попадают только строки с ошибкой. Фиксирует транзакцию
+        вызывающий код.
+
+        Args:
+            users_data: Словари с полями модели User, обязательно с 'telegram_id'
+            chunk_size: Количество строк в одном запросе
+
+        Returns:
+            Словарь с ключами 'created', 'updated' и 'failed' - список (telegram_id, ошибка)
+        """
+        report = {"created": 0, "updated": 0, "failed": []}
+
+        # Последняя строка с одинаковым Telegram ID побеждает
+        rows = list({row["telegram_id"]: row for row in users_data}.values())
+
+        for chunk in chunked(rows, chunk_size):
+            existing = await self.get_existing_telegram_ids([row["telegram_id"] for row in chunk], chunk_size)
+            new_rows = [row for row in chunk if row["telegram_id"] not in existing]
+            existing_rows = [row for row in chunk if row["telegram_id"] in existing]
+
+            try:
+                async with self.session.begin_nested():
+                    await self._write_users(new_rows, existing_rows)
+                report["created"] += len(new_rows)
+                report["updated"] += len(existing_rows)
+                continue
+            except IntegrityError:
+                pass
+
+            # Часть целиком не записалась - ищем конкретные строки
+            for row in chunk:
+                is_new = row["telegram_id"] not in existing
+                try:
+                    async with self.session.begin_nested():
+                        await self._write_users([row] if is_new else [], [] if is_new else [row])
+                except IntegrityError as e:
+                    report["failed"].append((row["telegram_id"], str(e.orig)))
+                    continue
+                report["created" if is_new else "updated"] += 1
+
+        return report
+
+    async def _write_users(self, new_rows: List[Dict[str, Any]], existing_rows: List[Dict[str, Any]]) -> None:
+        if new_rows:
+            await self.session.execute(insert(User), new_rows)
+        if existing_rows:
+            await self.session.execute(update(User), existing_rows)
+
+    async def iter_users_for_export(self, batch_size: int) -> AsyncIterator[List[tuple]]:
+        """Потоково отдает пользователей для выгрузки пачками по batch_size строк
+
+        Колонки: ФИО, username, Telegram ID, T-points, отдел, должность,
+        дата рождения, дата приема, активен.
+        """
+        stmt = (
+            select(User.fullname, User.username, User.telegram_id, User.tpoints, User.department,
+                   User.post, User.birth_date, User.hire_date, User.is_active)
+            .order_by(User.telegram_id)
+            .execution_options(yield_per=batch_size)
+        )
+        result = await self.session.stream(stmt)
+        async for partition in result.partitions():
+            yield [tuple(row) for row in partition]
+
+    async def iter_tpoints_for_export(self, batch_size: int) -> AsyncIterator[List[tuple]]:
+        """Потоково отдает историю начислений и списаний T-points пачками по batch_size строк
+
+        Колонки: ID, дата, Telegram ID, ФИО, сумма, ID заказа, товар, комментарий.
+        """
+        stmt = (
+            select(TPointsTransaction.id, TPointsTransaction.transaction_date, TPointsTransaction.user_id,
+                   User.fullname, TPointsTransaction.amount, TPointsTransaction.order_id,
+                   Product.name, TPointsTransaction.comment)
+            .outerjoin(User, User.telegram_id == TPointsTransaction.user_id)
+            .outerjoin(Product, Product.id == TPointsTransaction.product_id)
+            .order_by(TPointsTransaction.id)
+            .execution_options(yield_per=batch_size)
+        )
+        result = await self.session.stream(stmt)
+        async for partition in result.partitions():
+            yield [tuple(row) for row in partition]
+
     async def get_hr_by_telegram_id(self, telegram_id: int) -> Optional[User]:
         """Получает HR по Telegram ID"""
         result = await self.session.execute(
@@ -110,6 +213,56 @@ class UserRepo:
         """Получает список всех HR-менеджеров (аналог get_all_by_roles)"""
         return await self.get_all_by_roles(["hr"])
     
+    async def change_tpoints(self, user_id: int, amount: int, order_id: int = None,
+                             product_id: int = None, comment: str = None) -> Optional[int]:
+        """Атомарно меняет баланс T-points и записывает операцию в историю
+
+        Баланс меняется одним условным UPDATE (списание проходит только при
+        tpoints >= суммы), поэтому параллельные списания не уходят в минус и не
+        затирают друг друга. В PostgreSQL запись в историю выполняется в том же
+        запросе (CTE), в остальных БД - следующим запросом в той же транзакции.
+
+        Args:
+            amount: Положительная сумма - начисление, отрицательная - списание
+
+        Returns:
+            Новый баланс или None, если пользователя нет или недостаточно средств
+        """
+        debit = (
+            update(User)
+            .where(User.telegram_id == user_id)
+            .values(tpoints=User.tpoints + amount)
+            .returning(User.telegram_id, User.tpoints)
+        )
+        if amount < 0:
+            debit = debit.where(User.tpoints >= -amount)
+
+        ledger_values = {
+            "amount": amount,
+            "transaction_date": datetime.now().date(),
+            "order_id": order_id,
+            "product_id": product_id,
+            "comment": comment,
+        }
+
+        if dialect_name(self.session) == "postgresql":
+            debited = debit.cte("debited")
+            ledger = insert(TPointsTransaction).from_select(
+                ["user_id", *ledger_values],
+                select(debited.c.telegram_id, *(
+                    literal(value, TPointsTransaction.__table__.c[name].type)
+                    for name, value in ledger_values.items()
+                ))
+            ).cte("ledger")
+            result = await self.session.execute(select(debited.c.tpoints).add_cte(ledger))
+            return result.scalar_one_or_none()
+
+        row = (await self.session.execute(debit)).first()
+        if row is None:
+            return None
+        await self.session.execute(insert(TPointsTransaction).values(user_id=user_id, **ledger_values))
+        return row.tpoints
+
     # Новые методы для работы с транзакциями
     async def create_tpoints_transaction(self, user_id: int, amount: int, 
                                         order_id: int = None, product_id: int = None, 
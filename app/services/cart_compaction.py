@@ -0,0 +1,91 @@
+import asyncio
+import os
+from datetime import datetime, timedelta
+from typing import Optional
+
+from app.database.database import SessionLocal
+from app.repositories.cart_repo import CartRepository
+from app.services.cart_service import cart_views
+
+# Корзины без активности дольше стольких дней удаляются
+CART_IDLE_DAYS = int(os.getenv("CART_IDLE_DAYS", "30"))
+
+# Как часто запускать очистку (сек.), сколько корзин/строк удалять за транзакцию
+# и сколько ждать между пачками, чтобы не мешать обработке обновлений
+CART_COMPACTION_INTERVAL = float(os.getenv("CART_COMPACTION_INTERVAL", str(6 * 60 * 60)))
+CART_COMPACTION_BATCH = int(os.getenv("CART_COMPACTION_BATCH", "500"))
+CART_COMPACTION_PAUSE = float(os.getenv("CART_COMPACTION_PAUSE", "0.1"))
+
+
+class CartCompactor:
+    """Периодическая очистка брошенных корзин
+
+    Удаляет корзины, в которые давно ничего не добавляли, и строки корзин с
+    недоступными товарами. Каждая пачка удаляется отдельной короткой транзакцией,
+    между пачками обработчик уступает цикл событий.
+    """
+
+    def __init__(self, session_factory, idle_days: int = CART_IDLE_DAYS,
+                 interval: float = CART_COMPACTION_INTERVAL, batch_size: int = CART_COMPACTION_BATCH,
+                 pause: float = CART_COMPACTION_PAUSE):
+        self.session_factory = session_factory
+        self.idle_days = idle_days
+        self.interval = interval
+        self.batch_size = batch_size
+        self.pause = pause
+        self._worker: Optional[asyncio.Task] = None
+
+    def start(self):
+        if self._worker is None or self._worker.done():
+            self._worker = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._worker is not None:
+            self._worker.cancel()
+            self._worker = None
+
+    async def _run(self):
+        while True:
+            try:
+                await self.compact()
+            except Exception as e:
+                print(f"Cart compaction failed: {e}")
+            await asyncio.sleep(self.interval)
+
+    async def compact(self) -> dict:
+        """Очищает корзины пачками до тех пор, пока есть что удалять
+
+        Returns:
+            Словарь с ключами 'carts' и 'items' - сколько удалено корзин и строк
+        """
+        idle_since = datetime.now() - timedelta(days=self.idle_days)
+        reclaimed = {"carts": 0, "items": 0}
+
+        while True:
+            result = await self._batch(lambda repo: repo.delete_idle_carts(idle_since, self.batch_size))
+            reclaimed["carts"] += result["carts"]
+            reclaimed["items"] += result["items"]
+            if len(result["user_ids"]) < self.batch_size:
+                break
+            await asyncio.sleep(self.pause)
+
+        while True:
+            result = await self._batch(lambda repo: repo.delete_unavailable_items(self.batch_size))
+            reclaimed["items"] += result["items"]
+            if result["items"] < self.batch_size:
+                break
+            await asyncio.sleep(self.pause)
+
+        print(f"Cart compaction: removed {reclaimed['carts']} carts and {reclaimed['items']} cart items")
+        return reclaimed
+
+    async def _batch(self, delete) -> dict:
+        async with self.session_factory() as session:
+            async with session.begin():
+                result = await delete(CartRepository(session))
+        for user_id in result["user_ids"]:
+            cart_views.pop(user_id)
+        return result
+
+
+cart_compactor = CartCompactor(SessionLocal)
@@ -0,0 +1,122 @@
+import asyncio
+import os
+from typing import Awaitable, Callable, Dict, Optional, Set, Tuple
+
+from app.database.database import SessionLocal
+from app.services.cart_service import CartService, CartView
+
+# Сколько секунд копить нажатия "+"/"-" по строке корзины перед записью в БД
+CART_QUANTITY_DEBOUNCE = float(os.getenv("CART_QUANTITY_DEBOUNCE", "0.7"))
+
+# Корутина, отображающая результат: (новое количество или 0/None, корзина)
+FlushCallback = Callable[[Optional[int], CartView], Awaitable[None]]
+
+
+class _PendingChange:
+    def __init__(self):
+        self.delta = 0
+        self.on_flush: Optional[FlushCallback] = None
+        self.task: Optional[asyncio.Task] = None
+
+
+class QuantityDebouncer:
+    """Склеивает быстрые изменения количества по строке корзины
+
+    Нажатия за окно delay суммируются, затем итоговое изменение записывается одним
+    запросом в отдельной сессии и отображается один раз (последним переданным
+    on_flush). Если нажатия взаимно погасились, ни запись, ни отрисовка не нужны.
+    flush_user дожидается и записей, которые уже выполняются, поэтому после него
+    все нажатия пользователя зафиксированы в БД.
+    """
+
+    def __init__(self, session_factory, delay: float = CART_QUANTITY_DEBOUNCE):
+        self.session_factory = session_factory
+        self.delay = delay
+        self.pending: Dict[Tuple[int, int], _PendingChange] = {}
+        # Записи, которые уже выполняются и еще не зафиксированы: {user_id: futures}
+        self.writing: Dict[int, Set[asyncio.Future]] = {}
+
+    def tap(self, user_id: int, item_id: int, delta: int, on_flush: FlushCallback) -> int:
+        """Учитывает нажатие; возвращает накопленное за окно изменение"""
+        key = (user_id, item_id)
+        change = self.pending.get(key)
+        if change is None:
+            change = self.pending[key] = _PendingChange()
+            change.task = asyncio.create_task(self._flush_later(key))
+        change.delta += delta
+        change.on_flush = on_flush
+        return change.delta
+
+    async def flush_user(self, user_id: int):
+        """Немедленно записывает отложенные изменения пользователя (например, перед оформлением)
+
+        Отрисовка пропускается: вызывающий обработчик сам покажет актуальную корзину.
+        """
+        for key in [key for key in self.pending if key[0] == user_id]:
+            await self._flush_now(key)
+        writes = self.writing.get(user_id)
+        if writes:
+            await asyncio.wait(list(writes))
+
+    async def stop(self):
+        for key in list(self.pending):
+            await self._flush_now(key)
+        writes = [write for user_writes in self.writing.values() for write in user_writes]
+        if writes:
+            await asyncio.wait(writes)
+
+    async def _flush_now(self, key: Tuple[int, int]):
+        change = self.pending.get(key)
+        if change is None:
+            return
+        # Пока ключ в pending, задача еще спит и ее можно безопасно отменить
+        change.task.cancel()
+        await self._flush(key, render=False)
+
+    async def _flush_later(self, key: Tuple[int, int]):
+        await asyncio.sleep(self.delay)
+        await self._flush(key)
+
+    async def _flush(self, key: Tuple[int, int], render: bool = True):
+        change = self.pending.pop(key, None)
+        if change is None or change.delta == 0:
+            return
+
+        user_id, item_id = key
+        # Ключ уже не в pending: до фиксации записи ее ждет flush_user
+        written = asyncio.get_running_loop().create_future()
+        self.writing.setdefault(user_id, set()).add(written)
+        try:
+            async with self.session_factory() as session:
+                cart_service = CartService(session)
+                try:
+                    async with session.begin():
+                        quantity = await cart_service.update_quantity(user_id, item_id, change.delta)
+                finally:
+                    self._written(user_id, written)
+                if not render:
+                    return
+                cart = await cart_service.get_cart_view(user_id)
+        except Exception as e:
+            print(f"Failed to update cart item {item_id} of {user_id}: {e}")
+            return
+        finally:
+            # Сессия могла не открыться: ожидающие запись не должны зависнуть
+            self._written(user_id, written)
+
+        try:
+            await change.on_flush(quantity, cart)
+        except Exception as e:
+            print(f"Failed to render cart item {item_id} of {user_id}: {e}")
+
+    def _written(self, user_id: int, written: asyncio.Future):
+        if written.done():
+            return
+        written.set_result(None)
+        writes = self.writing[user_id]
+        writes.discard(written)
+        if not writes:
+            del self.writing[user_id]
+
+
+cart_quantities = QuantityDebouncer(SessionLocal)
@@ -1,10 +1,82 @@
+import logging
+import os
 from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy.orm import sessionmaker
-from sqlalchemy import select
+from sqlalchemy import select, event
 from app.repositories.cart_repo import CartRepository
 from app.repositories.user_repo import UserRepo
 from app.repositories.order_repo import OrderRepo
-from app.database.models import Cart, CartItem
+from app.repositories.catalog_repo import CatalogRepo
+from app.database.models import Cart, CartItem, User
+from app.database.versions import table_version
+from app.utils.cache import LRUCache
+
+logger = logging.getLogger(__name__)
+
+# Сообщение пользователю о непредвиденной ошибке оформления (подробности - в логе)
+CHECKOUT_FAILED_TEXT = "Произошла ошибка при оформлении заказа, попробуйте позже"
+
+# Сколько корзин держать в памяти
+CART_VIEW_CACHE_SIZE = int(os.getenv("CART_VIEW_CACHE_SIZE", "1000"))
+
+# Сколько последних результатов оформления по токену держать в памяти
+CHECKOUT_CACHE_SIZE = int(os.getenv("CHECKOUT_CACHE_SIZE", "1000"))
+
+
+class CheckoutError(Exception):
+    """Заказ не может быть оформлен; транзакция оформления откатывается"""
+
+
+class DuplicateCheckout(CheckoutError):
+    """Корзина с этим токеном уже оформлена; result - сохраненный результат"""
+
+    def __init__(self, result: dict = None):
+        super().__init__("Заказ уже оформляется, подождите")
+        self.result = result
+
+
+class CartProductView:
+    def __init__(self, product_id: int, name: str, price: int):
+        self.id = product_id
+        self.name = name
+        self.price = price
+
+
+class CartLineView:
+    """Строка корзины для отображения; повторяет нужные поля CartItem"""
+
+    def __init__(self, item_id: int, product: CartProductView, quantity: int, size: str = None, color: str = None):
+        self.id = item_id
+        self.product_id = product.id
+        self.product = product
+        self.quantity = quantity
+        self.size = size
+        self.color = color
+
+
+class CartView:
+    """Корзина пользователя для отображения (строки, названия, цены, итог)"""
+
+    def __init__(self, items: list[CartLineView]):
+        self.items = items
+
+    @property
+    def total(self) -> int:
+        return sum(item.product.price * item.quantity for item in self.items)
+
+    def find(self, item_id: int):
+        return next((item for item in self.items if item.id == item_id), None)
+
+    def remove(self, item_id: int) -> None:
+        self.items = [item for item in self.items if item.id != item_id]
+
+
+# Корзины по user_id: (версия таблицы товаров, CartView)
+cart_views = LRUCache(CART_VIEW_CACHE_SIZE)
+
+# Результаты оформления по (user_id, токен) и оформления, которые выполняются сейчас
+checkout_results = LRUCache(CHECKOUT_CACHE_SIZE)
+checkouts_in_progress: set[tuple[int, str]] = set()
 
 
 class CartService:
@@ -13,19 +85,64 @@ class CartService:
         self.cart_repo = CartRepository(session)
         self.user_repo = UserRepo(session)
         self.order_repo = OrderRepo(session)
+        self.catalog_repo = CatalogRepo(session)
 
     async def get_or_create_cart(self, user_id: int) -> Cart:
         """Возвращает корзину пользователя, создавая её, если не существует."""
         return await self.cart_repo.get_cart(user_id)
 
+    async def get_cart_view(self, user_id: int) -> CartView:
+        """Корзина для отображения: из кэша или одним запросом из БД
+
+        Кэш обновляется мутациями корзины и сбрасывается при изменении товаров
+        (цены и названия берутся из кэша, пока таблица товаров не менялась).
+        Списание остатков при оформлении заказов кэш не сбрасывает (STOCK_VERSION).
+        """
+        version = table_version("products")
+        cached = cart_views.get(user_id)
+        if cached is not None and cached[0] == version:
+            return cached[1]
+
+        lines = await self.cart_repo.get_cart_lines(user_id)
+        view = CartView([
+            CartLineView(line.id, CartProductView(line.product_id, line.name, line.price),
+                         line.quantity, line.size, line.color)
+            for line in lines
+        ])
+        cart_views.put(user_id, (version, view))
+        return view
+
+    def _update_view(self, user_id: int, update) -> None:
+        """Применяет изменение к закэшированной корзине (write-through)
+
+        Если транзакция будет откатана, корзина удаляется из кэша.
+        """
+        cached = cart_views.get(user_id)
+        if cached is None:
+            return
+        if update(cached[1]) is False:
+            cart_views.pop(user_id)
+        event.listen(self.session.sync_session, "after_soft_rollback",
+                     lambda session, previous: cart_views.pop(user_id), once=True)
+
     async def add_to_cart(self, user_id: int, product_id: int, quantity: int = 1, size: str = None, color: str = None):
         """Добавляет товар в корзину"""
-        cart = await self.get_or_create_cart(user_id)
-        return await self.cart_repo.add_item(cart.id, product_id, quantity, size, color)
+        cart_id = await self.cart_repo.get_cart_id(user_id)
+        line = await self.cart_repo.add_item(cart_id, product_id, quantity, size, color)
+
+        def update(view: CartView):
+            item = view.find(line.id)
+            if item is None:
+                # Новая строка: названия и цены товара в кэше нет, корзина перечитается
+                return False
+            item.quantity = line.quantity
+        self._update_view(user_id, update)
+        return line
 
     async def remove_from_cart(self, user_id: int, cart_item_id: int):
         """Удаляет товар из корзины"""
         await self.cart_repo.remove_item(cart_item_id)
+        self._update_view(user_id, lambda view: view.remove(cart_item_id))
     
     async def save_cart(self, cart: Cart):
         """Сохраняем корзину в базе данных"""
@@ -34,105 +151,160 @@ class CartService:
         await self.session.commit()
 
     async def update_quantity(self, user_id: int, cart_item_id: int, quantity_change: int):
-        """Обновляет количество товара в корзине"""
-        # Исправление: Получаем текущий элемент и меняем его количество
-        result = await self.session.execute(
-            select(CartItem).where(CartItem.id == cart_item_id)
-        )
-        cart_item = result.scalars().first()
-        
-        if cart_item:
-            new_quantity = cart_item.quantity + quantity_change
-            await self.cart_repo.update_quantity(cart_item_id, new_quantity)
+        """Обновляет количество товара в корзине (строка удаляется, когда количество доходит до нуля)"""
+        quantity = await self.cart_repo.change_quantity(cart_item_id, quantity_change, user_id)
+
+        def update(view: CartView):
+            item = view.find(cart_item_id)
+            if item is not None and quantity:
+                item.quantity = quantity
+            else:
+                view.remove(cart_item_id)
+        if quantity is not None:
+            self._update_view(user_id, update)
+        return quantity
 
     async def clear_user_cart(self, user_id: int):
         """Очистка корзины пользователя"""
-        cart = await self.cart_repo.get_cart(user_id)
-        if cart:
-            await self.cart_repo.clear_cart(cart.id)  # Удаление всех товаров из корзины
+        cart_id = await self.cart_repo.get_cart_id(user_id)
+        await self.cart_repo.clear_cart(cart_id)  # Удаление всех товаров из корзины
+        self._update_view(user_id, lambda view: view.items.clear())
         return True
 
-    async def get_cart_total(self, user_id: int):
-        """Возвращает общую стоимость товаров в корзине"""
-        cart = await self.get_or_create_cart(user_id)
-        return await self.cart_repo.get_cart_total(cart.id)
+    async def place_order(self, user_id: int, token: str = None) -> dict:
+        """Оформляет заказ из корзины в текущей транзакции, не фиксируя её
 
-    async def checkout_cart(self, user_id: int):
-        """Оформить заказ из корзины"""
-        try:
-            async with self.session.begin():  # Начало транзакции
-                # 1. Получаем корзину
-                cart = await self.cart_repo.get_cart(user_id)
-                if not cart.items:
-                    return False, "Корзина пуста"
-                    
-                # 2. Рассчитываем общую стоимость
-                total_cost = await self.cart_repo.get_cart_total(cart.id)
-                
-                # 3. Получаем данные пользователя и проверяем баланс T-points
-                user = await self.user_repo.get_user(user_id)
-                
-                if not user:
-                    return False, "Пользователь не найден"
-                
-                if user.tpoints < total_cost:
-                    return False, f"Недостаточно T-points для оформления заказа. Требуется: {total_cost}, доступно: {user.tpoints}"
-                    
-                # 4. Создаем заказ
-                order = await self.order_repo.create_order(
-                    user_id=user_id,
-                    total_cost=total_cost,
-                    status="pending"  # начальный статус заказа
-                )
-                
-                # 5. Подготовим список товаров для ответа и добавления в заказ
-                order_items = []
-                
-                # 6. Добавляем товары из корзины в заказ
-                for item in cart.items:
-                    order_item = await self.order_repo.add_order_item(
-                        order_id=order.id,
-                        product_id=item.product_id,
-                        quantity=item.quantity,
-                        price=item.product.price,
-                        size=item.size,
-                        color=item.color
-                    )
-                    
-                    # Добавляем информацию о товаре для уведомления HR
-                    order_items.append({
-                        "product_name": item.product.name,
-                        "product_id": item.product_id,
-                        "quantity": item.quantity,
-                        "price": item.product.price,
-                        "size": item.size,
-                        "color": item.color,
-                        "subtotal": item.product.price * item.quantity
-                    })
-                
-                # 7. Создаем транзакцию списания T-points
-                await self.order_repo.create_tpoints_transaction(
-                    user_id=user_id,
-                    amount=-total_cost,  # отрицательная сумма для списания
-                    order_id=order.id,
-                    comment=f"Оплата заказа #{order.id}"
-                )
-                
-                # 8. Списываем T-points с баланса пользователя
-                await self.user_repo.update_tpoints(user_id, user.tpoints - total_cost)
-                
-                # 9. Очищаем корзину
-                await self.cart_repo.clear_cart(cart.id)
-                
-                # 10. Возвращаем результат
-                return True, {
-                    "order_id": order.id,
-                    "total_cost": total_cost,
-                    "remaining_balance": user.tpoints - total_cost,
-                    "order_items": order_items  # Для уведомления HR
+        Args:
+            token: Токен кнопки оформления; повторное оформление с тем же токеном
+                не создает заказ (уникальный индекс checkout_requests)
+
+        Raises:
+            DuplicateCheckout: если корзина с этим токеном уже оформлена
+            CheckoutError: если заказ оформить нельзя; вызывающий код должен откатить транзакцию
+        """
+        # 0. Регистрируем токен: повторное оформление отвечает сохраненным результатом
+        if token and not await self.order_repo.claim_checkout(user_id, token):
+            raise DuplicateCheckout(await self.order_repo.get_checkout_result(user_id, token))
+
+        # 1. Получаем строки корзины с ценами товаров одним запросом
+        lines = await self.cart_repo.get_cart_lines(user_id)
+        if not lines:
+            raise CheckoutError("Корзина пуста")
+
+        # 2. Рассчитываем общую стоимость по уже загруженным строкам
+        total_cost = sum(line.price * line.quantity for line in lines)
+
+        # 3. Резервируем товар на складе одним условным запросом для всех позиций
+        quantities = {}
+        for line in lines:
+            quantities[line.product_id] = quantities.get(line.product_id, 0) + line.quantity
+        short = await self.catalog_repo.reserve_stock(quantities)
+        if short:
+            names = {line.product_id: line.name for line in lines}
+            raise CheckoutError(
+                "Недостаточно товара на складе: " + ", ".join(names[product_id] for product_id in short)
+            )
+
+        # 4. Создаем заказ вместе со всеми позициями
+        order_id = await self.order_repo.create_order_with_items(
+            user_id=user_id,
+            total_cost=total_cost,
+            items=[
+                {
+                    "product_id": line.product_id,
+                    "quantity": line.quantity,
+                    "price": line.price,
+                    "size": line.size,
+                    "color": line.color
                 }
-        
-        except Exception as e:
-            # Логирование и обработка других ошибок
-            print(f"Error during checkout: {e}")
-            return False, f"Произошла ошибка при оформлении заказа: {str(e)}"
\ No newline at end of file
+                for line in lines
+            ],
+            status="pending"  # начальный статус заказа
+        )
+
+        # 5. Информация о товарах для уведомления HR
+        order_items = [
+            {
+                "product_name": line.name,
+                "product_id": line.product_id,
+                "quantity": line.quantity,
+                "price": line.price,
+                "size": line.size,
+                "color": line.color,
+                "subtotal": line.price * line.quantity
+            }
+            for line in lines
+        ]
+
+        # 6. Списываем T-points одним условным запросом вместе с записью в историю
+        remaining_balance = await self.user_repo.change_tpoints(
+            user_id,
+            -total_cost,  # отрицательная сумма для списания
+            order_id=order_id,
+            comment=f"Оплата заказа #{order_id}"
+        )
+        if remaining_balance is None:
+            available = await self.session.scalar(select(User.tpoints).where(User.telegram_id == user_id))
+            if available is None:
+                raise CheckoutError("Пользователь не найден")
+            raise CheckoutError(
+                f"Недостаточно T-points для оформления заказа. Требуется: {total_cost}, доступно: {available}"
+            )
+
+        # 7. Очищаем корзину
+        await self.cart_repo.clear_cart(lines[0].cart_id)
+        self._update_view(user_id, lambda view: view.items.clear())
+
+        # 8. Возвращаем результат
+        result = {
+            "order_id": order_id,
+            "total_cost": total_cost,
+            "remaining_balance": remaining_balance,
+            "order_items": order_items  # Для уведомления HR
+        }
+        if token:
+            await self.order_repo.save_checkout_result(user_id, token, order_id, result)
+        return result
+
+    async def checkout_cart(self, user_id: int, token: str = None):
+        """Оформить заказ из корзины
+
+        Повторный вызов с тем же токеном не оформляет заказ еще раз: возвращается
+        сохраненный результат с ключом 'duplicate'.
+        """
+        key = (user_id, token)
+        if token:
+            cached = checkout_results.get(key)
+            if cached is not None:
+                return True, dict(cached, duplicate=True)
+            if key in checkouts_in_progress:
+                return False, "Заказ уже оформляется, подождите"
+            checkouts_in_progress.add(key)
+
+        try:
+            # Транзакция фиксируется явно: сессия обработчика могла уже начать ее
+            # чтением (например, корзины для проверки распродажи), и begin() упал бы
+            try:
+                result = await self.place_order(user_id, token)
+                await self.session.commit()
+            except BaseException:
+                await self.session.rollback()
+                raise
+            if token:
+                checkout_results.put(key, result)
+            return True, result
+
+        except DuplicateCheckout as e:
+            if e.result is None:
+                return False, str(e)
+            checkout_results.put(key, e.result)
+            return True, dict(e.result, duplicate=True)
+        except CheckoutError as e:
+            # Транзакция уже откатена: заказ не создан, баланс и остатки не изменились
+            return False, str(e)
+        except Exception:
+            # Подробности ошибки - только в логе, пользователю общий текст
+            logger.exception("Checkout failed for user %s", user_id)
+            return False, CHECKOUT_FAILED_TEXT
+        finally:
+            checkouts_in_progress.discard(key)
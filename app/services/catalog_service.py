@@ -1,19 +1,98 @@
-from app.repositories.catalog_repo import CatalogRepo
+from app.repositories.catalog_repo import CatalogRepo, CONTENT_COLUMNS
 from aiogram.types import InlineKeyboardMarkup, InputMediaPhoto
 from app.database.models import CommonImage, Product
 from app.keyboards.catalog_keyboard import catalog_keyboard
+from app.utils.catalog_diff import diff_catalog
+from app.utils.exel import iter_excel_chunks, ExcelFormatError, EXCEL_CHUNK_SIZE
+from app.utils.job_runner import excel_jobs, JobQueueFull
 import os
 import pandas as pd
 from datetime import datetime
 import re
 from io import BytesIO
+from contextlib import aclosing
+
+# Соответствие колонок Excel полям товара
+CATALOG_FIELD_MAPPING = {
+    'ID': 'id',
+    'Наименование товара': 'name',
+    'Описание': 'description',
+    'Цена (T-поинты)': 'price',
+    'URL изображения': 'image_url',
+    'Доступен (1-да, 0-нет)': 'is_available',
+    'Остаток на складе': 'stock',
+    'Доступные размеры': 'sizes',
+    'Доступные цвета': 'colors'
+}
+
+
+def build_catalog_workbook(products_data: list[dict], field_descriptions: dict) -> bytes:
+    """Build catalog Excel file from plain product rows (runs in a worker process)"""
+    # Create DataFrame
+    df = pd.DataFrame(products_data)
+    
+    # Create description DataFrame
+    desc_data = []
+    for field, description in field_descriptions.items():
+        desc_data.append({
+            'Поле': field,
+            'Описание': description
+        })
+    df_desc = pd.DataFrame(desc_data)
+    
+    # Create Excel in memory
+    output = BytesIO()
+    with pd.ExcelWriter(output, engine='openpyxl') as writer:
+        df.to_excel(writer, index=False, sheet_name='Каталог товаров')
+        df_desc.to_excel(writer, index=False, sheet_name='Инструкция')
+        
+        # Adjust column widths for catalog sheet
+        worksheet = writer.sheets['Каталог товаров']
+        for idx, col in enumerate(df.columns):
+            column_width = max(df[col].astype(str).map(len).max(), len(col)) + 2
+            worksheet.column_dimensions[chr(65 + idx)].width = min(column_width, 50)
+        
+        # Adjust column widths for description sheet
+        worksheet = writer.sheets['Инструкция']
+        worksheet.column_dimensions['A'].width = 30
+        worksheet.column_dimensions['B'].width = 100
+        
+        # Add some basic styling
+        from openpyxl.styles import Font, PatternFill
+        
+        # Style the headers in both sheets
+        for sheet in [worksheet, writer.sheets['Каталог товаров']]:
+            for cell in sheet[1]:
+                cell.font = Font(bold=True)
+                cell.fill = PatternFill(start_color="DAEEF3", end_color="DAEEF3", fill_type="solid")
+    
+    output.seek(0)
+    return output.getvalue()
+
+
+def read_catalog_chunks(source, chunk_size: int = EXCEL_CHUNK_SIZE):
+    """Read and validate catalog rows chunk by chunk (runs in a worker process)
+
+    Yields:
+        (products_data, errors, rows_read) for every chunk
+    """
+    rows_read = 0
+    for chunk in iter_excel_chunks(source, CATALOG_FIELD_MAPPING, chunk_size, required=('name', 'price')):
+        products_data = []
+        errors = []
+        for product in chunk:
+            try:
+                products_data.append(CatalogService._parse_product_row(product))
+            except ValueError as e:
+                errors.append(f"Строка {product['_row']}: {e}")
+        rows_read += len(chunk)
+        yield products_data, errors, rows_read
+
 
 class CatalogService:
     def __init__(self, catalog_repo: CatalogRepo):
         self.catalog_repo = catalog_repo
         self.excel_folder = "temp_excel"
-        
-        os.makedirs(self.excel_folder, exist_ok=True)
 
     async def list_products(self) -> list[Product]:
         """Get all products from database"""
@@ -105,6 +184,7 @@ class CatalogService:
         df_desc = pd.DataFrame(desc_data)
         
         # Create filename with timestamp
+        os.makedirs(self.excel_folder, exist_ok=True)
         timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
         filename = os.path.join(self.excel_folder, f"catalog_{timestamp}.xlsx")
         
@@ -172,132 +252,141 @@ class CatalogService:
                 field_mapping['colors']: product.colors if product.colors else ""
             })
         
-        # Create DataFrame
-        df = pd.DataFrame(products_data)
-        
-        # Create description DataFrame
-        desc_data = []
-        for field, description in field_descriptions.items():
-            desc_data.append({
-                'Поле': field,
-                'Описание': description
-            })
-        df_desc = pd.DataFrame(desc_data)
-        
-        # Create Excel in memory
-        output = BytesIO()
-        with pd.ExcelWriter(output, engine='openpyxl') as writer:
-            df.to_excel(writer, index=False, sheet_name='Каталог товаров')
-            df_desc.to_excel(writer, index=False, sheet_name='Инструкция')
-            
-            # Adjust column widths for catalog sheet
-            worksheet = writer.sheets['Каталог товаров']
-            for idx, col in enumerate(df.columns):
-                column_width = max(df[col].astype(str).map(len).max(), len(col)) + 2
-                worksheet.column_dimensions[chr(65 + idx)].width = min(column_width, 50)
-            
-            # Adjust column widths for description sheet
-            worksheet = writer.sheets['Инструкция']
-            worksheet.column_dimensions['A'].width = 30
-            worksheet.column_dimensions['B'].width = 100
-            
-            # Add some basic styling
-            from openpyxl.styles import Font, PatternFill
-            
-            # Style the headers in both sheets
-            for sheet in [worksheet, writer.sheets['Каталог товаров']]:
-                for cell in sheet[1]:
-                    cell.font = Font(bold=True)
-                    cell.fill = PatternFill(start_color="DAEEF3", end_color="DAEEF3", fill_type="solid")
-        
-        output.seek(0)
-        return output.getvalue()
+        # Build the workbook in a worker process to keep the event loop responsive
+        return await excel_jobs.run(build_catalog_workbook, products_data, field_descriptions)
+
+    async def import_catalog_from_excel(self, source, dry_run: bool = False, progress=None,
+                                        apply_stock: bool = False) -> dict:
+        """Process product import from Excel file with Russian field names
+
+        The file is parsed in a worker process and streamed back in chunks; every chunk
+        is compared with the stored products and only changed rows are written.
+        With dry_run=True nothing is written and the computed diff is returned instead.
 
-    async def import_catalog_from_excel(self, file_path: str) -> dict:
-        """Process product import from Excel file with Russian field names"""
+        Stock of existing products differs from the file whenever orders were placed
+        after the export, so it is reported separately (diff["stock"]) and written
+        only with apply_stock=True.
+
+        Args:
+            source: Excel file content (bytes) or path to it
+            dry_run: Only compute the diff
+            progress: Optional async callback receiving the number of processed rows
+            apply_stock: Also set stock of existing products to the values from the file
+        """
         try:
-            # Read Excel file
-            df = pd.read_excel(file_path)
-            
-            # Словарь соответствия русских и английских названий полей
-            reverse_field_mapping = {
-                'ID': 'id',
-                'Наименование товара': 'name',
-                'Описание': 'description',
-                'Цена (T-поинты)': 'price',
-                'URL изображения': 'image_url',
-                'Доступен (1-да, 0-нет)': 'is_available',
-                'Остаток на складе': 'stock',
-                'Доступные размеры': 'sizes',
-                'Доступные цвета': 'colors'
-            }
-            
-            # Проверяем наличие необходимых столбцов
-            required_ru_fields = ['Наименование товара', 'Цена (T-поинты)']
-            missing_fields = [field for field in required_ru_fields if field not in df.columns]
-            
-            if missing_fields:
-                return {
-                    "success": False,
-                    "message": f"В Excel файле отсутствуют обязательные поля: {', '.join(missing_fields)}"
-                }
-            
-            # Переименовываем столбцы с русского на английский для обработки
-            column_mapping = {ru: en for ru, en in reverse_field_mapping.items() if ru in df.columns}
-            df = df.rename(columns=column_mapping)
-            
-            # Convert DataFrame to list of dictionaries
-            raw_products_data = df.to_dict('records')
-            products_data = []
-            
-            # Validate data and process image links
-            for product in raw_products_data:
-                # Check required fields
-                if 'name' not in product or 'price' not in product:
-                    return {
-                        "success": False, 
-                        "message": "В Excel файле отсутствуют обязательные поля (name, price)"
+            diff = {"created": [], "updated": [], "unchanged": 0, "changes": {}, "stock": {}}
+            counts = {"created": 0, "updated": 0, "stock": 0}
+            errors = []
+
+            async with aclosing(excel_jobs.stream(read_catalog_chunks, source)) as chunks:
+                async for products_data, chunk_errors, rows_read in chunks:
+                    errors += chunk_errors
+
+                    # Compare with the stored versions of this chunk's products only
+                    product_ids = [product['id'] for product in products_data if product['id']]
+                    current_rows = await self.catalog_repo.get_product_rows(product_ids)
+                    part = diff_catalog(current_rows, products_data, CONTENT_COLUMNS)
+                    stock = {
+                        product_id: columns['stock']
+                        for product_id, columns in diff_catalog(current_rows, products_data, ('stock',))["changes"].items()
                     }
-                
-                # Convert is_available to boolean
-                is_available = product.get('is_available', True)
-                product['is_available'] = self._parse_bool(is_available)
-            
-                # Process Google Drive image link
-                image_raw = product.get('image_url')
-
-                try:
-                    if image_raw is not None:
-                        print(f"[DEBUG] Обработка изображения для продукта '{product.get('name')}'")
-                        product['image_url'] = self._extract_google_drive_image_url(image_raw)
-                    else:
-                        product['image_url'] = None
-                except Exception as e:
-                    print(f"[ERROR] Ошибка обработки URL для '{product.get('name')}': {e}")
-                    product['image_url'] = None
-
-                # Create new dictionary with required fields
-                products_data.append({
-                    'id': product.get('id'),
-                    'name': product['name'],
-                    'description': product.get('description', ''),
-                    'price': product['price'],
-                    'image_url': product['image_url'],
-                    'is_available': product['is_available'],
-                    'stock': product.get('stock', 1),  # Добавлено поле stock с дефолтным значением 1
-                    'sizes': product.get('sizes', ''),
-                    'colors': product.get('colors', '')
-                })
-                
-            # Save products to DB
-            result = await self.catalog_repo.create_or_update_products(products_data)
-            return {"success": True, "updated": result}
-        
+
+                    diff["unchanged"] += part["unchanged"]
+                    diff["stock"].update(stock)
+                    if dry_run:
+                        diff["created"] += part["created"]
+                        diff["updated"] += part["updated"]
+                        diff["changes"].update(part["changes"])
+                        if progress:
+                            await progress(rows_read)
+                        continue
+
+                    if part["created"] or part["updated"]:
+                        await self.catalog_repo.write_products(part["created"] + part["updated"])
+                        counts["created"] += len(part["created"])
+                        counts["updated"] += len(part["updated"])
+                    if apply_stock and stock:
+                        await self.catalog_repo.set_stock({product_id: new for product_id, (old, new) in stock.items()})
+                        counts["stock"] += len(stock)
+
+                    if progress:
+                        await progress(rows_read)
+
+            if dry_run:
+                return {"success": True, "dry_run": True, "diff": diff, "errors": errors}
+
+            await self.catalog_repo.session.commit()
+            return {
+                "success": True,
+                "updated": counts["updated"],
+                "created": counts["created"],
+                "unchanged": diff["unchanged"],
+                "stock": counts["stock"],
+                "stock_skipped": 0 if apply_stock else len(diff["stock"]),
+                "errors": errors
+            }
+
+        except ExcelFormatError as e:
+            return {"success": False, "message": str(e)}
+        except JobQueueFull as e:
+            return {"success": False, "message": str(e)}
         except Exception as e:
             print(f"Error during import: {e}")
             return {"success": False, "message": f"Ошибка при импорте: {str(e)}"}
+
+    @staticmethod
+    def _parse_product_row(product: dict) -> dict:
+        """Validate one Excel row and convert it to product columns"""
+        name = CatalogService._clean_value(product.get('name'))
+        if not name:
+            raise ValueError("не указано наименование товара")
+        try:
+            price = CatalogService._parse_int(product.get('price'))
+        except (TypeError, ValueError):
+            raise ValueError(f"некорректная цена '{product.get('price')}'")
+        if price is None:
+            raise ValueError("не указана цена")
+
+        # Process Google Drive image link
+        image_raw = CatalogService._clean_value(product.get('image_url'))
+        image_url = None
+        try:
+            if image_raw is not None:
+                image_url = CatalogService._extract_google_drive_image_url(image_raw)
+        except Exception as e:
+            print(f"[ERROR] Ошибка обработки URL для '{name}': {e}")
+
+        is_available = CatalogService._clean_value(product.get('is_available'))
+
+        return {
+            'id': CatalogService._parse_int(product.get('id')),
+            'name': name,
+            'description': CatalogService._clean_value(product.get('description')),
+            'price': price,
+            'image_url': image_url,
+            'is_available': CatalogService._parse_bool(is_available) if is_available is not None else True,
+            'stock': CatalogService._parse_int(product.get('stock', 1)),  # Добавлено поле stock с дефолтным значением 1
+            'sizes': CatalogService._clean_value(product.get('sizes')),
+            'colors': CatalogService._clean_value(product.get('colors'))
+        }
     
-    def _parse_bool(self, value) -> bool:
+    @staticmethod
+    def _clean_value(value):
+        """Convert pandas empty cells (NaN) to None"""
+        if value is None or (isinstance(value, float) and pd.isna(value)):
+            return None
+        return value
+
+    @staticmethod
+    def _parse_int(value) -> int | None:
+        """Convert Excel numbers (e.g. 100.0) to int, empty cells to None"""
+        value = CatalogService._clean_value(value)
+        if value is None or value == '':
+            return None
+        return int(value)
+
+    @staticmethod
+    def _parse_bool(value) -> bool:
         """Convert various types to boolean"""
         if isinstance(value, bool):
             return value
@@ -307,7 +396,8 @@ class CatalogService:
             return value.strip().lower() in ['true', '1', 'yes', 'да', 'истина']
         return False
     
-    def _extract_google_drive_image_url(self, url: str) -> str:
+    @staticmethod
+    def _extract_google_drive_image_url(url: str) -> str:
         """
         Преобразовать ссылку Google Drive в прямую ссылку на изображение
         """
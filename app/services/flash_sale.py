@@ -0,0 +1,216 @@
+import asyncio
+import logging
+import os
+from typing import Any, Awaitable, Callable, Dict, Optional
+
+from sqlalchemy import select
+
+from app.database.database import SessionLocal
+from app.database.models import Order, Product
+from app.database.versions import table_version, STOCK_VERSION
+from app.services.cart_service import CHECKOUT_FAILED_TEXT, CartService, CheckoutError, DuplicateCheckout
+
+# Товары распродажи (через запятую), заказы с ними идут через очередь
+FLASH_SALE_PRODUCTS = {int(product_id) for product_id in os.getenv("FLASH_SALE_PRODUCTS", "").split(",") if product_id.strip()}
+
+# Сколько заказов фиксируется одной транзакцией и сколько ждать добора пачки (сек.)
+FLASH_SALE_BATCH_SIZE = int(os.getenv("FLASH_SALE_BATCH_SIZE", "50"))
+FLASH_SALE_BATCH_WAIT = float(os.getenv("FLASH_SALE_BATCH_WAIT", "0.05"))
+
+logger = logging.getLogger(__name__)
+
+# Корутина, получающая результат оформления: (успех, результат place_order или текст ошибки)
+ResultCallback = Callable[[bool, Any], Awaitable[None]]
+
+
+class _Request:
+    def __init__(self, user_id: int, quantities: Dict[int, int], on_result: ResultCallback, token: Optional[str]):
+        self.user_id = user_id
+        self.quantities = quantities
+        self.on_result = on_result
+        self.token = token
+
+
+class FlashSaleQueue:
+    """Очередь оформления заказов с товарами распродажи
+
+    Заказы обрабатывает один обработчик в порядке поступления, поэтому транзакции
+    не соревнуются за одну строку товара. Остатки товаров распродажи держатся в
+    памяти: когда товар закончился, заказ отклоняется без обращения к БД.
+    Остальные заказы оформляются пачками: каждый в своей точке сохранения,
+    вся пачка - одной транзакцией. Остатки в БД по-прежнему списываются условным
+    запросом, так что счетчик в памяти только отсекает заведомо лишние заказы.
+    """
+
+    def __init__(self, session_factory, product_ids=FLASH_SALE_PRODUCTS,
+                 batch_size: int = FLASH_SALE_BATCH_SIZE, batch_wait: float = FLASH_SALE_BATCH_WAIT):
+        self.session_factory = session_factory
+        self.product_ids = set(product_ids)
+        self.batch_size = batch_size
+        self.batch_wait = batch_wait
+        self.queue: asyncio.Queue[_Request] = asyncio.Queue()
+        self.queued_users: set[int] = set()
+        self.stock: Dict[int, Optional[int]] = {}
+        self._stock_version = None
+        self._worker: Optional[asyncio.Task] = None
+
+    def applies_to(self, quantities: Dict[int, int]) -> bool:
+        """Нужно ли оформлять корзину с такими товарами через очередь"""
+        return bool(self.product_ids.intersection(quantities))
+
+    async def submit(self, user_id: int, quantities: Dict[int, int], on_result: ResultCallback,
+                     token: Optional[str] = None) -> Optional[int]:
+        """Ставит заказ в очередь
+
+        Args:
+            quantities: Количество товаров в корзине, {product_id: quantity}
+            on_result: Вызывается после фиксации пачки с результатом оформления
+            token: Токен кнопки оформления (см. CartService.place_order)
+
+        Returns:
+            Позиция в очереди или None, если заказ пользователя уже в очереди
+        """
+        if user_id in self.queued_users:
+            return None
+        if self._worker is None or self._worker.done():
+            self._worker = asyncio.create_task(self._run())
+        self.queued_users.add(user_id)
+        await self.queue.put(_Request(user_id, quantities, on_result, token))
+        return self.queue.qsize()
+
+    async def stop(self):
+        if self._worker is not None:
+            self._worker.cancel()
+            self._worker = None
+
+    async def _run(self):
+        while True:
+            batch = [await self.queue.get()]
+            # Добираем пачку, пока есть заявки и не истекло время ожидания
+            deadline = asyncio.get_running_loop().time() + self.batch_wait
+            while len(batch) < self.batch_size:
+                timeout = deadline - asyncio.get_running_loop().time()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self.queue.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+            try:
+                await self._process(batch)
+            except Exception:
+                logger.exception("Flash sale batch failed")
+                for request in batch:
+                    await self._deliver(request, False, CHECKOUT_FAILED_TEXT)
+            finally:
+                for request in batch:
+                    self.queued_users.discard(request.user_id)
+
+    async def _load_stock(self, session):
+        version = table_version("products", STOCK_VERSION)
+        if version == self._stock_version:
+            return
+        result = await session.execute(
+            select(Product.id, Product.stock).where(Product.id.in_(self.product_ids))
+        )
+        self.stock = dict(result.all())
+        self._stock_version = version
+
+    def _in_stock(self, quantities: Dict[int, int]) -> bool:
+        for product_id, quantity in quantities.items():
+            if product_id not in self.product_ids:
+                continue
+            available = self.stock.get(product_id, 0)
+            if available is not None and available < quantity:
+                return False
+        return True
+
+    async def _process(self, batch: list[_Request]):
+        results = []
+        async with self.session_factory() as session:
+            # Внешняя транзакция открывается явно до первого запроса: иначе на SQLite
+            # точка сохранения стала бы самостоятельной транзакцией и фиксировала
+            # каждый заказ отдельно
+            await session.begin()
+            await self._load_stock(session)
+            cart_service = CartService(session)
+
+            for request in batch:
+                if not self._in_stock(request.quantities):
+                    results.append((request, False, "Товар распродажи закончился"))
+                    continue
+                try:
+                    async with session.begin_nested():
+                        result = await cart_service.place_order(request.user_id, request.token)
+                except DuplicateCheckout as e:
+                    # Корзина уже оформлена этой кнопкой: отвечаем сохраненным результатом
+                    if e.result is None:
+                        results.append((request, False, str(e)))
+                    else:
+                        results.append((request, True, dict(e.result, duplicate=True)))
+                    continue
+                except CheckoutError as e:
+                    results.append((request, False, str(e)))
+                    continue
+                except Exception:
+                    logger.exception("Flash sale checkout failed for user %s", request.user_id)
+                    results.append((request, False, CHECKOUT_FAILED_TEXT))
+                    continue
+
+                for item in result["order_items"]:
+                    if self.stock.get(item["product_id"]) is not None:
+                        self.stock[item["product_id"]] -= item["quantity"]
+                results.append((request, True, result))
+
+            try:
+                await session.commit()
+            except Exception:
+                logger.exception("Flash sale commit failed")
+                self._stock_version = None
+                await session.rollback()
+                results = await self._durable_results(session, results)
+            else:
+                # Наши записи уже учтены в счетчике, перечитывать остатки не нужно
+                self._stock_version = table_version("products", STOCK_VERSION)
+
+        for request, success, result in results:
+            await self._deliver(request, success, result)
+
+    @staticmethod
+    async def _durable_results(session, results: list) -> list:
+        """Результаты пачки после ошибки фиксации
+
+        Ошибка COMMIT не означает, что заказы не записаны (например, соединение
+        оборвалось после фиксации), поэтому успешные заказы проверяются по БД:
+        сохранившиеся остаются успешными, остальные сообщаются как неудачные.
+        """
+        orders = {
+            result["order_id"]: request.user_id
+            for request, success, result in results
+            if success and not result.get("duplicate")
+        }
+        durable = set()
+        if orders:
+            try:
+                rows = await session.execute(
+                    select(Order.id, Order.user_id).where(Order.id.in_(list(orders)))
+                )
+                durable = {order_id for order_id, user_id in rows.all() if orders.get(order_id) == user_id}
+            except Exception:
+                logger.exception("Failed to check flash sale orders after commit failure")
+        return [
+            (request, False, "Не удалось оформить заказ, попробуйте еще раз")
+            if success and not result.get("duplicate") and result["order_id"] not in durable
+            else (request, success, result)
+            for request, success, result in results
+        ]
+
+    @staticmethod
+    async def _deliver(request: _Request, success: bool, result: Any):
+        try:
+            await request.on_result(success, result)
+        except Exception as e:
+            print(f"Failed to deliver flash sale result to {request.user_id}: {e}")
+
+
+flash_sale = FlashSaleQueue(SessionLocal)
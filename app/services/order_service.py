@@ -4,6 +4,8 @@ from app.repositories.catalog_repo import CatalogRepo
 from aiogram.types import InlineKeyboardButton, InlineKeyboardMarkup
 from app.database.models import User, Product, CartItem, Order, OrderItem, TPointsTransaction
 from app.services.cart_service import CartService
+from app.utils.exel import orders_excel_from_batches
+from app.utils.excel_stream import EXPORT_BATCH_SIZE
 from datetime import datetime
 from typing import List, Optional, Tuple, Dict
 
@@ -14,14 +16,26 @@ class OrderService:
         self.catalog_repo = catalog_repo
 
 
-    async def create_order(self, user_id: int, product_id: int):
-        return await self.order_repo.create_order(user_id, product_id)
-
     async def complete_order(self, order_id: int):
         return await self.order_repo.update_order_status(order_id, "completed")
 
-    async def cancel_order(self, order_id: int):
-        return await self.order_repo.update_order_status(order_id, "cancelled")
+    async def cancel_order(self, order_id: int) -> Optional[Order]:
+        """Отменяет заказ, возвращая T-points и остатки товаров, и фиксирует транзакцию
+
+        Raises:
+            ValueError: если заказ в статусе, который нельзя отменить
+        """
+        session = self.order_repo.session
+        try:
+            order = await self.order_repo.cancel_order(order_id)
+            await session.commit()
+        except BaseException:
+            await session.rollback()
+            raise
+        return order
+
+    async def export_orders_to_excel(self) -> bytes:
+        return await orders_excel_from_batches(self.order_repo.iter_orders_for_export(EXPORT_BATCH_SIZE))
 
     async def get_pending_orders(self):
         return await self.order_repo.get_pending_orders()
@@ -179,44 +193,3 @@ class OrderService:
         }
         
         return result
-    
-    def cancel_order(self, order_id: int, user_id: int) -> Tuple[bool, str]:
-        """Отменить заказ и вернуть T-поинты"""
-        order = self.db.query(Order).filter(Order.id == order_id, Order.user_id == user_id).first()
-        
-        if not order:
-            return False, "Заказ не найден"
-        
-        # Проверяем статус заказа
-        if order.status not in ["pending", "paid"]:
-            return False, f"Невозможно отменить заказ в статусе '{order.status}'"
-        
-        # Получаем пользователя
-        user = self.db.query(User).filter(User.telegram_id == user_id).first()
-        
-        # Возвращаем товары на склад
-        order_items = self.db.query(OrderItem).filter(OrderItem.order_id == order_id).all()
-        for item in order_items:
-            product = self.db.query(Product).filter(Product.id == item.product_id).first()
-            if product:
-                product.stock += item.quantity
-        
-        # Создаем транзакцию возврата T-поинтов
-        transaction = TPointsTransaction(
-            user_id=user_id,
-            amount=order.total_price,  # положительное значение для возврата
-            transaction_date=datetime.now().date(),
-            order_id=order.id,
-            comment=f"Возврат за отмененный заказ #{order.id}"
-        )
-        self.db.add(transaction)
-        
-        # Обновляем баланс пользователя
-        user.tpoints += order.total_price
-        
-        # Обновляем статус заказа
-        order.status = "cancelled"
-        
-        self.db.commit()
-        
-        return True, f"Заказ #{order.id} отменен, {order.total_price} T-поинтов возвращены"
\ No newline at end of file
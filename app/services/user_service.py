@@ -1,5 +1,6 @@
 from app.repositories.user_repo import UserRepo
-from app.utils.exel import user_create_excel_file
+from app.utils.exel import coerce_user_rows, users_excel_from_batches, tpoints_excel_from_batches
+from app.utils.excel_stream import EXPORT_BATCH_SIZE
 
 
 class UserService:
@@ -9,33 +10,23 @@ class UserService:
     async def get_hr_by_telegram_id(self, telegram_id: int):
         return await self.user_repo.get_hr_by_telegram_id(telegram_id)
     
-    async def bulk_import_users(self, users_data: list[dict]) -> None:
-        for user in users_data:
-            telegram_id = int(user["Telegram ID"])
-            existing = await self.user_repo.get_by_telegram_id(telegram_id)
+    async def bulk_import_users(self, users_data: list[dict]) -> dict:
+        """Импортирует сотрудников из строк с английскими заголовками (см. USER_FIELD_MAPPING)
 
-            is_active = str(user.get("Active", "1")).strip() in ["1", "True", "true"]
+        Returns:
+            Словарь с ключами 'created', 'updated' и 'errors' - сообщения о пропущенных строках
+        """
+        rows, errors = coerce_user_rows(users_data)
+        report = await self.user_repo.bulk_upsert_users(rows)
+        await self.user_repo.session.commit()
 
-            if existing:
-                existing.fullname = user["Full Name"]
-                existing.username = user.get("Username", "")
-                existing.tpoints = int(user.get("T-Points", 0))
-                existing.role = user.get("Role", "user")
-                existing.department = user["Department"]
-                existing.post = user["Post"]
-                existing.is_active = is_active
-            else:
-                await self.user_repo.create_user(
-                    telegram_id=telegram_id,
-                    fullname=user["Full Name"],
-                    username=user.get("Username", ""),
-                    tpoints=int(user.get("T-Points", 0)),
-                    role=user.get("Role", "user"),
-                    is_active=is_active,
-                )
+        errors += [f"Ошибка при сохранении (Telegram ID {telegram_id}): {error}"
+                   for telegram_id, error in report["failed"]]
+        return {"created": report["created"], "updated": report["updated"], "errors": errors}
 
-        await self.user_repo.session.commit()
-            
     async def export_users_to_excel(self) -> bytes:
-        users = await self.user_repo.get_all_users()
-        return user_create_excel_file(users)
\ No newline at end of file
+        # Строки читаются из БД пачками и сразу пишутся в файл, память не зависит от числа сотрудников
+        return await users_excel_from_batches(self.user_repo.iter_users_for_export(EXPORT_BATCH_SIZE))
+
+    async def export_tpoints_to_excel(self) -> bytes:
+        return await tpoints_excel_from_batches(self.user_repo.iter_tpoints_for_export(EXPORT_BATCH_SIZE))
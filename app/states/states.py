@@ -6,4 +6,9 @@ class AnonymousQuestionStates(StatesGroup):
 
 
 class CatalogStates(StatesGroup):
-    waiting_for_excel = State()
\ No newline at end of file
+    waiting_for_excel = State()
+    confirm_import = State()
+
+class DataExportStates(StatesGroup):
+    waiting_for_period = State()
+    waiting_for_department = State()
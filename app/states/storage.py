@@ -0,0 +1,334 @@
+import asyncio
+import json
+import os
+import sys
+from collections import OrderedDict
+from contextlib import asynccontextmanager
+from datetime import datetime, timedelta
+from typing import Any, AsyncIterator, Dict, Optional, Tuple
+
+from aiogram.fsm.state import State
+from aiogram.fsm.storage.base import BaseEventIsolation, BaseStorage, StateType, StorageKey
+from sqlalchemy import delete, select
+
+from app.database.dialect import upsert_insert, chunked
+from app.database.models import FSMRecord
+from app.utils.cache import LRUCache
+from app.utils.metrics import metrics
+
+# Хранилище FSM: "sql" (в БД бота, переживает перезапуск) или "memory"
+FSM_STORAGE = os.getenv("FSM_STORAGE", "sql")
+
+# Сколько записей держать в кэше процесса, через сколько секунд сбрасывать изменения
+# в БД и через сколько секунд без изменений состояние считается брошенным
+FSM_CACHE_SIZE = int(os.getenv("FSM_CACHE_SIZE", "10000"))
+FSM_FLUSH_DELAY = float(os.getenv("FSM_FLUSH_DELAY", "0.5"))
+FSM_TTL = float(os.getenv("FSM_TTL", str(7 * 24 * 60 * 60)))
+
+# Предел числа состояний в памяти (FSM_STORAGE=memory): сверх него вытесняются давно не использованные
+FSM_MAX_ENTRIES = int(os.getenv("FSM_MAX_ENTRIES", "50000"))
+
+# Сколько ключей с истекшими состояниями помнить, чтобы сообщить пользователю об истечении сессии
+FSM_EXPIRED_KEYS = 10000
+
+# Как часто удалять из БД просроченные записи (сек.) и сколько записей в одном INSERT
+FSM_PURGE_INTERVAL = 10 * 60
+FSM_FLUSH_CHUNK_SIZE = 500
+
+fsm_entries = metrics.gauge("fsm_entries", "Состояния FSM в памяти")
+fsm_memory_bytes = metrics.gauge("fsm_memory_bytes", "Примерный объем состояний FSM в памяти")
+fsm_expired_total = metrics.counter("fsm_expired_total", "Удаленные состояния FSM: истек срок или превышен предел")
+
+
+def _deep_size(obj: Any) -> int:
+    """Примерный размер объекта в байтах вместе с содержимым словарей и списков"""
+    size = sys.getsizeof(obj)
+    if isinstance(obj, dict):
+        size += sum(_deep_size(key) + _deep_size(value) for key, value in obj.items())
+    elif isinstance(obj, (list, tuple, set, frozenset)):
+        size += sum(_deep_size(item) for item in obj)
+    return size
+
+
+class _Record:
+    def __init__(self, state: Optional[str] = None, data: Optional[Dict[str, Any]] = None,
+                 updated_at: Optional[datetime] = None):
+        self.state = state
+        self.data = data or {}
+        self.updated_at = updated_at or datetime.now()
+
+    @property
+    def empty(self) -> bool:
+        return self.state is None and not self.data
+
+
+class SQLStorage(BaseStorage):
+    """Хранилище FSM в БД бота с кэшем в памяти
+
+    Чтение идет из LRU-кэша процесса, в БД - только при промахе. Запись сразу
+    меняет кэш, а в БД изменения сбрасываются пачкой раз в flush_delay секунд,
+    так что несколько update_data подряд дают одну запись. Состояние без
+    изменений дольше ttl секунд считается пустым и удаляется.
+
+    Кэш согласован, пока обновления пользователя обрабатывает один процесс
+    (в многопроцессном режиме пользователи закреплены за процессами).
+    """
+
+    def __init__(self, session_factory, cache_size: int = FSM_CACHE_SIZE,
+                 flush_delay: float = FSM_FLUSH_DELAY, ttl: float = FSM_TTL):
+        self.session_factory = session_factory
+        self.flush_delay = flush_delay
+        self.ttl = timedelta(seconds=ttl)
+        self._cache = LRUCache(cache_size)
+        # Изменения, еще не записанные в БД: {ключ: запись}
+        self._dirty: Dict[str, _Record] = {}
+        self._flush_task: Optional[asyncio.Task] = None
+        self._purged_at = datetime.min
+        self._expired_keys = LRUCache(FSM_EXPIRED_KEYS)
+
+    @staticmethod
+    def _key(key: StorageKey) -> str:
+        parts = (key.bot_id, key.chat_id, key.user_id, key.thread_id, key.business_connection_id, key.destiny)
+        return ":".join("" if part is None else str(part) for part in parts)
+
+    def _expired(self, record: _Record) -> bool:
+        return record.updated_at < datetime.now() - self.ttl
+
+    def _cached(self, key: str) -> Optional[_Record]:
+        # Несброшенное изменение могло быть вытеснено из LRU, поэтому сначала _dirty
+        return self._dirty.get(key) or self._cache.get(key)
+
+    def _expire(self, key: StorageKey, expired: _Record) -> _Record:
+        # Запоминаем истечение для SessionExpiredMiddleware и удаляем запись из БД
+        self._expired_keys.put(self._key(key), expired.state or "")
+        fsm_expired_total.inc(reason="ttl")
+        record = _Record()
+        self._write(key, record)
+        return record
+
+    def pop_expired(self, key: StorageKey) -> Optional[str]:
+        """Состояние, истекшее с прошлого обращения ("" - были только данные), или None; пометка снимается"""
+        return self._expired_keys.pop(self._key(key))
+
+    async def _load(self, key: StorageKey) -> _Record:
+        storage_key = self._key(key)
+        record = self._cached(storage_key)
+        if record is not None:
+            if self._expired(record):
+                return self._expire(key, record) if not record.empty else _Record()
+            return record
+
+        async with self.session_factory() as session:
+            row = (await session.execute(
+                select(FSMRecord.state, FSMRecord.data, FSMRecord.updated_at).where(FSMRecord.key == storage_key)
+            )).first()
+        loaded = _Record()
+        if row is not None:
+            loaded = _Record(row.state, json.loads(row.data) if row.data else {}, row.updated_at)
+
+        # Пока шел запрос, запись могла измениться в этом процессе
+        record = self._cached(storage_key)
+        if record is not None:
+            return record
+        if self._expired(loaded) and not loaded.empty:
+            return self._expire(key, loaded)
+        self._cache.put(storage_key, loaded)
+        return loaded
+
+    def _write(self, key: StorageKey, record: _Record) -> None:
+        storage_key = self._key(key)
+        self._cache.put(storage_key, record)
+        self._dirty[storage_key] = record
+        if self._flush_task is None:
+            self._flush_task = asyncio.create_task(self._flush_later())
+
+    async def _flush_later(self):
+        await asyncio.sleep(self.flush_delay)
+        self._flush_task = None
+        await self.flush()
+
+    async def flush(self) -> None:
+        """Записывает накопленные изменения в БД одной транзакцией"""
+        dirty, self._dirty = self._dirty, {}
+        if not dirty:
+            return
+        removed = [key for key, record in dirty.items() if record.empty]
+        rows = [
+            {"key": key, "state": record.state, "data": json.dumps(record.data, ensure_ascii=False),
+             "updated_at": record.updated_at}
+            for key, record in dirty.items() if not record.empty
+        ]
+        try:
+            async with self.session_factory() as session:
+                async with session.begin():
+                    for chunk in chunked(rows, FSM_FLUSH_CHUNK_SIZE):
+                        stmt = upsert_insert(session, FSMRecord).values(chunk)
+                        stmt = stmt.on_conflict_do_update(
+                            index_elements=[FSMRecord.key],
+                            set_={"state": stmt.excluded.state, "data": stmt.excluded.data,
+                                  "updated_at": stmt.excluded.updated_at}
+                        )
+                        await session.execute(stmt)
+                    if removed:
+                        await session.execute(delete(FSMRecord).where(FSMRecord.key.in_(removed)))
+                    if datetime.now() - self._purged_at > timedelta(seconds=FSM_PURGE_INTERVAL):
+                        await session.execute(delete(FSMRecord).where(FSMRecord.updated_at < datetime.now() - self.ttl))
+                        self._purged_at = datetime.now()
+        except Exception as e:
+            print(f"Failed to save FSM states: {e}")
+            # Вернем изменения в очередь, если после них не было новых
+            for key, record in dirty.items():
+                self._dirty.setdefault(key, record)
+            if self._flush_task is None:
+                self._flush_task = asyncio.create_task(self._flush_later())
+
+    async def set_state(self, key: StorageKey, state: StateType = None) -> None:
+        record = await self._load(key)
+        self._write(key, _Record(state.state if isinstance(state, State) else state, record.data))
+
+    async def get_state(self, key: StorageKey) -> Optional[str]:
+        return (await self._load(key)).state
+
+    async def set_data(self, key: StorageKey, data: Dict[str, Any]) -> None:
+        # Проверяем сериализацию сразу, чтобы ошибка была в обработчике, а не при сбросе
+        json.dumps(data)
+        record = await self._load(key)
+        self._write(key, _Record(record.state, data.copy()))
+
+    async def get_data(self, key: StorageKey) -> Dict[str, Any]:
+        return (await self._load(key)).data.copy()
+
+    async def close(self) -> None:
+        if self._flush_task is not None:
+            self._flush_task.cancel()
+            self._flush_task = None
+        await self.flush()
+
+
+class BoundedMemoryStorage(BaseStorage):
+    """Хранилище FSM в памяти процесса с ограниченным сроком жизни и объемом
+
+    Состояние, к которому не обращались дольше ttl секунд, удаляется; при
+    превышении max_entries вытесняются давно не использованные. Записи
+    упорядочены по последнему обращению, поэтому просроченные всегда в начале
+    и очистка при каждой записи стоит O(1) в среднем. Число записей и
+    примерный объем в байтах экспортируются в метрики и доступны через memory_usage().
+    """
+
+    def __init__(self, max_entries: int = FSM_MAX_ENTRIES, ttl: float = FSM_TTL):
+        self.max_entries = max_entries
+        self.ttl = timedelta(seconds=ttl)
+        # {ключ: (запись, размер в байтах)}, от давно не использованных к недавним
+        self._records: OrderedDict[StorageKey, Tuple[_Record, int]] = OrderedDict()
+        self._bytes = 0
+        self._expired_keys = LRUCache(FSM_EXPIRED_KEYS)
+
+    def _drop(self, key: StorageKey, reason: str) -> None:
+        record, size = self._records.pop(key)
+        self._bytes -= size
+        self._expired_keys.put(key, record.state or "")
+        fsm_expired_total.inc(reason=reason)
+
+    def _sweep(self, now: datetime) -> None:
+        deadline = now - self.ttl
+        while self._records:
+            key, (record, _) = next(iter(self._records.items()))
+            if record.updated_at >= deadline:
+                break
+            self._drop(key, "ttl")
+
+    def _report(self) -> None:
+        fsm_entries.set(len(self._records))
+        fsm_memory_bytes.set(self._bytes)
+
+    def _load(self, key: StorageKey) -> _Record:
+        entry = self._records.get(key)
+        if entry is None:
+            return _Record()
+        record = entry[0]
+        now = datetime.now()
+        if record.updated_at < now - self.ttl:
+            self._drop(key, "ttl")
+            return _Record()
+        # Срок считается от последнего обращения, а не от последнего изменения
+        record.updated_at = now
+        self._records.move_to_end(key)
+        return record
+
+    def _write(self, key: StorageKey, record: _Record) -> None:
+        entry = self._records.pop(key, None)
+        if entry is not None:
+            self._bytes -= entry[1]
+        if not record.empty:
+            size = _deep_size(record.state) + _deep_size(record.data)
+            self._records[key] = (record, size)
+            self._bytes += size
+            while len(self._records) > self.max_entries:
+                self._drop(next(iter(self._records)), "size")
+        # Просроченные удаляются при записи: чтение проверяет только свою запись
+        self._sweep(record.updated_at)
+        self._report()
+
+    def memory_usage(self) -> Dict[str, int]:
+        """Текущее число состояний и их примерный объем в байтах"""
+        self._sweep(datetime.now())
+        self._report()
+        return {"entries": len(self._records), "bytes": self._bytes}
+
+    def pop_expired(self, key: StorageKey) -> Optional[str]:
+        """Состояние, истекшее или вытесненное с прошлого обращения ("" - были только данные), или None"""
+        return self._expired_keys.pop(key)
+
+    async def set_state(self, key: StorageKey, state: StateType = None) -> None:
+        record = self._load(key)
+        self._write(key, _Record(state.state if isinstance(state, State) else state, record.data))
+
+    async def get_state(self, key: StorageKey) -> Optional[str]:
+        return self._load(key).state
+
+    async def set_data(self, key: StorageKey, data: Dict[str, Any]) -> None:
+        record = self._load(key)
+        self._write(key, _Record(record.state, data.copy()))
+
+    async def get_data(self, key: StorageKey) -> Dict[str, Any]:
+        return self._load(key).data.copy()
+
+    async def close(self) -> None:
+        pass
+
+
+class KeyEventIsolation(BaseEventIsolation):
+    """Обработка обновлений одного ключа FSM по очереди
+
+    Блокировка берется в FSMContextMiddleware до чтения состояния, поэтому
+    следующее обновление пользователя видит состояние, установленное предыдущим.
+    Блокировка удаляется, когда обновлений ключа в работе и в ожидании не осталось.
+    """
+
+    def __init__(self):
+        # ключ -> [блокировка, число обновлений ключа в работе и в ожидании]
+        self._locks: Dict[StorageKey, list] = {}
+
+    @asynccontextmanager
+    async def lock(self, key: StorageKey) -> AsyncIterator[None]:
+        entry = self._locks.get(key)
+        if entry is None:
+            entry = self._locks[key] = [asyncio.Lock(), 0]
+        entry[1] += 1
+        try:
+            async with entry[0]:
+                yield
+        finally:
+            entry[1] -= 1
+            if entry[1] == 0:
+                del self._locks[key]
+
+    async def close(self) -> None:
+        self._locks.clear()
+
+
+def create_storage(session_factory) -> BaseStorage:
+    """Хранилище FSM по настройке FSM_STORAGE"""
+    if FSM_STORAGE == "memory":
+        return BoundedMemoryStorage()
+    return SQLStorage(session_factory)
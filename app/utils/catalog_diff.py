@@ -0,0 +1,48 @@
+import pandas as pd
+
+
+def diff_catalog(current_rows: dict[int, dict], incoming_rows: list[dict], columns: tuple) -> dict:
+    """Сравнивает загружаемый каталог с текущим по колонкам
+
+    Args:
+        current_rows: Текущие товары из БД, {id: {колонка: значение}}
+        incoming_rows: Строки из Excel (строки без 'id' считаются новыми)
+        columns: Сравниваемые колонки
+
+    Returns:
+        Словарь с ключами:
+            created   - строки новых товаров
+            updated   - строки изменённых товаров
+            unchanged - количество товаров без изменений
+            changes   - {id: {колонка: (старое, новое)}} для изменённых товаров
+    """
+    incoming = pd.DataFrame(incoming_rows, columns=['id', *columns], dtype=object)
+    new_mask = incoming['id'].isna()
+    created = [incoming_rows[i] for i in incoming.index[new_mask]]
+
+    # Последняя строка с одинаковым ID побеждает
+    keyed = incoming[~new_mask].drop_duplicates('id', keep='last')
+    keyed_positions = dict(zip(keyed['id'].astype(int), keyed.index))
+    keyed = keyed.set_index(keyed['id'].astype(int)).drop(columns='id')
+
+    current = pd.DataFrame.from_dict(current_rows, orient='index', columns=list(columns), dtype=object)
+    exists = keyed.index.isin(current.index)
+    created += [incoming_rows[keyed_positions[pid]] for pid in keyed.index[~exists]]
+
+    new = keyed[exists]
+    old = current.reindex(new.index)
+
+    # Ячейка изменилась, если значения различаются и они не оба пустые
+    differs = (old != new) & ~(old.isna() & new.isna())
+    changed_ids = differs.index[differs.any(axis=1)]
+
+    changes = {}
+    for pid, column in differs.loc[changed_ids].stack().loc[lambda cells: cells].index:
+        changes.setdefault(int(pid), {})[column] = (old.at[pid, column], new.at[pid, column])
+
+    return {
+        "created": created,
+        "updated": [incoming_rows[keyed_positions[pid]] for pid in changed_ids],
+        "unchanged": len(new) - len(changed_ids),
+        "changes": changes,
+    }
@@ -0,0 +1,105 @@
+import asyncio
+import io
+from typing import AsyncIterator, Sequence
+from openpyxl import Workbook
+from openpyxl.cell import WriteOnlyCell
+from openpyxl.styles import Font, PatternFill
+from openpyxl.utils import get_column_letter
+
+# Сколько строк забирается из БД за один раз
+EXPORT_BATCH_SIZE = 1000
+
+# По скольким первым строкам считается ширина колонок
+WIDTH_SAMPLE_SIZE = 200
+MAX_COLUMN_WIDTH = 50
+
+HEADER_FONT = Font(bold=True)
+HEADER_FILL = PatternFill(start_color="DAEEF3", end_color="DAEEF3", fill_type="solid")
+
+
+def _column_widths(headers: Sequence[str], sample: Sequence[Sequence]) -> list[int]:
+    widths = [len(str(header)) for header in headers]
+    for row in sample:
+        for index, value in enumerate(row):
+            if value is not None:
+                widths[index] = max(widths[index], len(str(value)))
+    return [min(width + 2, MAX_COLUMN_WIDTH) for width in widths]
+
+
+class XlsxStreamWriter:
+    """Потоковая запись Excel в режиме write-only
+
+    Строки сразу сериализуются во временный файл openpyxl и не хранятся в памяти,
+    поэтому память не зависит от количества строк. Запись выполняется в потоке,
+    чтобы не блокировать цикл событий. Ширина колонок задается до первой строки,
+    поэтому считается по первым строкам выгрузки.
+    """
+
+    def __init__(self):
+        self.workbook = Workbook(write_only=True)
+
+    def _header(self, sheet, headers: Sequence[str]) -> list[WriteOnlyCell]:
+        cells = []
+        for header in headers:
+            cell = WriteOnlyCell(sheet, value=header)
+            cell.font = HEADER_FONT
+            cell.fill = HEADER_FILL
+            cells.append(cell)
+        return cells
+
+    def _start_sheet(self, title: str, headers: Sequence[str], widths: Sequence[int]):
+        sheet = self.workbook.create_sheet(title)
+        for index, width in enumerate(widths, start=1):
+            sheet.column_dimensions[get_column_letter(index)].width = width
+        sheet.append(self._header(sheet, headers))
+        return sheet
+
+    @staticmethod
+    def _append_rows(sheet, rows: Sequence[Sequence]) -> None:
+        for row in rows:
+            sheet.append(row)
+
+    async def write_sheet(self, title: str, headers: Sequence[str],
+                          batches: AsyncIterator[Sequence[Sequence]]) -> int:
+        """Пишет лист из асинхронного потока пачек строк
+
+        Args:
+            title: Название листа
+            headers: Заголовки колонок
+            batches: Пачки строк (значения в порядке заголовков)
+
+        Returns:
+            Количество записанных строк
+        """
+        sheet = None
+        pending = []
+        written = 0
+
+        async for batch in batches:
+            if sheet is None:
+                # Копим строки, пока не наберется выборка для ширины колонок
+                pending.extend(batch)
+                if len(pending) < WIDTH_SAMPLE_SIZE:
+                    continue
+                sheet = self._start_sheet(title, headers, _column_widths(headers, pending[:WIDTH_SAMPLE_SIZE]))
+                batch, pending = pending, []
+            await asyncio.to_thread(self._append_rows, sheet, batch)
+            written += len(batch)
+
+        if sheet is None:
+            sheet = self._start_sheet(title, headers, _column_widths(headers, pending))
+            self._append_rows(sheet, pending)
+            written += len(pending)
+        return written
+
+    def write_static_sheet(self, title: str, headers: Sequence[str], rows: Sequence[Sequence],
+                           widths: Sequence[int]) -> None:
+        """Пишет небольшой лист целиком (например, инструкцию)"""
+        sheet = self._start_sheet(title, headers, widths)
+        self._append_rows(sheet, rows)
+
+    async def to_bytes(self) -> bytes:
+        """Закрывает книгу и возвращает содержимое файла"""
+        output = io.BytesIO()
+        await asyncio.to_thread(self.workbook.save, output)
+        return output.getvalue()
@@ -7,182 +7,312 @@ from app.database.models import User, AnonymousQuestion
 from app.database.database import AsyncSession
 from openpyxl import load_workbook
 from openpyxl.utils import get_column_letter
-from datetime import datetime
+from datetime import datetime, date
 from app.repositories.catalog_repo import CatalogRepo
+from app.repositories.user_repo import UserRepo
 import re
 from openpyxl.styles import Font, PatternFill
+from sqlalchemy import select
+from contextlib import aclosing
+from app.utils.job_runner import excel_jobs, JobQueueFull
+from app.utils.excel_stream import XlsxStreamWriter
 
-def user_create_excel_file(users: list[User]) -> bytes:
-    # Словарь соответствия английских и русских названий полей
-    field_mapping = {
-        "Full Name": "ФИО",
-        "Username": "Имя пользователя",
-        "Telegram ID": "ID Telegram",
-        "T-Points": "T-Points",
-        "Department": "Отдел",
-        "Post": "Должность",
-        "Birth Date": "Дата рождения",
-        "Hire Date": "Дата приема на работу",
-        "Active": "Активен (1-да, 0-нет)"
-    }
-    
-    # Словарь с описаниями полей и форматами
-    field_descriptions = {
-        "ФИО": "Полное имя сотрудника",
-        "Имя пользователя": "Имя пользователя в Telegram (без символа @)",
-        "ID Telegram": "Уникальный идентификатор Telegram пользователя (числовой)",
-        "T-Points": "Количество T-Points на балансе пользователя",
-        "Отдел": "Наименование отдела сотрудника",
-        "Должность": "Должность сотрудника",
-        "Дата рождения": "Дата рождения в формате ГГГГ-ММ-ДД",
-        "Дата приема на работу": "Дата приема на работу в формате ГГГГ-ММ-ДД",
-        "Активен (1-да, 0-нет)": "Флаг активности пользователя: 1 - активен, 0 - неактивен"
-    }
-
-    data = [
-        {
-            field_mapping["Full Name"]: user.fullname,
-            field_mapping["Username"]: user.username or "",
-            field_mapping["Telegram ID"]: user.telegram_id,
-            field_mapping["T-Points"]: user.tpoints,
-            field_mapping["Department"]: user.department or "",
-            field_mapping["Post"]: user.post or "",
-            field_mapping["Birth Date"]: user.birth_date,
-            field_mapping["Hire Date"]: user.hire_date,
-            field_mapping["Active"]: int(user.is_active),
-        }
-        for user in users
+# Количество строк, которые читаются из Excel и пишутся в БД за один раз
+EXCEL_CHUNK_SIZE = 1000
+
+
+class ExcelFormatError(ValueError):
+    """Файл Excel не соответствует ожидаемому формату"""
+
+
+def iter_excel_chunks(source, column_mapping: dict, chunk_size: int = EXCEL_CHUNK_SIZE, required=()):
+    """Потоково читает первый лист Excel в режиме read-only
+
+    Заголовки переименовываются по column_mapping (неизвестные остаются как есть),
+    пустые строки пропускаются. Каждая строка - словарь, в '_row' номер строки в файле.
+    В памяти одновременно находится не больше chunk_size строк.
+
+    Args:
+        source: Путь к файлу, содержимое файла (bytes) или файловый объект
+        column_mapping: Соответствие заголовков файла внутренним именам полей
+        chunk_size: Количество строк в одной части
+        required: Обязательные поля (внутренние имена)
+
+    Yields:
+        Списки словарей длиной не больше chunk_size
+    """
+    if isinstance(source, bytes):
+        source = io.BytesIO(source)
+    workbook = load_workbook(source, read_only=True, data_only=True)
+    try:
+        rows = workbook.worksheets[0].iter_rows(values_only=True)
+        header = next(rows, None) or ()
+        names = [
+            column_mapping.get(str(cell).strip(), str(cell).strip()) if cell is not None else None
+            for cell in header
+        ]
+
+        missing = [field for field in required if field not in names]
+        if missing:
+            reverse_mapping = {en: ru for ru, en in column_mapping.items()}
+            missing_ru = [reverse_mapping.get(field, field) for field in missing]
+            raise ExcelFormatError(f"Отсутствуют столбцы: {', '.join(missing_ru)}")
+
+        chunk = []
+        for row_number, values in enumerate(rows, start=2):
+            if all(value is None or value == "" for value in values):
+                continue
+            record = {name: value for name, value in zip(names, values) if name}
+            record["_row"] = row_number
+            chunk.append(record)
+            if len(chunk) >= chunk_size:
+                yield chunk
+                chunk = []
+        if chunk:
+            yield chunk
+    finally:
+        workbook.close()
+
+
+def _to_date(value):
+    """Приводит значение ячейки с датой к date (или None)"""
+    if value is None or value == "":
+        return None
+    if isinstance(value, datetime):
+        return value.date()
+    if isinstance(value, date):
+        return value
+    return pd.to_datetime(value).date()
+
+
+# Заголовки выгрузки сотрудников (совпадают с шаблоном импорта) и их описания
+USER_EXPORT_HEADERS = ("ФИО", "Имя пользователя", "ID Telegram", "T-Points", "Отдел", "Должность",
+                       "Дата рождения", "Дата приема на работу", "Активен (1-да, 0-нет)")
+
+USER_FIELD_DESCRIPTIONS = {
+    "ФИО": "Полное имя сотрудника",
+    "Имя пользователя": "Имя пользователя в Telegram (без символа @)",
+    "ID Telegram": "Уникальный идентификатор Telegram пользователя (числовой)",
+    "T-Points": "Количество T-Points на балансе пользователя",
+    "Отдел": "Наименование отдела сотрудника",
+    "Должность": "Должность сотрудника",
+    "Дата рождения": "Дата рождения в формате ГГГГ-ММ-ДД",
+    "Дата приема на работу": "Дата приема на работу в формате ГГГГ-ММ-ДД",
+    "Активен (1-да, 0-нет)": "Флаг активности пользователя: 1 - активен, 0 - неактивен"
+}
+
+ORDER_EXPORT_HEADERS = ("ID заказа", "Дата", "ID Telegram", "ФИО", "Отдел", "Сумма", "Статус", "Товаров, шт.")
+
+ORDER_STATUS_LABELS = {
+    "pending": "Новый",
+    "completed": "Выполнен",
+    "cancelled": "Отменен",
+}
+
+TPOINTS_EXPORT_HEADERS = ("ID", "Дата", "ID Telegram", "ФИО", "Сумма", "ID заказа", "Товар", "Комментарий")
+
+
+async def users_excel_from_batches(batches) -> bytes:
+    """Строит выгрузку сотрудников из потока строк UserRepo.iter_users_for_export"""
+    async def rows():
+        async for batch in batches:
+            yield [
+                (fullname, username or "", telegram_id, tpoints, department or "", post or "",
+                 birth_date, hire_date, int(bool(is_active)))
+                for fullname, username, telegram_id, tpoints, department, post, birth_date, hire_date, is_active
+                in batch
+            ]
+
+    writer = XlsxStreamWriter()
+    await writer.write_sheet("Пользователи", USER_EXPORT_HEADERS, rows())
+    writer.write_static_sheet("Инструкция", ("Поле", "Описание"), list(USER_FIELD_DESCRIPTIONS.items()), (30, 100))
+    return await writer.to_bytes()
+
+
+async def orders_excel_from_batches(batches) -> bytes:
+    """Строит выгрузку заказов из потока строк OrderRepo.iter_orders_for_export"""
+    async def rows():
+        async for batch in batches:
+            yield [
+                (*row[:6], ORDER_STATUS_LABELS.get(row[6], row[6]), row[7])
+                for row in batch
+            ]
+
+    writer = XlsxStreamWriter()
+    await writer.write_sheet("Заказы", ORDER_EXPORT_HEADERS, rows())
+    return await writer.to_bytes()
+
+
+async def tpoints_excel_from_batches(batches) -> bytes:
+    """Строит выгрузку истории T-points из потока строк UserRepo.iter_tpoints_for_export"""
+    writer = XlsxStreamWriter()
+    await writer.write_sheet("T-Points", TPOINTS_EXPORT_HEADERS, batches)
+    return await writer.to_bytes()
+
+
+# Соответствие русских и английских названий полей сотрудника
+USER_FIELD_MAPPING = {
+    "ФИО": "Full Name",
+    "Имя пользователя": "Username",
+    "ID Telegram": "Telegram ID",
+    "T-Points": "T-Points",
+    "Отдел": "Department",
+    "Должность": "Post",
+    "Дата рождения": "Birth Date",
+    "Дата приема на работу": "Hire Date",
+    "Активен (1-да, 0-нет)": "Active"
+}
+
+
+# Поля сотрудника в Excel и соответствующие поля модели User
+USER_COLUMN_FIELDS = {
+    "Telegram ID": "telegram_id",
+    "Full Name": "fullname",
+    "Username": "username",
+    "T-Points": "tpoints",
+    "Department": "department",
+    "Post": "post",
+    "Birth Date": "birth_date",
+    "Hire Date": "hire_date",
+    "Active": "is_active",
+    "Role": "role",
+}
+
+_TRUE_VALUES = {"1", "true", "да", "yes"}
+_FALSE_VALUES = {"0", "false", "нет", "no"}
+
+
+def _text_column(column: pd.Series) -> pd.Series:
+    """Текстовая колонка: числа без '.0', пустые строки - None"""
+    numeric = pd.to_numeric(column, errors="coerce")
+    whole = numeric.notna() & (numeric % 1 == 0)
+    text = column.where(~whole, numeric.where(whole).astype("Int64").astype(str))
+    text = text.where(text.isna(), text.astype(str).str.strip())
+    return text.where(text.notna() & (text != ""), None)
+
+
+def _date_column(column: pd.Series) -> tuple[pd.Series, pd.Series]:
+    """Колонка дат: (значения date или None, маска некорректных ячеек)"""
+    parsed = pd.to_datetime(column.map(lambda value: value if value != "" else None), errors="coerce")
+    invalid = column.notna() & (column != "") & parsed.isna()
+    return parsed.dt.date.astype(object).where(parsed.notna(), None), invalid
+
+
+def coerce_user_rows(records: list[dict]) -> tuple[list[dict], list[str]]:
+    """Приводит строки сотрудников к полям модели User разом для всей части
+
+    Args:
+        records: Строки Excel с английскими заголовками (см. USER_FIELD_MAPPING),
+            номер строки файла - в '_row' (если есть)
+
+    Returns:
+        (users_data, error_messages): корректные строки в виде словарей с полями модели
+        и сообщения о строках, которые пропущены из-за ошибок
+    """
+    if not records:
+        return [], []
+
+    df = pd.DataFrame(records, dtype=object)
+    df = df.reindex(columns=[*USER_COLUMN_FIELDS, "_row"]).astype(object)
+    df = df.where(df.notna(), None)
+    if df["_row"].isna().all():
+        df["_row"] = range(2, len(df) + 2)
+
+    out = pd.DataFrame(index=df.index)
+    invalid = {}
+
+    telegram_id = pd.to_numeric(df["Telegram ID"], errors="coerce")
+    invalid["Telegram ID"] = telegram_id.isna() | (telegram_id % 1 != 0)
+    out["telegram_id"] = telegram_id
+
+    out["fullname"] = _text_column(df["Full Name"])
+    invalid["Full Name"] = out["fullname"].isna()
+
+    tpoints = pd.to_numeric(df["T-Points"], errors="coerce")
+    invalid["T-Points"] = df["T-Points"].notna() & (tpoints.isna() | (tpoints % 1 != 0))
+    out["tpoints"] = tpoints.fillna(0)
+
+    for column in ("Username", "Department", "Post"):
+        out[USER_COLUMN_FIELDS[column]] = _text_column(df[column])
+
+    for column in ("Birth Date", "Hire Date"):
+        out[USER_COLUMN_FIELDS[column]], invalid[column] = _date_column(df[column])
+
+    active_text = _text_column(df["Active"]).str.lower()
+    invalid["Active"] = active_text.notna() & ~active_text.isin(_TRUE_VALUES | _FALSE_VALUES)
+    out["is_active"] = active_text.isna() | active_text.isin(_TRUE_VALUES)
+
+    has_role = "Role" in records[0]
+    if has_role:
+        out["role"] = _text_column(df["Role"]).fillna("user")
+
+    invalid = pd.DataFrame(invalid)
+    bad_rows = invalid.any(axis=1)
+
+    reverse_mapping = {en: ru for ru, en in USER_FIELD_MAPPING.items()}
+    error_messages = [
+        f"Ошибка в строке {df.at[index, '_row']} (Telegram ID {df.at[index, 'Telegram ID'] or 'неизвестно'}): "
+        f"некорректное значение в столбцах {', '.join(reverse_mapping.get(c, c) for c in invalid.columns[invalid.loc[index]])}"
+        for index in invalid.index[bad_rows]
     ]
-    
-    df = pd.DataFrame(data)
-    
-    # Create description DataFrame
-    desc_data = []
-    for field, description in field_descriptions.items():
-        desc_data.append({
-            'Поле': field,
-            'Описание': description
-        })
-    df_desc = pd.DataFrame(desc_data)
-    
-    output = io.BytesIO()
-    
-    with pd.ExcelWriter(output, engine='openpyxl') as writer:
-        df.to_excel(writer, index=False, sheet_name='Пользователи')
-        df_desc.to_excel(writer, index=False, sheet_name='Инструкция')
-        
-        # Adjust column widths for users sheet
-        worksheet = writer.sheets['Пользователи']
-        for idx, col in enumerate(df.columns):
-            column_width = max(df[col].astype(str).map(len).max(), len(col)) + 2
-            worksheet.column_dimensions[get_column_letter(idx + 1)].width = min(column_width, 50)
-        
-        # Adjust column widths for description sheet
-        worksheet = writer.sheets['Инструкция']
-        worksheet.column_dimensions['A'].width = 30
-        worksheet.column_dimensions['B'].width = 100
-        
-        # Style the headers in both sheets
-        for sheet in [worksheet, writer.sheets['Пользователи']]:
-            for cell in sheet[1]:
-                cell.font = Font(bold=True)
-                cell.fill = PatternFill(start_color="DAEEF3", end_color="DAEEF3", fill_type="solid")
-    
-    output.seek(0)
-    return output.getvalue()
 
+    good = out[~bad_rows].astype(object)
+    good["telegram_id"] = good["telegram_id"].astype(int)
+    good["tpoints"] = good["tpoints"].astype(int)
+    good["is_active"] = good["is_active"].astype(bool)
+    return good.to_dict("records"), error_messages
+
+
+def read_user_chunks(source, chunk_size: int = EXCEL_CHUNK_SIZE):
+    """Читает и приводит к типам строки сотрудников по частям (выполняется в процессе пула)
 
-async def parse_excel_file(file_path: str, db: AsyncSession) -> dict:
-    print(f"[DEBUG] parse_excel_file вызвана с путем: {file_path}")
+    Yields:
+        (users_data, error_messages, rows_read) для каждой части
+    """
+    rows_read = 0
+    for chunk in iter_excel_chunks(source, USER_FIELD_MAPPING, chunk_size, required=["Full Name", "Telegram ID"]):
+        users_data, error_messages = coerce_user_rows(chunk)
+        rows_read += len(chunk)
+        yield users_data, error_messages, rows_read
+
+
+async def parse_excel_file(source, db: AsyncSession, progress=None) -> dict:
+    """Импортирует сотрудников из Excel
+
+    Args:
+        source: Содержимое файла (bytes) или путь к нему
+        db: Сессия БД
+        progress: Необязательная корутина, получающая количество прочитанных строк
+    """
     try:
-        # Проверка существования файла
-        if not os.path.exists(file_path):
-            print(f"[ERROR] Файл не существует: {file_path}")
+        if isinstance(source, str) and not os.path.exists(source):
+            print(f"[ERROR] Файл не существует: {source}")
             return {"success": False, "message": "Файл не найден"}
             
-        print(f"Начинаем обработку файла: {file_path}")
-        
-        # Словарь соответствия русских и английских названий полей
-        reverse_field_mapping = {
-            "ФИО": "Full Name",
-            "Имя пользователя": "Username",
-            "ID Telegram": "Telegram ID",
-            "T-Points": "T-Points",
-            "Отдел": "Department",
-            "Должность": "Post",
-            "Дата рождения": "Birth Date",
-            "Дата приема на работу": "Hire Date",
-            "Активен (1-да, 0-нет)": "Active"
-        }
-        
-        # Читаем Excel с обработкой дат
-        df = pd.read_excel(file_path, parse_dates=["Дата рождения", "Дата приема на работу", "Birth Date", "Hire Date"])
-        print(f"Файл успешно прочитан. Найдено {len(df)} записей")
-        print(f"Columns: {df.columns.tolist()}")
-        
-        # Выводим первые несколько строк для проверки
-        print("Пример данных:")
-        print(df.head(2))
-        
-        # Переименовываем столбцы с русского на английский для обработки
-        rename_dict = {ru: en for ru, en in reverse_field_mapping.items() if ru in df.columns}
-        if rename_dict:
-            df = df.rename(columns=rename_dict)
-        
-        # Проверяем наличие всех необходимых столбцов
-        required_columns = ["Full Name", "Telegram ID"]
-        missing_columns = [col for col in required_columns if col not in df.columns]
-        if missing_columns:
-            # Переводим названия обратно на русский для понятной ошибки
-            missing_ru = [list(reverse_field_mapping.keys())[list(reverse_field_mapping.values()).index(col)] for col in missing_columns]
-            print(f"ОШИБКА: Отсутствуют столбцы: {', '.join(missing_ru)}")
-            return {"success": False, "message": f"Отсутствуют столбцы: {', '.join(missing_ru)}"}
+        print("Начинаем обработку файла")
         
+        user_repo = UserRepo(db)
+
         # Счетчики
         updated = 0
-        errors = 0
         error_messages = []
         
         print("Начинаем обработку записей...")
-        # Обрабатываем каждую строку
-        for index, row in df.iterrows():
-            try:
-                telegram_id = row["Telegram ID"]
-                print(f"Обработка записи {index+1}/{len(df)}: Telegram ID {telegram_id}")
+        # Файл разбирается в отдельном процессе, здесь только запись в БД
+        async with aclosing(excel_jobs.stream(read_user_chunks, source)) as chunks:
+            async for users_data, chunk_errors, rows_read in chunks:
+                error_messages += chunk_errors
+                report = await user_repo.bulk_upsert_users(users_data)
+                updated += report["created"] + report["updated"]
+                error_messages += [
+                    f"Ошибка при сохранении (Telegram ID {telegram_id}): {error}"
+                    for telegram_id, error in report["failed"]
+                ]
                 
-                # Используем select вместо query
-                from sqlalchemy import select
-                from app.database.models import User
-                
-                # Получаем пользователя по Telegram ID или создаем нового
-                stmt = select(User).where(User.telegram_id == telegram_id)
-                result = await db.execute(stmt)
-                user = result.scalar_one_or_none()
-                
-                if not user:
-                    print(f"Создаем нового пользователя с Telegram ID {telegram_id}")
-                    user = User(telegram_id=telegram_id)
-                    db.add(user)
-                else:
-                    print(f"Обновляем существующего пользователя с Telegram ID {telegram_id}")
-                
-                # Обновляем данные пользователя
-                user.fullname = row["Full Name"]
-                user.username = row["Username"] if not pd.isna(row.get("Username", None)) else None
-                user.tpoints = int(row["T-Points"]) if not pd.isna(row.get("T-Points", None)) else 0
-                user.department = row["Department"] if not pd.isna(row.get("Department", None)) else None
-                user.post = row["Post"] if not pd.isna(row.get("Post", None)) else None
-                user.birth_date = row["Birth Date"] if not pd.isna(row.get("Birth Date", None)) else None
-                user.hire_date = row["Hire Date"] if not pd.isna(row.get("Hire Date", None)) else None
-                user.is_active = bool(row["Active"]) if not pd.isna(row.get("Active", None)) else True
-                
-                print(f"Данные пользователя успешно обновлены")
-                updated += 1
-            except Exception as e:
-                errors += 1
-                error_message = f"Ошибка в строке {index+1} (Telegram ID {row.get('Telegram ID', 'неизвестно')}): {str(e)}"
-                print(f"ОШИБКА: {error_message}")
-                error_messages.append(error_message)
+                if progress:
+                    await progress(rows_read)
+        
+        errors = len(error_messages)
         
         # Сохраняем изменения в базе данных
         print(f"Сохраняем изменения в базе данных...")
@@ -201,6 +331,10 @@ async def parse_excel_file(file_path: str, db: AsyncSession) -> dict:
         print(f"Результат импорта: {result}")
         return result
     
+    except (ExcelFormatError, JobQueueFull) as e:
+        print(f"ОШИБКА: {str(e)}")
+        await db.rollback()
+        return {"success": False, "message": str(e)}
     except Exception as e:
         print(f"КРИТИЧЕСКАЯ ОШИБКА при импорте: {str(e)}")
         await db.rollback()  # Асинхронный метод rollback
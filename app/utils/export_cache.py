@@ -0,0 +1,82 @@
+from typing import Awaitable, Callable, Optional
+from aiogram.types import BufferedInputFile, Message
+from aiogram.exceptions import TelegramBadRequest
+
+
+class CachedExport:
+    def __init__(self, version: tuple, data: bytes, filename: str):
+        self.version = version
+        self.data: Optional[bytes] = data
+        self.filename = filename
+        self.file_id: Optional[str] = None
+
+
+class ExportCache:
+    """Кэш выгрузок по версии данных
+
+    Для каждой выгрузки хранится последний построенный файл. Пока Telegram не вернул
+    file_id, хранятся байты файла; после первой отправки файл переотправляется по file_id,
+    а байты освобождаются.
+    """
+
+    def __init__(self):
+        self._entries: dict[str, CachedExport] = {}
+
+    def get(self, name: str, version: tuple) -> Optional[CachedExport]:
+        entry = self._entries.get(name)
+        if entry is None or entry.version != version:
+            return None
+        return entry
+
+    def put(self, name: str, version: tuple, data: bytes, filename: str) -> CachedExport:
+        entry = CachedExport(version, data, filename)
+        self._entries[name] = entry
+        return entry
+
+    def invalidate(self, name: str) -> None:
+        self._entries.pop(name, None)
+
+
+export_cache = ExportCache()
+
+
+async def send_cached_export(
+    message: Message,
+    name: str,
+    version: tuple,
+    build: Callable[[], Awaitable[bytes]],
+    filename: str,
+    caption: str = None
+) -> Message:
+    """Отправляет выгрузку, по возможности без повторной генерации и загрузки файла
+
+    Args:
+        message: Сообщение, в чат которого отправляется файл
+        name: Имя выгрузки в кэше
+        version: Версия данных, полученная до чтения данных (см. table_version)
+        build: Корутина-фабрика, строящая файл
+        filename: Имя файла для новой выгрузки
+        caption: Подпись к документу
+    """
+    entry = export_cache.get(name, version)
+
+    if entry is not None and entry.file_id:
+        try:
+            return await message.answer_document(entry.file_id, caption=caption)
+        except TelegramBadRequest as e:
+            # file_id больше недействителен - строим файл заново
+            print(f"Telegram error: {e}")
+            export_cache.invalidate(name)
+            entry = None
+
+    if entry is None:
+        entry = export_cache.put(name, version, await build(), filename)
+
+    sent = await message.answer_document(
+        BufferedInputFile(entry.data, filename=entry.filename),
+        caption=caption
+    )
+    if sent.document:
+        entry.file_id = sent.document.file_id
+        entry.data = None
+    return sent
@@ -0,0 +1,136 @@
+import asyncio
+import multiprocessing
+import os
+import queue
+from concurrent.futures import ProcessPoolExecutor
+from typing import Any, AsyncIterator, Callable
+
+# Количество процессов для обработки Excel и максимальное число задач в работе и в очереди
+EXCEL_MAX_WORKERS = int(os.getenv("EXCEL_MAX_WORKERS", "2"))
+EXCEL_MAX_PENDING = int(os.getenv("EXCEL_MAX_PENDING", "4"))
+
+# Сколько готовых частей может ждать в очереди между процессом и циклом событий
+STREAM_BUFFER_SIZE = 2
+
+# Как долго поток ждёт очередную часть, прежде чем проверить, не отменено ли чтение (сек.)
+STREAM_POLL_INTERVAL = 1.0
+
+_ITEM, _DONE, _ERROR = "item", "done", "error"
+
+
+class JobQueueFull(Exception):
+    """Очередь задач переполнена, новую задачу принять нельзя"""
+
+
+def _stream_worker(func: Callable, channel, cancelled, *args) -> None:
+    """Выполняется в процессе пула: передаёт элементы генератора в очередь"""
+    try:
+        for item in func(*args):
+            # Ждём место в очереди, но прекращаем работу, если получатель ушёл
+            while True:
+                if cancelled.is_set():
+                    return
+                try:
+                    channel.put((_ITEM, item), timeout=1)
+                    break
+                except queue.Full:
+                    continue
+        channel.put((_DONE, None))
+    except BaseException as e:
+        channel.put((_ERROR, e))
+
+
+def _drain(channel) -> None:
+    """Освобождает очередь, чтобы процесс не ждал места для следующей части"""
+    try:
+        while True:
+            channel.get_nowait()
+    except Exception:
+        # queue.Empty или менеджер очередей уже остановлен
+        pass
+
+
+class ExcelJobRunner:
+    """Выполняет разбор и генерацию Excel в пуле процессов, не блокируя цикл событий
+
+    Пул и менеджер очередей создаются при первой задаче. Одновременно в работе и в
+    ожидании может быть не больше max_pending задач, остальные сразу отклоняются.
+    """
+
+    def __init__(self, max_workers: int = EXCEL_MAX_WORKERS, max_pending: int = EXCEL_MAX_PENDING):
+        self.max_workers = max_workers
+        self.max_pending = max_pending
+        self.pending = 0
+        self._executor = None
+        self._manager = None
+
+    def _ensure_started(self):
+        if self._executor is None:
+            # spawn: дочерние процессы не наследуют потоки и соединения с БД
+            context = multiprocessing.get_context("spawn")
+            self._executor = ProcessPoolExecutor(max_workers=self.max_workers, mp_context=context)
+            self._manager = context.Manager()
+
+    def _acquire(self):
+        if self.pending >= self.max_pending:
+            raise JobQueueFull("Слишком много задач с Excel, попробуйте позже")
+        self._ensure_started()
+        self.pending += 1
+
+    async def run(self, func: Callable, *args) -> Any:
+        """Выполняет func(*args) в процессе пула и возвращает результат"""
+        self._acquire()
+        try:
+            loop = asyncio.get_running_loop()
+            return await loop.run_in_executor(self._executor, func, *args)
+        finally:
+            self.pending -= 1
+
+    async def stream(self, func: Callable, *args) -> AsyncIterator[Any]:
+        """Выполняет генератор func(*args) в процессе пула и отдаёт его элементы по мере готовности
+
+        Очередь между процессами ограничена, поэтому процесс не убегает вперёд
+        медленного потребителя и память остаётся ограниченной.
+        """
+        self._acquire()
+        loop = asyncio.get_running_loop()
+        channel = self._manager.Queue(maxsize=STREAM_BUFFER_SIZE)
+        cancelled = self._manager.Event()
+        future = loop.run_in_executor(self._executor, _stream_worker, func, channel, cancelled, *args)
+        try:
+            while True:
+                # Ожидание ограничено по времени: если потребителя отменят, поток
+                # пула не останется навсегда заблокированным в get
+                try:
+                    kind, payload = await loop.run_in_executor(None, channel.get, True, STREAM_POLL_INTERVAL)
+                except queue.Empty:
+                    if not future.done():
+                        continue
+                    # Процесс завершился: итог уже в очереди или процесс упал, не отправив его
+                    try:
+                        kind, payload = channel.get_nowait()
+                    except queue.Empty:
+                        await future
+                        raise RuntimeError("Задача Excel завершилась без результата")
+                if kind == _DONE:
+                    break
+                if kind == _ERROR:
+                    raise payload
+                yield payload
+            await future
+        finally:
+            cancelled.set()
+            # Еще не начатая задача не запустится, начатая увидит cancelled
+            future.cancel()
+            _drain(channel)
+            self.pending -= 1
+
+    def shutdown(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._manager.shutdown()
+            self._executor = None
+            self._manager = None
+
+
+excel_jobs = ExcelJobRunner()
@@ -1,3 +1,4 @@
+import time
 from aiogram.types import CallbackQuery, Message, InlineKeyboardMarkup, InputMediaPhoto
 from aiogram.exceptions import TelegramBadRequest
 
@@ -68,4 +69,27 @@ async def update_message(
                     reply_markup=reply_markup
                 )
         except Exception as ex:
-            print(f"Failed to recover: {ex}")
\ No newline at end of file
+            print(f"Failed to recover: {ex}")
+
+
+class ProgressMessage:
+    """Сообщение о ходе длительной операции, которое редактируется не чаще раза в interval секунд"""
+
+    def __init__(self, message: Message, interval: float = 2.0):
+        self.message = message
+        self.interval = interval
+        self._last_text = message.text
+        self._last_update = time.monotonic()
+
+    async def update(self, text: str, force: bool = False):
+        if text == self._last_text:
+            return
+        now = time.monotonic()
+        if not force and now - self._last_update < self.interval:
+            return
+        try:
+            await self.message.edit_text(text)
+            self._last_text = text
+            self._last_update = now
+        except TelegramBadRequest as e:
+            print(f"Telegram error: {e}")
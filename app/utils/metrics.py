@@ -0,0 +1,155 @@
+import threading
+from typing import Dict, Optional, Sequence, Tuple
+
+# Границы гистограмм времени по умолчанию (сек.)
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+Labels = Tuple[Tuple[str, str], ...]
+
+
+def _labels(labels: Dict[str, str]) -> Labels:
+    return tuple(sorted((key, str(value)) for key, value in labels.items()))
+
+
+def _format_labels(labels: Labels, extra: Labels = ()) -> str:
+    pairs = labels + extra
+    if not pairs:
+        return ""
+    return "{" + ",".join(f'{key}="{value}"' for key, value in pairs) + "}"
+
+
+# Снимок метрики для передачи между процессами: (тип, описание, значения, границы гистограммы)
+Snapshot = Tuple[str, str, dict, Tuple[float, ...]]
+
+
+def _samples(name: str, snapshot: Snapshot, extra: Labels = ()) -> list[str]:
+    kind, _, values, buckets = snapshot
+    if kind != "histogram":
+        return [f"{name}{_format_labels(key + extra)} {value}" for key, value in values.items()]
+    lines = []
+    for key, (counts, total, count) in values.items():
+        key += extra
+        for bound, bucket_count in zip(buckets, counts):
+            lines.append(f"{name}_bucket{_format_labels(key, (('le', str(bound)),))} {bucket_count}")
+        lines.append(f"{name}_bucket{_format_labels(key, (('le', '+Inf'),))} {count}")
+        lines.append(f"{name}_sum{_format_labels(key)} {total}")
+        lines.append(f"{name}_count{_format_labels(key)} {count}")
+    return lines
+
+
+class _Metric:
+    kind = ""
+    buckets: Tuple[float, ...] = ()
+
+    def __init__(self, name: str, description: str):
+        self.name = name
+        self.description = description
+        self._lock = threading.Lock()
+
+    def snapshot(self) -> Snapshot:
+        with self._lock:
+            return self.kind, self.description, self._copy_values(), self.buckets
+
+    def _copy_values(self) -> dict:
+        raise NotImplementedError
+
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def __init__(self, name: str, description: str):
+        super().__init__(name, description)
+        self.values: Dict[Labels, float] = {}
+
+    def inc(self, amount: float = 1, **labels):
+        key = _labels(labels)
+        with self._lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def get(self, **labels) -> float:
+        return self.values.get(_labels(labels), 0)
+
+    def _copy_values(self) -> dict:
+        return dict(self.values)
+
+
+class Gauge(Counter):
+    kind = "gauge"
+
+    def dec(self, amount: float = 1, **labels):
+        self.inc(-amount, **labels)
+
+    def set(self, value: float, **labels):
+        with self._lock:
+            self.values[_labels(labels)] = value
+
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(self, name: str, description: str, buckets: Sequence[float] = DEFAULT_BUCKETS):
+        super().__init__(name, description)
+        self.buckets = tuple(buckets)
+        # labels -> [счетчики по границам, сумма, количество]
+        self.values: Dict[Labels, list] = {}
+
+    def observe(self, value: float, **labels):
+        key = _labels(labels)
+        with self._lock:
+            counts, total, count = self.values.get(key) or ([0] * len(self.buckets), 0.0, 0)
+            for index, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[index] += 1
+            self.values[key] = [counts, total + value, count + 1]
+
+    def get(self, **labels) -> Tuple[float, int]:
+        """Сумма и количество наблюдений"""
+        _, total, count = self.values.get(_labels(labels), (None, 0.0, 0))
+        return total, count
+
+    def _copy_values(self) -> dict:
+        return {key: [list(counts), total, count] for key, (counts, total, count) in self.values.items()}
+
+
+class MetricsRegistry:
+    """Метрики процесса в формате Prometheus (text exposition)"""
+
+    def __init__(self):
+        self.metrics: Dict[str, _Metric] = {}
+
+    def _register(self, metric: _Metric) -> _Metric:
+        return self.metrics.setdefault(metric.name, metric)
+
+    def counter(self, name: str, description: str) -> Counter:
+        return self._register(Counter(name, description))
+
+    def gauge(self, name: str, description: str) -> Gauge:
+        return self._register(Gauge(name, description))
+
+    def histogram(self, name: str, description: str, buckets: Sequence[float] = DEFAULT_BUCKETS) -> Histogram:
+        return self._register(Histogram(name, description, buckets))
+
+    def snapshot(self) -> Dict[str, Snapshot]:
+        """Значения всех метрик для передачи в другой процесс"""
+        return {name: metric.snapshot() for name, metric in list(self.metrics.items())}
+
+    def render(self, shards: Optional[Dict[int, Dict[str, Snapshot]]] = None) -> str:
+        """Метрики в формате Prometheus
+
+        Args:
+            shards: Снимки метрик процессов-обработчиков {номер процесса: snapshot()};
+                их значения выводятся с меткой shard
+        """
+        sources = [((), self.snapshot())]
+        sources += [((("shard", str(index)),), snapshot) for index, snapshot in sorted((shards or {}).items())]
+        lines = []
+        for name in dict.fromkeys(name for _, snapshot in sources for name in snapshot):
+            kind, description = next(snapshot[name][:2] for _, snapshot in sources if name in snapshot)
+            lines += [f"# HELP {name} {description}", f"# TYPE {name} {kind}"]
+            for extra, snapshot in sources:
+                if name in snapshot:
+                    lines.extend(_samples(name, snapshot[name], extra))
+        return "\n".join(lines) + "\n"
+
+
+metrics = MetricsRegistry()
@@ -0,0 +1,222 @@
+import asyncio
+import hmac
+import multiprocessing
+import os
+import queue
+from typing import Any, Callable, Dict, List, Optional
+from aiohttp import web
+from aiogram import Bot, Dispatcher
+
+from app.database.models import Base
+from app.database.versions import shared_table_versions, use_shared_table_versions
+from app.utils.metrics import metrics
+from app.utils.webhook import (
+    WEBHOOK_URL, WEBHOOK_PATH, WEBHOOK_SECRET, WEBHOOK_HOST, WEBHOOK_PORT, start_metrics_server
+)
+
+# Количество процессов-обработчиков; 1 - обычный режим в одном процессе
+BOT_WORKERS = int(os.getenv("BOT_WORKERS", "1"))
+
+# Long polling получателя: сколько секунд Telegram держит запрос getUpdates
+POLLING_TIMEOUT = 30
+
+# Как часто процессы-обработчики передают получателю снимок своих метрик (сек.)
+METRICS_PUSH_INTERVAL = 5
+
+
+def shard_key(raw: Dict[str, Any]) -> int:
+    """Ключ шардирования обновления: id пользователя, а если его нет - id чата"""
+    for key, payload in raw.items():
+        if key == "update_id" or not isinstance(payload, dict):
+            continue
+        user = payload.get("from") or payload.get("user")
+        if isinstance(user, dict) and "id" in user:
+            return user["id"]
+        chat = payload.get("chat") or (payload.get("message") or {}).get("chat")
+        if isinstance(chat, dict) and "id" in chat:
+            return chat["id"]
+    return 0
+
+
+class ShardRouter:
+    """Раскладывает обновления по очередям процессов: один пользователь - всегда один процесс"""
+
+    def __init__(self, queues: List[Any]):
+        self.queues = queues
+
+    def route(self, raw: Dict[str, Any]) -> int:
+        index = shard_key(raw) % len(self.queues)
+        self.queues[index].put(raw)
+        return index
+
+
+def shard_metrics_handler(shard_metrics):
+    """Обработчик /metrics получателя: свои метрики и метрики процессов-обработчиков с меткой shard"""
+
+    async def handler(request: web.Request) -> web.Response:
+        shards = await asyncio.to_thread(shard_metrics.copy)
+        return web.Response(text=metrics.render(shards), content_type="text/plain", charset="utf-8")
+    return handler
+
+
+async def _push_metrics(index: int, shard_metrics):
+    """Периодически передает снимок метрик процесса получателю"""
+    while True:
+        await asyncio.sleep(METRICS_PUSH_INTERVAL)
+        try:
+            await asyncio.to_thread(shard_metrics.__setitem__, index, metrics.snapshot())
+        except Exception as e:
+            print(f"Failed to push metrics of worker {index}: {e}")
+
+
+def _worker_main(index: int, updates, versions: dict, shard_metrics, create_bot: Callable[[], Bot],
+                 build_dispatcher: Callable[[], Dispatcher]):
+    """Точка входа процесса-обработчика"""
+    use_shared_table_versions(versions)
+    try:
+        asyncio.run(_serve_worker(index, updates, shard_metrics, create_bot(), build_dispatcher()))
+    except KeyboardInterrupt:
+        pass
+
+
+async def _serve_worker(index: int, updates, shard_metrics, bot: Bot, dp: Dispatcher):
+    dp["shard_index"] = index
+    workflow_data = {"dispatcher": dp, "bots": [bot], **dp.workflow_data}
+    await dp.emit_startup(bot=bot, **workflow_data)
+    tasks = set()
+    pusher = asyncio.create_task(_push_metrics(index, shard_metrics))
+    try:
+        running = True
+        while running:
+            batch = [await asyncio.to_thread(updates.get)]
+            # Забираем все, что уже пришло, без лишних переходов в поток
+            while True:
+                try:
+                    batch.append(updates.get_nowait())
+                except queue.Empty:
+                    break
+            for raw in batch:
+                if raw is None:
+                    running = False
+                    break
+                # Порядок обновлений пользователя сохраняет OrderedDispatchMiddleware:
+                # задачи стартуют в порядке создания
+                task = asyncio.create_task(dp.feed_raw_update(bot, raw))
+                tasks.add(task)
+                task.add_done_callback(tasks.discard)
+        if tasks:
+            await asyncio.gather(*tasks, return_exceptions=True)
+    finally:
+        pusher.cancel()
+        await dp.emit_shutdown(bot=bot, **workflow_data)
+        await bot.session.close()
+
+
+async def _poll(bot: Bot, router: ShardRouter, allowed_updates: List[str]):
+    await bot.delete_webhook(drop_pending_updates=True)
+    offset: Optional[int] = None
+    while True:
+        try:
+            updates = await bot.get_updates(offset=offset, timeout=POLLING_TIMEOUT, allowed_updates=allowed_updates)
+        except Exception as e:
+            print(f"Failed to fetch updates: {e}")
+            await asyncio.sleep(1)
+            continue
+        for update in updates:
+            router.route(update.model_dump(mode="json", by_alias=True, exclude_none=True))
+            offset = update.update_id + 1
+
+
+def build_receiver_app(router: ShardRouter, metrics_handler, path: str = WEBHOOK_PATH,
+                       secret: str = WEBHOOK_SECRET) -> web.Application:
+    """Webhook-получатель: проверяет секрет, отдает обновление нужному процессу и сразу отвечает 200
+
+    Args:
+        metrics_handler: Обработчик /metrics (см. shard_metrics_handler)
+    """
+
+    async def receive(request: web.Request) -> web.Response:
+        token = request.headers.get("X-Telegram-Bot-Api-Secret-Token", "")
+        if not hmac.compare_digest(token, secret or ""):
+            return web.Response(status=401, text="Unauthorized")
+        router.route(await request.json())
+        return web.Response()
+
+    app = web.Application()
+    app.router.add_post(path, receive)
+    app.router.add_get("/metrics", metrics_handler)
+    return app
+
+
+async def _serve_webhook(bot: Bot, router: ShardRouter, allowed_updates: List[str], metrics_handler):
+    if not WEBHOOK_URL or not WEBHOOK_SECRET:
+        raise ValueError("Для режима webhook нужны WEBHOOK_URL и WEBHOOK_SECRET")
+    runner = web.AppRunner(build_receiver_app(router, metrics_handler))
+    await runner.setup()
+    try:
+        await web.TCPSite(runner, WEBHOOK_HOST, WEBHOOK_PORT).start()
+        await bot.set_webhook(
+            WEBHOOK_URL.rstrip("/") + WEBHOOK_PATH,
+            secret_token=WEBHOOK_SECRET,
+            allowed_updates=allowed_updates,
+            drop_pending_updates=True
+        )
+        await asyncio.Event().wait()
+    finally:
+        await runner.cleanup()
+
+
+async def run_sharded(create_bot: Callable[[], Bot], build_dispatcher: Callable[[], Dispatcher],
+                      workers: int, mode: str = "polling"):
+    """Запускает бота в workers процессах
+
+    Текущий процесс только получает обновления (long polling или webhook) и
+    раскладывает их по процессам по id пользователя, поэтому состояние FSM и кэши
+    пользователя живут в одном процессе, а его обновления обрабатываются по порядку.
+    Версии таблиц для кэшей хранятся в общей памяти. Процессы-обработчики раз в
+    METRICS_PUSH_INTERVAL передают снимки метрик получателю, и он отдает их по
+    /metrics с меткой shard (в режиме polling - на METRICS_PORT).
+
+    Args:
+        create_bot, build_dispatcher: Фабрики бота и диспетчера; вызываются в каждом процессе
+        mode: "polling" или "webhook"
+    """
+    # spawn: дочерние процессы не наследуют цикл событий и соединения с БД
+    context = multiprocessing.get_context("spawn")
+    versions = shared_table_versions(context, Base.metadata.tables)
+    use_shared_table_versions(versions)
+
+    manager = context.Manager()
+    shard_metrics = manager.dict()
+    metrics_handler = shard_metrics_handler(shard_metrics)
+
+    queues = [context.Queue() for _ in range(workers)]
+    processes = [
+        context.Process(target=_worker_main,
+                        args=(index, updates, versions, shard_metrics, create_bot, build_dispatcher),
+                        name=f"bot-worker-{index}", daemon=True)
+        for index, updates in enumerate(queues)
+    ]
+    for process in processes:
+        process.start()
+    print(f"✅ Запущено процессов-обработчиков: {workers}")
+
+    bot = create_bot()
+    allowed_updates = build_dispatcher().resolve_used_update_types()
+    router = ShardRouter(queues)
+    metrics_server = None
+    try:
+        if mode == "webhook":
+            await _serve_webhook(bot, router, allowed_updates, metrics_handler)
+        else:
+            metrics_server = await start_metrics_server(metrics_handler)
+            await _poll(bot, router, allowed_updates)
+    finally:
+        if metrics_server is not None:
+            await metrics_server.cleanup()
+        for updates in queues:
+            updates.put(None)
+        for process in processes:
+            await asyncio.to_thread(process.join, 30)
+        await bot.session.close()
+        manager.shutdown()
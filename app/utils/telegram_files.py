@@ -0,0 +1,50 @@
+import io
+import os
+import tempfile
+from contextlib import asynccontextmanager
+from typing import AsyncIterator, Union
+from aiogram import Bot
+from aiogram.types import Document
+
+# Максимальный размер загружаемого файла и порог, после которого файл пишется на диск
+MAX_UPLOAD_SIZE = int(os.getenv("MAX_UPLOAD_SIZE", str(20 * 1024 * 1024)))
+IN_MEMORY_UPLOAD_SIZE = int(os.getenv("IN_MEMORY_UPLOAD_SIZE", str(5 * 1024 * 1024)))
+
+
+class UploadTooLarge(Exception):
+    """Загруженный файл превышает допустимый размер"""
+
+
+@asynccontextmanager
+async def downloaded_document(bot: Bot, document: Document) -> AsyncIterator[Union[bytes, str]]:
+    """Скачивает документ из Telegram
+
+    Небольшие файлы скачиваются в память и отдаются как bytes, большие - во временный
+    файл, путь к которому отдаётся вместо содержимого. Временный файл удаляется при
+    выходе из контекста, в том числе при ошибке.
+
+    Raises:
+        UploadTooLarge: если файл больше MAX_UPLOAD_SIZE
+    """
+    file_size = document.file_size or 0
+    if file_size > MAX_UPLOAD_SIZE:
+        raise UploadTooLarge(
+            f"Файл слишком большой ({file_size // 1024} КБ), максимум {MAX_UPLOAD_SIZE // 1024} КБ"
+        )
+
+    if file_size and file_size <= IN_MEMORY_UPLOAD_SIZE:
+        buffer = io.BytesIO()
+        await bot.download(document, destination=buffer)
+        yield buffer.getvalue()
+        return
+
+    fd, path = tempfile.mkstemp(suffix=os.path.splitext(document.file_name or "")[1])
+    os.close(fd)
+    try:
+        await bot.download(document, destination=path)
+        yield path
+    finally:
+        try:
+            os.unlink(path)
+        except OSError:
+            pass
@@ -1,3 +1,6 @@
+from html import escape
+
+
 def anonymous_block_description() -> str:
     return (
         "<b>Анонимные вопросы HR</b>\n\n"
@@ -5,3 +8,61 @@ def anonymous_block_description() -> str:
         "📌 <b>Все ваши вопросы останутся анонимными</b>, и только вы будете знать, кто их задал. Мы ценим вашу откровенность и готовы учесть каждое мнение.\n\n"
         "Не стесняйтесь делиться своими мыслями! Пожалуйста, введите свой вопрос или предложение:"
     )
+
+
+PRODUCT_FIELD_LABELS = {
+    'name': 'Наименование',
+    'description': 'Описание',
+    'price': 'Цена',
+    'image_url': 'Изображение',
+    'is_available': 'Доступен',
+    'stock': 'Остаток',
+    'sizes': 'Размеры',
+    'colors': 'Цвета'
+}
+
+
+def _short(value, limit: int = 40) -> str:
+    text = "—" if value is None or value == "" else str(value)
+    if len(text) > limit:
+        text = text[:limit - 3] + "..."
+    return escape(text)
+
+
+def catalog_diff_description(diff: dict, limit: int = 20) -> str:
+    """Текст предпросмотра изменений каталога перед применением импорта"""
+    text = (
+        "📋 <b>Предпросмотр изменений каталога</b>\n\n"
+        f"➕ Новых товаров: {len(diff['created'])}\n"
+        f"✏️ Изменённых товаров: {len(diff['updated'])}\n"
+        f"▫️ Без изменений: {diff['unchanged']}\n"
+    )
+
+    lines = []
+    for product_id, columns in diff["changes"].items():
+        changes = "; ".join(
+            f"{PRODUCT_FIELD_LABELS.get(column, column)}: {_short(old)} → {_short(new)}"
+            for column, (old, new) in columns.items()
+        )
+        lines.append(f"#{product_id}: {changes}")
+    for row in diff["created"]:
+        lines.append(f"➕ {_short(row.get('name'))}")
+
+    if lines:
+        text += "\n<b>Изменения:</b>\n" + "\n".join(lines[:limit])
+        if len(lines) > limit:
+            text += f"\n... и ещё {len(lines) - limit}"
+
+    stock = diff.get("stock") or {}
+    if stock:
+        # Остатки уменьшаются заказами, поэтому меняются только отдельной кнопкой
+        stock_lines = [f"#{product_id}: {_short(old)} → {_short(new)}" for product_id, (old, new) in stock.items()]
+        text += (
+            f"\n\n📦 <b>Остатки отличаются у {len(stock)} товаров</b>\n"
+            "Применяются только кнопкой «с остатками»: значения из файла заменят текущие, "
+            "включая уже проданные единицы.\n" + "\n".join(stock_lines[:limit])
+        )
+        if len(stock_lines) > limit:
+            text += f"\n... и ещё {len(stock_lines) - limit}"
+
+    return text
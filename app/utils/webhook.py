@@ -0,0 +1,79 @@
+import asyncio
+import os
+from typing import Optional
+from aiohttp import web
+from aiogram import Bot, Dispatcher
+from aiogram.webhook.aiohttp_server import SimpleRequestHandler, setup_application
+
+from app.utils.metrics import metrics
+
+# Режим webhook: публичный адрес бота, путь и секрет, который Telegram передает в заголовке
+WEBHOOK_URL = os.getenv("WEBHOOK_URL", "")
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "/webhook")
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET")
+WEBHOOK_HOST = os.getenv("WEBHOOK_HOST", "0.0.0.0")
+WEBHOOK_PORT = int(os.getenv("WEBHOOK_PORT", "8080"))
+
+# Режим long polling: адрес и порт отдельной страницы метрик (0 - не запускать)
+METRICS_HOST = os.getenv("METRICS_HOST", WEBHOOK_HOST)
+METRICS_PORT = int(os.getenv("METRICS_PORT", "9100"))
+
+
+async def metrics_handler(request: web.Request) -> web.Response:
+    return web.Response(text=metrics.render(), content_type="text/plain", charset="utf-8")
+
+
+async def start_metrics_server(handler=metrics_handler, host: str = METRICS_HOST,
+                               port: int = METRICS_PORT) -> Optional[web.AppRunner]:
+    """Отдает метрики по /metrics, когда webhook-приложения нет (long polling)
+
+    Returns:
+        Запущенный сервер (остановить - cleanup()) или None, если METRICS_PORT=0
+    """
+    if not port:
+        return None
+    app = web.Application()
+    app.router.add_get("/metrics", handler)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.TCPSite(runner, host, port).start()
+    print(f"Метрики: {host}:{port}/metrics")
+    return runner
+
+
+def build_webhook_app(dp: Dispatcher, bot: Bot, path: str = WEBHOOK_PATH, secret: str = WEBHOOK_SECRET) -> web.Application:
+    """aiohttp-приложение, принимающее обновления от Telegram
+
+    Запрос без верного X-Telegram-Bot-Api-Secret-Token отклоняется. Telegram сразу
+    получает ответ 200, а обновление обрабатывается в фоновой задаче.
+    Дополнительно отдает метрики по /metrics.
+    """
+    app = web.Application()
+    SimpleRequestHandler(dispatcher=dp, bot=bot, handle_in_background=True, secret_token=secret).register(app, path=path)
+    app.router.add_get("/metrics", metrics_handler)
+    # Запуск и остановка приложения вызывают startup/shutdown диспетчера
+    setup_application(app, dp, bot=bot)
+    return app
+
+
+async def run_webhook(dp: Dispatcher, bot: Bot):
+    """Регистрирует webhook в Telegram и обслуживает его до остановки процесса"""
+    if not WEBHOOK_URL:
+        raise ValueError("Для режима webhook нужен WEBHOOK_URL")
+    if not WEBHOOK_SECRET:
+        raise ValueError("Для режима webhook нужен WEBHOOK_SECRET")
+
+    runner = web.AppRunner(build_webhook_app(dp, bot))
+    await runner.setup()
+    try:
+        await web.TCPSite(runner, WEBHOOK_HOST, WEBHOOK_PORT).start()
+        await bot.set_webhook(
+            WEBHOOK_URL.rstrip("/") + WEBHOOK_PATH,
+            secret_token=WEBHOOK_SECRET,
+            allowed_updates=dp.resolve_used_update_types(),
+            drop_pending_updates=True
+        )
+        print(f"Webhook: слушаю {WEBHOOK_HOST}:{WEBHOOK_PORT}{WEBHOOK_PATH}")
+        await asyncio.Event().wait()
+    finally:
+        await runner.cleanup()
@@ -3,10 +3,20 @@ import asyncio
 from dotenv import load_dotenv
 from aiogram import Bot, Dispatcher
 from aiogram.enums.parse_mode import ParseMode
-from aiogram.fsm.storage.memory import MemoryStorage
 from app.middlewares.group_membership import GroupMembershipMiddleware
 from app.middlewares.database import DatabaseMiddleware
+from app.middlewares.deduplication import UpdateDeduplicationMiddleware
+from app.middlewares.dispatch import OrderedDispatchMiddleware
+from app.middlewares.admission import AdmissionControlMiddleware
+from app.middlewares.session_expired import SessionExpiredMiddleware
 from app.database.database import init_db, SessionLocal
+from app.utils.job_runner import excel_jobs
+from app.utils.webhook import run_webhook, start_metrics_server
+from app.utils.sharding import run_sharded, BOT_WORKERS
+from app.states.storage import create_storage, KeyEventIsolation
+from app.services.flash_sale import flash_sale
+from app.services.cart_debounce import cart_quantities
+from app.services.cart_compaction import cart_compactor
 
 # Import models to register them with Base
 from app.database.models import User, TPointsTransaction, Product, Order, AnonymousQuestion
@@ -20,22 +30,39 @@ from app.handlers.user_manage import user_manage_router
 from app.handlers.anon_questions import anon_questions_router
 from app.handlers.catalog_manage import catalog_manage_router
 from app.handlers.cart import cart_router
+from app.handlers.data_export import data_export_router
 
 async def on_startup(dispatcher: Dispatcher):
+    # В многопроцессном режиме фоновая очистка корзин работает только в одном процессе
+    if dispatcher.get("shard_index", 0) == 0:
+        cart_compactor.start()
     print("✅ Бот запущен")
 
 async def on_shutdown(dispatcher: Dispatcher):
+    excel_jobs.shutdown()
+    await flash_sale.stop()
+    await cart_quantities.stop()
+    await cart_compactor.stop()
     print("❌ Бот остановлен")
 
-async def main():
-    load_dotenv()
-    # Initialize database
-    await init_db()
-    bot = Bot(token=os.getenv("TOKEN"))
-    dp = Dispatcher(storage=MemoryStorage())
+def create_bot() -> Bot:
+    return Bot(token=os.getenv("TOKEN"))
+
+
+def build_dispatcher() -> Dispatcher:
+    # Обновления пользователя обрабатываются по очереди начиная с чтения состояния FSM
+    dp = Dispatcher(storage=create_storage(SessionLocal), events_isolation=KeyEventIsolation())
+    dp.update.outer_middleware(UpdateDeduplicationMiddleware())
+    # Порядок важен: отклонение при перегрузке до постановки в очередь планировщика
+    dispatch = OrderedDispatchMiddleware()
+    dp.update.outer_middleware(AdmissionControlMiddleware(dispatch))
+    dp.update.outer_middleware(dispatch)
     dp.update.middleware(DatabaseMiddleware(SessionLocal))
 
     # middlewares
+    # До фильтров состояний: продолжение истекшего сценария получает понятный ответ
+    dp.callback_query.outer_middleware(SessionExpiredMiddleware())
+    dp.message.outer_middleware(SessionExpiredMiddleware())
     dp.callback_query.middleware(GroupMembershipMiddleware(target_group_id=os.getenv("GROUP_ID")))
 
     dp.message.middleware(GroupMembershipMiddleware( target_group_id=os.getenv("GROUP_ID")))
@@ -49,14 +76,40 @@ async def main():
         order_router,
         user_manage_router,
         anon_questions_router,
-        catalog_manage_router
+        catalog_manage_router,
+        data_export_router
     )
 
     # события
     dp.startup.register(on_startup)
     dp.shutdown.register(on_shutdown)
+    return dp
+
+
+async def main():
+    load_dotenv()
+    # Initialize database
+    await init_db()
+    mode = os.getenv("BOT_MODE", "polling")
+
+    # BOT_WORKERS > 1: получатель раскладывает обновления по процессам-обработчикам
+    if BOT_WORKERS > 1:
+        await run_sharded(create_bot, build_dispatcher, BOT_WORKERS, mode)
+        return
+
+    bot = create_bot()
+    dp = build_dispatcher()
+    # BOT_MODE=webhook для продакшена, по умолчанию long polling (локальная разработка)
+    if mode == "webhook":
+        await run_webhook(dp, bot)
+        return
     await bot.delete_webhook(drop_pending_updates=True)
-    await dp.start_polling(bot)
+    metrics_server = await start_metrics_server()
+    try:
+        await dp.start_polling(bot)
+    finally:
+        if metrics_server is not None:
+            await metrics_server.cleanup()
 
 if __name__ == '__main__':
     try: